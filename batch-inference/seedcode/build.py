@@ -4,8 +4,9 @@ import logging
 import os
 
 import boto3
-from botocore.exceptions import ClientError
 
+from model_registry import get_approved_package
+from stage_config import get_stages, write_stage_configs
 from pipelines import run_pipeline
 
 from sagemaker.model import Model
@@ -16,56 +17,7 @@ logger = logging.getLogger(__name__)
 sm_client = boto3.client("sagemaker")
 
 
-def get_approved_package(model_package_group_name):
-    """Gets the latest approved model package for a model package group.
-
-    Args:
-        model_package_group_name: The model package group name.
-
-    Returns:
-        The SageMaker Model Package ARN.
-    """
-    try:
-        # Get the latest approved model package
-        response = sm_client.list_model_packages(
-            ModelPackageGroupName=model_package_group_name,
-            ModelApprovalStatus="Approved",
-            SortBy="CreationTime",
-            MaxResults=100,
-        )
-        approved_packages = response["ModelPackageSummaryList"]
-
-        # Fetch more packages if none returned with continuation token
-        while len(approved_packages) == 0 and "NextToken" in response:
-            logger.debug("Getting more packages for token: {}".format(response["NextToken"]))
-            response = sm_client.list_model_packages(
-                ModelPackageGroupName=model_package_group_name,
-                ModelApprovalStatus="Approved",
-                SortBy="CreationTime",
-                MaxResults=100,
-                NextToken=response["NextToken"],
-            )
-            approved_packages.extend(response["ModelPackageSummaryList"])
-
-        # Return error if no packages found
-        if len(approved_packages) == 0:
-            error_message = (
-                f"No approved ModelPackage found for ModelPackageGroup: {model_package_group_name}"
-            )
-            logger.error(error_message)
-            raise Exception(error_message)
-
-        # Return the pmodel package arn
-        model_package_arn = approved_packages[0]["ModelPackageArn"]
-        print(approved_packages[0])
-        logger.info(f"Identified the latest approved model package: {model_package_arn}")
-        return model_package_arn
-    except ClientError as e:
-        error_message = e.response["Error"]["Message"]
-        logger.error(error_message)
-        raise Exception(error_message)
-
-def extend_config(args, model_package_arn, pipeline_arn, stage_config):
+def extend_config(args, model_package_arn, pipeline_arn, stage_config, project_tags):
     """
     Extend the stage configuration with additional parameters and tags based.
     """
@@ -88,7 +40,7 @@ def extend_config(args, model_package_arn, pipeline_arn, stage_config):
         "sagemaker:project-name": args.sagemaker_project_name,
     }
     # Add tags from Project
-    get_pipeline_custom_tags(args, sm_client, new_tags)
+    new_tags.update(project_tags)
 
     return {
         "Parameters": {**stage_config["Parameters"], **new_params},
@@ -106,31 +58,6 @@ def get_pipeline_custom_tags(args, sm_client, new_tags):
         logger.error("Error getting project tags")
     return new_tags
 
-def get_cfn_style_config(stage_config):
-    parameters = []
-    for key, value in stage_config["Parameters"].items():
-        parameter = {
-            "ParameterKey": key,
-            "ParameterValue": value
-        }
-        parameters.append(parameter)
-    tags = []
-    for key, value in stage_config["Tags"].items():
-        tag = {
-            "Key": key,
-            "Value": value
-        }
-        tags.append(tag)
-    return parameters, tags
-
-def create_cfn_params_tags_file(config, export_params_file, export_tags_file):
-    # Write Params and tags in separate file for Cfn cli command
-    parameters, tags = get_cfn_style_config(config)
-    with open(export_params_file, "w") as f:
-        json.dump(parameters, f, indent=4)
-    with open(export_tags_file, "w") as f:
-        json.dump(tags, f, indent=4)
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--log-level", type=str, default=os.environ.get("LOGLEVEL", "INFO").upper())
@@ -140,6 +67,7 @@ if __name__ == "__main__":
     parser.add_argument("--sagemaker-project-id", type=str, required=True)
     parser.add_argument("--sagemaker-project-name", type=str, required=True)
     parser.add_argument("--sagemaker-project-arn", type=str, required=False)
+    parser.add_argument("--default-bucket", type=str, default=None)
     parser.add_argument("--import-staging-config", type=str, default="staging-config.json")
     parser.add_argument("--import-prod-config", type=str, default="prod-config.json")
     parser.add_argument("--export-staging-config", type=str, default="staging-config-export.json")
@@ -149,6 +77,8 @@ if __name__ == "__main__":
     parser.add_argument("--export-prod-params", type=str, default="prod-params-export.json")
     parser.add_argument("--export-prod-tags", type=str, default="prod-tags-export.json")
     parser.add_argument("--export-cfn-params-tags", type=bool, default=False)
+    parser.add_argument("--shards-per-instance", type=int, default=None)
+    parser.add_argument("--incremental", action="store_true")
     args, _ = parser.parse_known_args()
 
     # Configure logging to output the line number and message
@@ -156,7 +86,7 @@ if __name__ == "__main__":
     logging.basicConfig(format=log_format, level=args.log_level)
 
     # Get the latest approved package
-    model_package_arn = get_approved_package(args.model_package_group_name)
+    model_package_arn = get_approved_package(args.model_package_group_name, sm_client)
 
     # Build the pipeline
     pipeline_definition = run_pipeline.main(
@@ -168,25 +98,21 @@ if __name__ == "__main__":
         ]),
         json.dumps({
             'region':args.aws_region,
+            'role':args.model_execution_role,
+            'default_bucket':args.default_bucket,
             'pipeline_name':f'{args.sagemaker_project_name}-{args.sagemaker_project_id}-BatchInference',
-            'base_job_prefix':f'{args.sagemaker_project_name}-{args.sagemaker_project_id}'
+            'base_job_prefix':f'{args.sagemaker_project_name}-{args.sagemaker_project_id}',
+            'shards_per_instance':args.shards_per_instance,
+            'incremental':args.incremental
         })
     )
 
-    # Write the staging config
-    with open(args.import_staging_config, "r") as f:
-        staging_config = extend_config(args, model_package_arn, pipeline_definition, json.load(f))
-    logger.debug("Staging config: {}".format(json.dumps(staging_config, indent=4)))
-    with open(args.export_staging_config, "w") as f:
-        json.dump(staging_config, f, indent=4)
-    if (args.export_cfn_params_tags):
-      create_cfn_params_tags_file(staging_config, args.export_staging_params, args.export_staging_tags)
+    # Get the project tags once for every stage
+    project_tags = get_pipeline_custom_tags(args, sm_client, {})
 
-    # Write the prod config for code pipeline
-    with open(args.import_prod_config, "r") as f:
-        prod_config = extend_config(args, model_package_arn, pipeline_definition, json.load(f))
-    logger.debug("Prod config: {}".format(json.dumps(prod_config, indent=4)))
-    with open(args.export_prod_config, "w") as f:
-        json.dump(prod_config, f, indent=4)
-    if (args.export_cfn_params_tags):
-      create_cfn_params_tags_file(prod_config, args.export_prod_params, args.export_prod_tags)
+    # Write the config of every stage
+    write_stage_configs(
+        get_stages(args, ["staging", "prod"]),
+        lambda stage_config: extend_config(args, model_package_arn, pipeline_definition, stage_config, project_tags),
+        args.export_cfn_params_tags,
+    )
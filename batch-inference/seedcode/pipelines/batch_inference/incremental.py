@@ -0,0 +1,142 @@
+"""Selects the input objects not scored yet and commits the watermark once they are scored.
+
+The watermark is the ETag of every input object scored by the model package, kept in the
+artifact bucket. The select mode lists the InputPath prefix and writes a manifest of the objects
+that are new or changed since the watermark, every object when the model package or the input
+path changed, along with the watermark to commit. The commit mode then copies that watermark to
+the watermark location after the transform succeeded, so a failed execution is retried in full.
+"""
+import argparse
+import json
+import logging
+import os
+import pathlib
+import shutil
+from urllib.parse import urlparse
+
+import boto3
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.StreamHandler())
+
+WATERMARK_FILE = "watermark.json"
+
+
+def split_s3_uri(uri):
+    """Splits an s3:// uri into its bucket and key."""
+    parsed = urlparse(uri)
+    return parsed.netloc, parsed.path.lstrip("/")
+
+
+def list_input_objects(s3_client, input_path):
+    """Lists the ETag of every object under the input path, by key."""
+    bucket, prefix = split_s3_uri(input_path)
+    objects = {}
+    for page in s3_client.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        for content in page.get("Contents", []):
+            if not content["Key"].endswith("/"):
+                objects[content["Key"]] = content["ETag"]
+    return objects
+
+
+def read_watermark(s3_client, watermark_uri):
+    """Reads the last committed watermark, or None before the first commit."""
+    bucket, prefix = split_s3_uri(watermark_uri)
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=f"{prefix.rstrip('/')}/{WATERMARK_FILE}")
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None
+        raise
+    return json.loads(response["Body"].read())
+
+
+def select_objects(objects, watermark, model_package_name, input_path):
+    """Selects the keys of the objects to score, in key order.
+
+    Args:
+        objects: the ETag of every input object, by key
+        watermark: the last committed watermark, or None
+        model_package_name: the model package the transform scores with
+        input_path: the InputPath of the execution
+
+    Returns:
+        the keys to score and whether every object is rescored
+    """
+    if (
+        watermark is None
+        or watermark["model_package_name"] != model_package_name
+        or watermark["input_path"] != input_path
+    ):
+        return sorted(objects), True
+    scored = watermark["objects"]
+    return sorted(key for key, etag in objects.items() if scored.get(key) != etag), False
+
+
+def write_manifest(keys, input_path, manifest_dir):
+    """Writes the manifest of the selected objects, relative to the directory of the input path.
+
+    Keeping the keys relative to the same directory keeps the transform output names the same
+    as when transforming the whole prefix.
+    """
+    bucket, prefix = split_s3_uri(input_path)
+    directory = prefix[: prefix.rfind("/") + 1]
+    manifest = [{"prefix": f"s3://{bucket}/{directory}"}]
+    manifest.extend(key[len(directory):] for key in keys)
+    pathlib.Path(manifest_dir).mkdir(parents=True, exist_ok=True)
+    with open(os.path.join(manifest_dir, "manifest"), "w") as f:
+        json.dump(manifest, f)
+
+
+def select(input_path, watermark_uri, model_package_name, base_dir):
+    """Writes the manifest, the selection report and the watermark to commit."""
+    s3_client = boto3.client("s3")
+    objects = list_input_objects(s3_client, input_path)
+    watermark = read_watermark(s3_client, watermark_uri)
+    keys, full = select_objects(objects, watermark, model_package_name, input_path)
+    logger.info(
+        "Selected %d of %d input objects%s.",
+        len(keys),
+        len(objects),
+        ", rescoring every object" if full else "",
+    )
+
+    write_manifest(keys, input_path, f"{base_dir}/manifest")
+    pathlib.Path(f"{base_dir}/selection").mkdir(parents=True, exist_ok=True)
+    with open(f"{base_dir}/selection/selection.json", "w") as f:
+        json.dump({"new_objects": len(keys), "input_objects": len(objects), "full": full}, f)
+    pathlib.Path(f"{base_dir}/pending").mkdir(parents=True, exist_ok=True)
+    with open(f"{base_dir}/pending/{WATERMARK_FILE}", "w") as f:
+        json.dump(
+            {
+                "model_package_name": model_package_name,
+                "input_path": input_path,
+                "objects": objects,
+            },
+            f,
+        )
+
+
+def commit(base_dir):
+    """Copies the pending watermark to the watermark output."""
+    pathlib.Path(f"{base_dir}/watermark").mkdir(parents=True, exist_ok=True)
+    shutil.copyfile(
+        f"{base_dir}/pending/{WATERMARK_FILE}", f"{base_dir}/watermark/{WATERMARK_FILE}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", type=str, choices=["select", "commit"], default="select")
+    parser.add_argument("--input-path", type=str)
+    parser.add_argument("--watermark-uri", type=str)
+    parser.add_argument("--model-package-name", type=str, default="")
+    args = parser.parse_args()
+
+    base_dir = "/opt/ml/processing"
+    if args.mode == "commit":
+        commit(base_dir)
+    else:
+        select(args.input_path, args.watermark_uri, args.model_package_name, base_dir)
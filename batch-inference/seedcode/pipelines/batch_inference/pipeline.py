@@ -4,12 +4,23 @@ import boto3
 import sagemaker
 from sagemaker import model
 import sagemaker.session
+from sagemaker.processing import ProcessingInput, ProcessingOutput
+from sagemaker.sklearn.processing import SKLearnProcessor
+from sagemaker.workflow.conditions import ConditionGreaterThan
+from sagemaker.workflow.condition_step import (
+    ConditionStep,
+    JsonGet,
+)
+from sagemaker.workflow.execution_variables import ExecutionVariables
+from sagemaker.workflow.functions import Join
 from sagemaker.workflow.parameters import (
     ParameterInteger,
     ParameterString,
 )
 from sagemaker.workflow.pipeline import Pipeline
+from sagemaker.workflow.properties import PropertyFile
 from sagemaker.workflow.steps import (
+    ProcessingStep,
     TransformStep, 
     Transformer, 
     TransformInput
@@ -68,19 +79,58 @@ def get_pipeline_custom_tags(new_tags, region, sagemaker_project_arn=None):
 
 def get_pipeline(
     region,
+    role=None,
+    default_bucket=None,
     pipeline_name="AbalonePipelineBatchInference",
     base_job_prefix="Abalone",
+    max_concurrent_transforms=None,
+    max_payload=10,
+    shards_per_instance=None,
+    input_filter=None,
+    output_filter=None,
+    processing_instance_type="ml.m5.xlarge",
+    incremental=False,
 ):
     """Gets a SageMaker ML Pipeline instance working with on abalone data.
 
+    The input CSV files are split into lines and sent to the model in mini-batches of up to
+    max_payload MB, each of the BatchInstanceCount instances running max_concurrent_transforms
+    of them at a time, and the predictions are written out one line per record.
+
+    A transform job hands every input object to a single instance, so a large input file is
+    scored by one instance however many are configured. With shards_per_instance set, a
+    processing step first splits the input into BatchInstanceCount * shards_per_instance
+    balanced line-aligned shards listed in a manifest, the transform joins every prediction to
+    its input row, and a second processing step reassembles them in input order as one
+    <input file>.out per input file under OutputPath.
+
+    With incremental set, a processing step first selects the InputPath objects whose ETag
+    differs from the watermark kept per pipeline in the artifact bucket, every object when the
+    ModelPackageName or the InputPath changed. Only those are transformed and, when none are
+    new, the transform is skipped. The watermark is committed once the predictions are written.
+
     Args:
         region: AWS region to create and run the pipeline.
+        role: IAM role to run the processing jobs, when sharding or incremental.
+        default_bucket: the bucket to use for storing the shards, their predictions and the
+            watermarks.
         model_name: Name of the SageMaker Model to deploy
+        max_concurrent_transforms: the number of requests sent at a time to each instance, or
+            None to use the value advertised by the model container, one per vCPU for the
+            built-in XGBoost algorithm
+        max_payload: the maximum size in MB of the mini-batch of records of a request
+        shards_per_instance: the number of shards per transform instance, or None to transform
+            the input objects as they are
+        input_filter: the JSONPath selecting the features sent to the model from every record
+        output_filter: the JSONPath selecting the output columns, of the input row joined to
+            its prediction when sharding
+        processing_instance_type: the instance type of the processing jobs
+        incremental: whether to only transform the input objects not transformed yet
 
     Returns:
         an instance of a pipeline
     """
-    sagemaker_session = get_session(region)
+    sagemaker_session = get_session(region, default_bucket)
 
     #### PARAMETERS
     model_name = ParameterString("ModelName", default_value='${ModelName}')
@@ -88,15 +138,163 @@ def get_pipeline(
     batch_inference_instance_type = ParameterString("BatchInstanceType", default_value='ml.m5.xlarge')
     input_path = ParameterString("InputPath", default_value=f"s3://sagemaker-servicecatalog-seedcode-{region}/dataset/abalone-dataset.csv")
     output_path = ParameterString("OutputPath")
+    model_package_name = ParameterString("ModelPackageName", default_value="")
+
+    if shards_per_instance or incremental:
+        execution_prefix = Join(
+            on="/",
+            values=[
+                f"s3://{sagemaker_session.default_bucket()}",
+                base_job_prefix,
+                "batch-inference",
+                ExecutionVariables.PIPELINE_EXECUTION_ID,
+            ],
+        )
+
+    #### INCREMENTAL SELECTION
+    steps = []
+    input_data = input_path
+    input_data_type = 'S3Prefix'
+    if incremental:
+        incremental_processor = SKLearnProcessor(
+            framework_version="0.23-1",
+            instance_type=processing_instance_type,
+            instance_count=1,
+            base_job_name=f"{base_job_prefix}/batch-inference-incremental",
+            sagemaker_session=sagemaker_session,
+            role=role,
+        )
+        # Staging and prod run the same definition, so the watermark is kept per pipeline
+        watermark_uri = Join(
+            on="/",
+            values=[
+                f"s3://{sagemaker_session.default_bucket()}",
+                base_job_prefix,
+                "batch-inference",
+                ExecutionVariables.PIPELINE_NAME,
+                "watermark",
+            ],
+        )
+        selection_report = PropertyFile(
+            name="BatchInferenceSelection",
+            output_name="selection",
+            path="selection.json",
+        )
+        select_step = ProcessingStep(
+            name='SelectNewInputStep',
+            processor=incremental_processor,
+            outputs=[
+                ProcessingOutput(
+                    output_name="manifest",
+                    source="/opt/ml/processing/manifest",
+                    destination=Join(on="/", values=[execution_prefix, "manifest"]),
+                ),
+                ProcessingOutput(output_name="selection", source="/opt/ml/processing/selection"),
+                ProcessingOutput(output_name="pending", source="/opt/ml/processing/pending"),
+            ],
+            code=os.path.join(BASE_DIR, "incremental.py"),
+            job_arguments=[
+                "--mode",
+                "select",
+                "--input-path",
+                input_path,
+                "--watermark-uri",
+                watermark_uri,
+                "--model-package-name",
+                model_package_name,
+            ],
+            property_files=[selection_report],
+        )
+        input_data = Join(
+            on="/",
+            values=[
+                select_step.properties.ProcessingOutputConfig.Outputs["manifest"].S3Output.S3Uri,
+                "manifest",
+            ],
+        )
+        input_data_type = 'ManifestFile'
+
+    #### SHARDING
+    transform_input = TransformInput(
+        data=input_data,
+        data_type=input_data_type,
+        content_type='text/csv',
+        split_type='Line',
+        input_filter=input_filter,
+        output_filter=output_filter,
+    )
+    transform_output_path = output_path
+    if shards_per_instance:
+        sharding_processor = SKLearnProcessor(
+            framework_version="0.23-1",
+            instance_type=processing_instance_type,
+            instance_count=1,
+            base_job_name=f"{base_job_prefix}/batch-inference-shard",
+            sagemaker_session=sagemaker_session,
+            role=role,
+        )
+        shards_uri = Join(on="/", values=[execution_prefix, "shards"])
+        shard_step = ProcessingStep(
+            name='ShardInputStep',
+            processor=sharding_processor,
+            inputs=[
+                ProcessingInput(
+                    source=input_data,
+                    destination="/opt/ml/processing/input",
+                    s3_data_type=input_data_type,
+                ),
+            ],
+            outputs=[
+                ProcessingOutput(
+                    output_name="shards",
+                    source="/opt/ml/processing/shards",
+                    destination=shards_uri,
+                ),
+                ProcessingOutput(
+                    output_name="layout",
+                    source="/opt/ml/processing/layout",
+                    destination=Join(on="/", values=[execution_prefix, "layout"]),
+                ),
+            ],
+            code=os.path.join(BASE_DIR, "shard.py"),
+            job_arguments=[
+                "--shards-uri",
+                shards_uri,
+                "--instance-count",
+                Join(on="", values=[batch_inference_instance_count]),
+                "--shards-per-instance",
+                str(shards_per_instance),
+            ],
+        )
+        steps.append(shard_step)
+        transform_input = TransformInput(
+            data=Join(
+                on="/",
+                values=[
+                    shard_step.properties.ProcessingOutputConfig.Outputs["shards"].S3Output.S3Uri,
+                    "manifest",
+                ],
+            ),
+            data_type='ManifestFile',
+            content_type='text/csv',
+            split_type='Line',
+            input_filter=input_filter,
+            output_filter=output_filter,
+            join_source='Input',
+        )
+        transform_output_path = Join(on="/", values=[execution_prefix, "predictions"])
 
     #### SAGEMAKER CONSTRUCTS
     transform = Transformer(
         model_name=model_name,
-        instance_count=1,
-        instance_type='ml.m5.xlarge',
-        output_path=output_path,
+        instance_count=batch_inference_instance_count,
+        instance_type=batch_inference_instance_type,
+        strategy='MultiRecord',
+        assemble_with='Line',
+        output_path=transform_output_path,
         base_transform_job_name=f"{base_job_prefix}/batch-transform-job",
-        max_payload=10,
+        max_concurrent_transforms=max_concurrent_transforms,
+        max_payload=max_payload,
         accept='text/csv'
     )
 
@@ -104,14 +302,83 @@ def get_pipeline(
     transform_step = TransformStep(
         name='BatchInferenceStep',
         transformer=transform,
-        inputs=TransformInput(data=input_path, content_type='text/csv')
+        inputs=transform_input
     )
+    steps.append(transform_step)
+
+    if shards_per_instance:
+        reassemble_step = ProcessingStep(
+            name='ReassembleOutputStep',
+            processor=sharding_processor,
+            inputs=[
+                ProcessingInput(
+                    source=transform_step.properties.TransformOutput.S3OutputPath,
+                    destination="/opt/ml/processing/predictions",
+                ),
+                ProcessingInput(
+                    source=shard_step.properties.ProcessingOutputConfig.Outputs[
+                        "layout"
+                    ].S3Output.S3Uri,
+                    destination="/opt/ml/processing/layout",
+                ),
+            ],
+            outputs=[
+                ProcessingOutput(
+                    output_name="predictions",
+                    source="/opt/ml/processing/output",
+                    destination=output_path,
+                ),
+            ],
+            code=os.path.join(BASE_DIR, "reassemble.py"),
+        )
+        steps.append(reassemble_step)
+
+    if incremental:
+        commit_step = ProcessingStep(
+            name='CommitWatermarkStep',
+            processor=incremental_processor,
+            inputs=[
+                ProcessingInput(
+                    source=select_step.properties.ProcessingOutputConfig.Outputs[
+                        "pending"
+                    ].S3Output.S3Uri,
+                    destination="/opt/ml/processing/pending",
+                ),
+            ],
+            outputs=[
+                ProcessingOutput(
+                    output_name="watermark",
+                    source="/opt/ml/processing/watermark",
+                    destination=watermark_uri,
+                ),
+            ],
+            code=os.path.join(BASE_DIR, "incremental.py"),
+            job_arguments=["--mode", "commit"],
+            depends_on=[steps[-1].name],
+        )
+        cond_new_input = ConditionGreaterThan(
+            left=JsonGet(
+                step=select_step,
+                property_file=selection_report,
+                json_path="new_objects"
+            ),
+            right=0,
+        )
+        steps = [
+            select_step,
+            ConditionStep(
+                name='CheckNewInput',
+                conditions=[cond_new_input],
+                if_steps=steps + [commit_step],
+                else_steps=[],
+            ),
+        ]
 
     #### PIPELINE
     pipeline = Pipeline(
         name=pipeline_name,
-        parameters=[model_name, batch_inference_instance_count, batch_inference_instance_type, input_path, output_path],
-        steps=[transform_step],
+        parameters=[model_name, batch_inference_instance_count, batch_inference_instance_type, input_path, output_path, model_package_name],
+        steps=steps,
         sagemaker_session=sagemaker_session
     )
     return pipeline
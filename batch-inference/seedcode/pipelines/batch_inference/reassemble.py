@@ -0,0 +1,65 @@
+"""Reassembles the predictions of the transformed shards into one output file per input file."""
+import json
+import logging
+import os
+import pathlib
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.StreamHandler())
+
+
+def reassemble(layout, predictions_dir, output_dir):
+    """Writes the predictions of the shards back in input order, as <source key>.out files.
+
+    The transform writes the predictions of every shard to <shard>.out, one line per record, and
+    the layout written by shard.py tells which input file every line comes from.
+
+    Args:
+        layout: the layout of the shards
+        predictions_dir: the directory holding the transform output
+        output_dir: the directory to write the reassembled predictions to
+
+    Returns:
+        the number of records reassembled per source key
+    """
+    records = {}
+    output_file = None
+    source = None
+    try:
+        for shard in layout["shards"]:
+            with open(os.path.join(predictions_dir, f"{shard['name']}.out"), "rb") as f:
+                for segment in shard["segments"]:
+                    if segment["source"] != source:
+                        if output_file is not None:
+                            output_file.close()
+                        source = segment["source"]
+                        output_path = pathlib.Path(output_dir, f"{source}.out")
+                        output_path.parent.mkdir(parents=True, exist_ok=True)
+                        output_file = open(output_path, "wb")
+                        records[source] = 0
+                    for _ in range(segment["records"]):
+                        line = f.readline()
+                        if not line:
+                            raise ValueError(f"{shard['name']} has fewer predictions than records.")
+                        if not line.endswith(b"\n"):
+                            line += b"\n"
+                        output_file.write(line)
+                    records[source] += segment["records"]
+                if f.readline().strip():
+                    raise ValueError(f"{shard['name']} has more predictions than records.")
+    finally:
+        if output_file is not None:
+            output_file.close()
+    return records
+
+
+if __name__ == "__main__":
+    logger.debug("Starting reassembly.")
+    base_dir = "/opt/ml/processing"
+    with open(f"{base_dir}/layout/layout.json") as f:
+        layout = json.load(f)
+
+    records = reassemble(layout, f"{base_dir}/predictions", f"{base_dir}/output")
+    for source, count in records.items():
+        logger.info("%s.out: %d predictions.", source, count)
@@ -0,0 +1,106 @@
+"""Splits the batch inference input into balanced line-aligned shards under a manifest."""
+import argparse
+import json
+import logging
+import os
+import pathlib
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.StreamHandler())
+
+
+def list_input_files(input_dir):
+    """Lists the input files with their keys relative to the input prefix, in key order."""
+    input_dir = pathlib.Path(input_dir)
+    return [
+        (path, path.relative_to(input_dir).as_posix())
+        for path in sorted(input_dir.rglob("*"))
+        if path.is_file()
+    ]
+
+
+def shard_files(files, shards_dir, shard_count):
+    """Writes the records of the files, in order, to up to shard_count shards of about equal size.
+
+    Every shard ends on a record boundary and blank lines are dropped, so that the transform
+    returns exactly one prediction per record. A shard may span several input files.
+
+    Args:
+        files: the (path, source key) of the input files in order
+        shards_dir: the directory to write the part-NNNNN.csv shards to
+        shard_count: the number of shards to split the input into
+
+    Returns:
+        the layout of the shards, the name of every shard with its segments, the number of
+        records of every source key in it
+    """
+    total_size = sum(os.path.getsize(path) for path, _ in files)
+    target_size = max(total_size / shard_count, 1)
+    pathlib.Path(shards_dir).mkdir(parents=True, exist_ok=True)
+    shards = []
+    shard_file = None
+    written = 0
+    try:
+        for path, source in files:
+            with open(path, "rb") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    if shard_file is None:
+                        shards.append({"name": f"part-{len(shards):05d}.csv", "segments": []})
+                        shard_file = open(os.path.join(shards_dir, shards[-1]["name"]), "wb")
+                    segments = shards[-1]["segments"]
+                    if not segments or segments[-1]["source"] != source:
+                        segments.append({"source": source, "records": 0})
+                    if not line.endswith(b"\n"):
+                        line += b"\n"
+                    shard_file.write(line)
+                    segments[-1]["records"] += 1
+                    written += len(line)
+                    if written >= target_size * len(shards) and len(shards) < shard_count:
+                        shard_file.close()
+                        shard_file = None
+    finally:
+        if shard_file is not None:
+            shard_file.close()
+    return {"shards": shards}
+
+
+def write_manifest(layout, shards_dir, shards_uri):
+    """Writes the manifest file listing the shards for the transform input."""
+    manifest = [{"prefix": f"{shards_uri.rstrip('/')}/"}]
+    manifest.extend(shard["name"] for shard in layout["shards"])
+    with open(os.path.join(shards_dir, "manifest"), "w") as f:
+        json.dump(manifest, f)
+
+
+if __name__ == "__main__":
+    logger.debug("Starting sharding.")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shards-uri", type=str, required=True)
+    parser.add_argument("--instance-count", type=int, default=1)
+    parser.add_argument("--shards-per-instance", type=int, default=1)
+    args = parser.parse_args()
+
+    base_dir = "/opt/ml/processing"
+    shards_dir = f"{base_dir}/shards"
+    shard_count = args.instance_count * args.shards_per_instance
+
+    files = list_input_files(f"{base_dir}/input")
+    logger.info("Splitting %d input files into %d shards.", len(files), shard_count)
+    layout = shard_files(files, shards_dir, shard_count)
+    if not layout["shards"]:
+        raise ValueError("No records found in the input.")
+    write_manifest(layout, shards_dir, args.shards_uri)
+
+    pathlib.Path(f"{base_dir}/layout").mkdir(parents=True, exist_ok=True)
+    with open(f"{base_dir}/layout/layout.json", "w") as f:
+        json.dump(layout, f)
+    for shard in layout["shards"]:
+        logger.info(
+            "%s: %d records from %s.",
+            shard["name"],
+            sum(segment["records"] for segment in shard["segments"]),
+            ", ".join(segment["source"] for segment in shard["segments"]),
+        )
@@ -0,0 +1,95 @@
+import io
+import json
+
+import pytest
+from botocore.exceptions import ClientError
+
+from pipelines.batch_inference import incremental
+
+INPUT_PATH = "s3://bucket/input/data"
+
+
+class FakeS3Client:
+    def __init__(self, objects):
+        self.objects = objects
+
+    def get_paginator(self, operation_name):
+        assert operation_name == "list_objects_v2"
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        keys = sorted(key for bucket, key in self.objects if bucket == Bucket)
+        keys = [key for key in keys if key.startswith(Prefix)]
+        # One object per page, as the listing may be paged anywhere
+        for key in keys:
+            yield {"Contents": [{"Key": key, "ETag": self.objects[("bucket", key)]["ETag"]}]}
+        if not keys:
+            yield {}
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        return {"Body": io.BytesIO(self.objects[(Bucket, Key)]["Body"])}
+
+
+def watermark(objects, model_package_name="model/1", input_path=INPUT_PATH):
+    return {"model_package_name": model_package_name, "input_path": input_path, "objects": objects}
+
+
+def test_only_new_and_changed_objects_are_selected():
+    objects = {"input/data/b.csv": '"2"', "input/data/a.csv": '"1"', "input/data/c.csv": '"3"'}
+    scored = {"input/data/a.csv": '"1"', "input/data/b.csv": '"old"', "input/data/d.csv": '"4"'}
+
+    keys, full = incremental.select_objects(objects, watermark(scored), "model/1", INPUT_PATH)
+
+    assert keys == ["input/data/b.csv", "input/data/c.csv"] and not full
+    keys, full = incremental.select_objects(objects, watermark(objects), "model/1", INPUT_PATH)
+    assert keys == [] and not full
+
+
+@pytest.mark.parametrize(
+    "last_watermark",
+    [None, watermark({}, model_package_name="model/0"), watermark({}, input_path="s3://other")],
+)
+def test_every_object_is_rescored_without_a_matching_watermark(last_watermark):
+    objects = {"input/data/b.csv": '"2"', "input/data/a.csv": '"1"'}
+
+    keys, full = incremental.select_objects(objects, last_watermark, "model/1", INPUT_PATH)
+
+    assert keys == ["input/data/a.csv", "input/data/b.csv"] and full
+
+
+def test_watermark_is_committed_after_the_selection(tmp_path, monkeypatch):
+    scored = {"input/data/a.csv": '"1"'}
+    s3_client = FakeS3Client(
+        {
+            ("bucket", "input/data/a.csv"): {"ETag": '"1"'},
+            ("bucket", "input/data/sub/b.csv"): {"ETag": '"2"'},
+            ("bucket", "input/data/"): {"ETag": '"dir"'},
+            ("bucket", "input/other.csv"): {"ETag": '"3"'},
+            ("bucket", "watermark/watermark.json"): {
+                "Body": json.dumps(watermark(scored)).encode("utf-8")
+            },
+        }
+    )
+    monkeypatch.setattr(incremental.boto3, "client", lambda service_name: s3_client)
+
+    incremental.select(INPUT_PATH, "s3://bucket/watermark/", "model/1", tmp_path)
+
+    manifest = json.loads((tmp_path / "manifest" / "manifest").read_text())
+    assert manifest == [{"prefix": "s3://bucket/input/"}, "data/sub/b.csv"]
+    selection = json.loads((tmp_path / "selection" / "selection.json").read_text())
+    assert selection == {"new_objects": 1, "input_objects": 2, "full": False}
+    assert not (tmp_path / "watermark").exists()
+
+    incremental.commit(tmp_path)
+
+    committed = json.loads((tmp_path / "watermark" / incremental.WATERMARK_FILE).read_text())
+    assert committed == watermark({"input/data/a.csv": '"1"', "input/data/sub/b.csv": '"2"'})
+
+
+def test_first_execution_has_no_watermark():
+    s3_client = FakeS3Client({})
+
+    assert incremental.read_watermark(s3_client, "s3://bucket/watermark") is None
+    assert incremental.list_input_objects(s3_client, INPUT_PATH) == {}
@@ -0,0 +1,73 @@
+import json
+
+import pytest
+
+from pipelines.batch_inference import reassemble, shard
+
+
+def write_inputs(input_dir):
+    inputs = {
+        "a.csv": b"1,a\n2,a\n\n3,a\n",
+        "nested/b.csv": b"4,b\n5,b",
+        "nested/c.csv": b"\n",
+        "z.csv": b"".join(b"%d,z\n" % i for i in range(6, 30)),
+    }
+    for key, content in inputs.items():
+        path = input_dir / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+    return inputs
+
+
+def transform(shards_dir, predictions_dir, layout):
+    """Stands in for the transform joining every prediction to its input row."""
+    predictions_dir.mkdir()
+    for name in [s["name"] for s in layout["shards"]]:
+        lines = (shards_dir / name).read_bytes().splitlines()
+        output = b"".join(b"%s,%d\n" % (line, 10 * int(line.split(b",")[0])) for line in lines)
+        (predictions_dir / f"{name}.out").write_bytes(output)
+
+
+@pytest.mark.parametrize("shard_count", [1, 3, 100])
+def test_predictions_are_reassembled_in_input_order(tmp_path, shard_count):
+    inputs = write_inputs(tmp_path / "input")
+    files = shard.list_input_files(tmp_path / "input")
+    layout = shard.shard_files(files, tmp_path / "shards", shard_count)
+    shard.write_manifest(layout, tmp_path / "shards", "s3://bucket/shards")
+    transform(tmp_path / "shards", tmp_path / "predictions", layout)
+
+    records = reassemble.reassemble(layout, tmp_path / "predictions", tmp_path / "output")
+
+    assert [key for _, key in files] == ["a.csv", "nested/b.csv", "nested/c.csv", "z.csv"]
+    assert 1 <= len(layout["shards"]) <= shard_count
+    manifest = json.loads((tmp_path / "shards" / "manifest").read_text())
+    assert manifest == [{"prefix": "s3://bucket/shards/"}] + [s["name"] for s in layout["shards"]]
+    assert records == {"a.csv": 3, "nested/b.csv": 2, "z.csv": 24}
+    for key, count in records.items():
+        rows = [line for line in inputs[key].splitlines() if line.strip()]
+        expected = b"".join(b"%s,%d\n" % (row, 10 * int(row.split(b",")[0])) for row in rows)
+        assert (tmp_path / "output" / f"{key}.out").read_bytes() == expected
+    assert not (tmp_path / "output" / "nested" / "c.csv.out").exists()
+
+
+def test_shards_are_balanced(tmp_path):
+    write_inputs(tmp_path / "input")
+
+    layout = shard.shard_files(shard.list_input_files(tmp_path / "input"), tmp_path / "shards", 3)
+
+    counts = [sum(s["records"] for s in shard_["segments"]) for shard_ in layout["shards"]]
+    sizes = [(tmp_path / "shards" / s["name"]).stat().st_size for s in layout["shards"]]
+    assert len(counts) == 3 and sum(counts) == 29
+    # Every shard ends on the first record boundary past its share of the bytes
+    assert all(abs(size - sum(sizes) / 3) < 2 * len(b"10,z\n") for size in sizes)
+
+
+def test_missing_predictions_are_detected(tmp_path):
+    write_inputs(tmp_path / "input")
+    layout = shard.shard_files(shard.list_input_files(tmp_path / "input"), tmp_path / "shards", 2)
+    transform(tmp_path / "shards", tmp_path / "predictions", layout)
+    out = tmp_path / "predictions" / f"{layout['shards'][-1]['name']}.out"
+    out.write_bytes(b"".join(out.read_bytes().splitlines(keepends=True)[:-1]))
+
+    with pytest.raises(ValueError, match="fewer predictions"):
+        reassemble.reassemble(layout, tmp_path / "predictions", tmp_path / "output")
@@ -16,47 +16,134 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 """Evaluation script for measuring mean squared error."""
+import argparse
+import hashlib
 import json
 import logging
 import pathlib
 import pickle
+import shutil
 import tarfile
+import tempfile
 
 import numpy as np
 import pandas as pd
 import xgboost
 
-from sklearn.metrics import mean_squared_error
-
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 logger.addHandler(logging.StreamHandler())
 
 
+class RunningRegressionMetrics:
+    """Accumulates regression metrics over batches of predictions.
+
+    The residual mean and sum of squared deviations are merged batch by batch with Chan's parallel form of Welford's
+    algorithm, so the results match a single pass over all the predictions without holding them in memory.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.residual_mean = 0.0
+        self.residual_m2 = 0.0
+        self.squared_error_mean = 0.0
+
+    def update(self, y, predictions):
+        """Adds a batch of labels and their predictions."""
+        residuals = np.asarray(y, dtype=np.float64) - predictions
+        n = len(residuals)
+        if n == 0:
+            return
+        total = self.count + n
+        batch_mean = residuals.mean()
+        delta = batch_mean - self.residual_mean
+        self.residual_mean += delta * n / total
+        self.residual_m2 += np.square(residuals - batch_mean).sum() + delta**2 * self.count * n / total
+        self.squared_error_mean += (np.square(residuals).mean() - self.squared_error_mean) * n / total
+        self.count = total
+
+    @property
+    def mse(self):
+        return self.squared_error_mean
+
+    @property
+    def residual_std(self):
+        if self.count == 0:
+            return None
+        return np.sqrt(self.residual_m2 / self.count)
+
+
+def extract_model(model_path, cache_dir="model-cache"):
+    """Extracts a model.tar.gz once, into a cache directory named after the digest of its content.
+
+    Returns:
+        the directory holding the extracted model artifacts
+    """
+    digest = hashlib.sha256()
+    with open(model_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    model_dir = pathlib.Path(cache_dir) / digest.hexdigest()
+    if model_dir.exists():
+        logger.info("Using the model artifacts already extracted to %s.", model_dir)
+        return model_dir
+    pathlib.Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    staging_dir = tempfile.mkdtemp(dir=cache_dir)
+    with tarfile.open(model_path) as tar:
+        tar.extractall(path=staging_dir)
+    try:
+        pathlib.Path(staging_dir).rename(model_dir)
+    except OSError:
+        # extracted concurrently by another process
+        shutil.rmtree(staging_dir)
+    return model_dir
+
+
+def load_xgboost_model(model_file):
+    """Loads an xgboost model saved in the native binary, JSON or UBJSON format, falling back to unpickling the
+    artifacts of older xgboost containers."""
+    with open(model_file, "rb") as f:
+        # pickles of protocol 2 and above start with the PROTO opcode
+        if f.read(1) == pickle.PROTO:
+            logger.info("%s is not in a native xgboost format, unpickling it.", model_file)
+            f.seek(0)
+            return pickle.load(f)
+    booster = xgboost.Booster()
+    booster.load_model(bytearray(pathlib.Path(model_file).read_bytes()))
+    return booster
+
+
 if __name__ == "__main__":
     logger.debug("Starting evaluation.")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=100000)
+    args = parser.parse_args()
+
     model_path = "/opt/ml/processing/model/model.tar.gz"
-    with tarfile.open(model_path) as tar:
-        tar.extractall(path=".")
+    model_dir = extract_model(model_path)
 
     logger.debug("Loading xgboost model.")
-    model = pickle.load(open("xgboost-model", "rb"))
-
-    logger.debug("Reading test data.")
-    test_path = "/opt/ml/processing/test/test.csv"
-    df = pd.read_csv(test_path, header=None)
+    model = load_xgboost_model(model_dir / "xgboost-model")
 
     logger.debug("Reading test data.")
-    y_test = df.iloc[:, 0].to_numpy()
-    df.drop(df.columns[0], axis=1, inplace=True)
-    X_test = xgboost.DMatrix(df.values)
+    # the test split is written as test.csv, or as several test-part-*.csv files for distributed training, skipping
+    # the empty parts that pandas cannot read
+    test_paths = sorted(
+        path for path in pathlib.Path("/opt/ml/processing/test").glob("test*.csv") if path.stat().st_size > 0
+    )
 
-    logger.info("Performing predictions against test data.")
-    predictions = model.predict(X_test)
+    logger.info("Performing predictions against test data in batches of %d rows.", args.batch_size)
+    metrics = RunningRegressionMetrics()
+    for test_path in test_paths:
+        for df in pd.read_csv(test_path, header=None, chunksize=args.batch_size):
+            X_test = xgboost.DMatrix(df.iloc[:, 1:].values)
+            metrics.update(df.iloc[:, 0].to_numpy(), model.predict(X_test))
+    if metrics.count == 0:
+        raise ValueError("No test rows to evaluate the model on.")
 
     logger.debug("Calculating mean squared error.")
-    mse = mean_squared_error(y_test, predictions)
-    std = np.std(y_test - predictions)
+    mse = metrics.mse
+    std = metrics.residual_std
     report_dict = {
         "regression_metrics": {
             "mse": {"value": mse, "standard_deviation": std},
@@ -0,0 +1,208 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Drives concurrent load against an endpoint and checks the results against SLOs.
+
+Every line of the sample payload file is the body of one request, sent in turn by a pool of
+threads sharing a sagemaker-runtime client, for a fixed duration and optionally paced to a
+target rate. The client pools one connection per thread and does not retry, so that the
+recorded latency and errors are the ones of the endpoint. Passing an endpoint url sends the
+requests to a local HTTP stand-in of the endpoint instead.
+"""
+
+import itertools
+import logging
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+
+LATENCY_PERCENTILES = [50, 90, 99]
+
+
+def read_payloads(payload_file):
+    """Reads the request bodies, one per non-empty line of the payload file."""
+    with open(payload_file, "rb") as f:
+        payloads = [line.rstrip(b"\r\n") for line in f if line.strip()]
+    if not payloads:
+        raise Exception(f"No payload found in {payload_file}")
+    return payloads
+
+
+def get_invoker(endpoint_name, content_type, concurrency, target_model=None, endpoint_url=None, region_name=None):
+    """Gets the function invoking the endpoint with a payload, raising on error."""
+    config = Config(
+        max_pool_connections=concurrency,
+        retries={"total_max_attempts": 1, "mode": "standard"},
+        connect_timeout=5,
+        read_timeout=60,
+    )
+    client = boto3.client("sagemaker-runtime", config=config, endpoint_url=endpoint_url, region_name=region_name)
+    kwargs = {"EndpointName": endpoint_name, "ContentType": content_type}
+    if target_model:
+        kwargs["TargetModel"] = target_model
+
+    def invoke(payload):
+        client.invoke_endpoint(Body=payload, **kwargs)["Body"].read()
+
+    return invoke
+
+
+class RateLimiter:
+    """Paces the requests of all the threads to a target rate, unlimited when None."""
+
+    def __init__(self, rps=None):
+        self.interval = 1 / rps if rps else 0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_time, now)
+            self.next_time = slot + self.interval
+        time.sleep(max(0, slot - now))
+
+
+def percentile(sorted_values, p):
+    """Gets the nearest-rank percentile of sorted values, None when there are none."""
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def run_load_test(invoke, payloads, concurrency=4, duration=30, rps=None):
+    """Invokes the endpoint from concurrent threads for a duration.
+
+    Args:
+        invoke: The function invoking the endpoint with a payload, raising on error.
+        payloads: The request bodies, sent in turn.
+        concurrency: The number of threads sending requests.
+        duration: The number of seconds to send requests for.
+        rps: The target number of requests per second, or None to send them back to back.
+
+    Returns:
+        The number of requests, errors by error code, error rate, throughput of successful
+        requests per second and latency percentiles in milliseconds.
+    """
+    limiter = RateLimiter(rps)
+    counter = itertools.count()
+    deadline = time.monotonic() + duration
+
+    def send_requests():
+        latencies, errors = [], {}
+        while True:
+            limiter.wait()
+            if time.monotonic() >= deadline:
+                return latencies, errors
+            payload = payloads[next(counter) % len(payloads)]
+            start = time.perf_counter()
+            try:
+                invoke(payload)
+            except ClientError as e:
+                code = e.response["Error"]["Code"]
+                errors[code] = errors.get(code, 0) + 1
+                continue
+            except Exception as e:  # pylint: disable=W0703
+                errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+                continue
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    logger.info(f"Sending requests from {concurrency} threads for {duration}s")
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda _: send_requests(), range(concurrency)))
+    elapsed = time.monotonic() - started
+
+    latencies = sorted(latency for thread_latencies, _ in results for latency in thread_latencies)
+    errors = {}
+    for _, thread_errors in results:
+        for code, count in thread_errors.items():
+            errors[code] = errors.get(code, 0) + count
+    requests = len(latencies) + sum(errors.values())
+    latency_ms = {f"p{p}": percentile(latencies, p) for p in LATENCY_PERCENTILES}
+    latency_ms["max"] = latencies[-1] if latencies else None
+    return {
+        "requests": requests,
+        "errors": errors,
+        "error_rate": sum(errors.values()) / requests if requests else None,
+        "duration_seconds": elapsed,
+        "throughput_rps": len(latencies) / elapsed,
+        "latency_ms": latency_ms,
+    }
+
+
+def check(value, threshold, passed):
+    return {"value": value, "threshold": threshold, "passed": bool(passed)}
+
+
+def check_slos(stats, max_p99_latency_ms=None, max_error_rate=None, min_throughput=None):
+    """Checks the load test results against the SLOs, skipping the unset ones."""
+    checks = {"requests": check(stats["requests"], 1, stats["requests"] >= 1)}
+    p99 = stats["latency_ms"]["p99"]
+    if max_p99_latency_ms is not None:
+        checks["max_p99_latency_ms"] = check(p99, max_p99_latency_ms, p99 is not None and p99 <= max_p99_latency_ms)
+    if max_error_rate is not None:
+        error_rate = stats["error_rate"]
+        checks["max_error_rate"] = check(
+            error_rate, max_error_rate, error_rate is not None and error_rate <= max_error_rate
+        )
+    if min_throughput is not None:
+        checks["min_throughput_rps"] = check(
+            stats["throughput_rps"], min_throughput, stats["throughput_rps"] >= min_throughput
+        )
+    return checks
+
+
+def add_arguments(parser, payload_file=None):
+    """Adds the load test options and SLOs to an argument parser."""
+    parser.add_argument("--payload-file", type=str, default=payload_file)
+    parser.add_argument("--content-type", type=str, default="text/csv")
+    parser.add_argument("--target-model", type=str, default=None)
+    parser.add_argument("--endpoint-url", type=str, default=None)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--rps", type=float, default=None)
+    parser.add_argument("--max-p99-latency-ms", type=float, default=None)
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    parser.add_argument("--min-throughput", type=float, default=None)
+
+
+def load_test(endpoint_name, args):
+    """Runs the load test of the endpoint with the parsed options.
+
+    Returns:
+        The load test results and SLO checks.
+    """
+    invoke = get_invoker(
+        endpoint_name,
+        args.content_type,
+        args.concurrency,
+        target_model=args.target_model,
+        endpoint_url=args.endpoint_url,
+    )
+    stats = run_load_test(invoke, read_payloads(args.payload_file), args.concurrency, args.duration, args.rps)
+    checks = check_slos(stats, args.max_p99_latency_ms, args.max_error_rate, args.min_throughput)
+    return {**stats, "slos": checks, "success": all(c["passed"] for c in checks.values())}
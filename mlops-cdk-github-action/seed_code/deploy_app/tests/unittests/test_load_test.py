@@ -0,0 +1,113 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import threading
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from integration_tests.load_test import add_arguments, check_slos, load_test, percentile, read_payloads
+
+ENDPOINT_NAME = "deploy-app-staging"
+
+
+class EndpointHandler(BaseHTTPRequestHandler):
+    """Answers the invocations of the endpoint like SageMaker, failing the payloads starting with "fail"."""
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.path != f"/endpoints/{ENDPOINT_NAME}/invocations" or body.startswith(b"fail"):
+            self.send_response(400)
+            self.send_header("x-amzn-ErrorType", "ValidationError")
+            response = b'{"message": "Invalid payload"}'
+        else:
+            self.send_response(200)
+            response = b"0.5"
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def endpoint_url(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    server = ThreadingHTTPServer(("127.0.0.1", 0), EndpointHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+def parse_args(payload_file, endpoint_url, *args):
+    parser = ArgumentParser()
+    add_arguments(parser)
+    return parser.parse_args(
+        ["--payload-file", str(payload_file), "--endpoint-url", endpoint_url, "--duration", "1", *args]
+    )
+
+
+def test_percentile():
+    assert percentile([], 50) is None
+    assert percentile([1, 2, 3, 4], 50) == 2
+    assert percentile([1, 2, 3, 4], 99) == 4
+
+
+def test_read_payloads(tmp_path):
+    payload_file = tmp_path / "payload.csv"
+    payload_file.write_bytes(b"1,2\r\n\n3,4\n")
+    assert read_payloads(payload_file) == [b"1,2", b"3,4"]
+
+
+def test_load_test(tmp_path, endpoint_url):
+    payload_file = tmp_path / "payload.csv"
+    payload_file.write_text("1,2\n3,4\n")
+    results = load_test(ENDPOINT_NAME, parse_args(payload_file, endpoint_url, "--concurrency", "2"))
+    assert results["success"]
+    assert results["requests"] > 0
+    assert results["errors"] == {}
+    assert results["latency_ms"]["p50"] <= results["latency_ms"]["p99"] <= results["latency_ms"]["max"]
+
+
+def test_load_test_rate(tmp_path, endpoint_url):
+    payload_file = tmp_path / "payload.csv"
+    payload_file.write_text("1,2\n")
+    results = load_test(ENDPOINT_NAME, parse_args(payload_file, endpoint_url, "--rps", "10"))
+    assert results["requests"] <= 11
+
+
+def test_load_test_errors(tmp_path, endpoint_url):
+    payload_file = tmp_path / "payload.csv"
+    payload_file.write_text("1,2\nfail\n")
+    results = load_test(ENDPOINT_NAME, parse_args(payload_file, endpoint_url, "--concurrency", "1"))
+    assert not results["success"]
+    assert results["errors"]["ValidationError"] > 0
+    assert not results["slos"]["max_error_rate"]["passed"]
+
+
+def test_check_slos():
+    stats = {"requests": 100, "error_rate": 0.0, "throughput_rps": 50.0, "latency_ms": {"p99": 120.0}}
+    checks = check_slos(stats, max_p99_latency_ms=100, max_error_rate=0.01, min_throughput=10)
+    assert not checks["max_p99_latency_ms"]["passed"]
+    assert checks["max_error_rate"]["passed"]
+    assert checks["min_throughput_rps"]["passed"]
@@ -0,0 +1,118 @@
+"""Local steps of the abalone pipeline, running the pipeline scripts on synthetic data.
+
+The steps read and write a directory standing in for S3, so the preprocess, train,
+evaluate and condition chain runs without AWS or Docker.
+"""
+import json
+import logging
+import pathlib
+import tarfile
+
+import numpy as np
+import pandas as pd
+import xgboost
+
+from pipelines.abalone import evaluate, preprocess
+
+logger = logging.getLogger(__name__)
+
+
+def generate_data(path, rows=10000, seed=0):
+    """Writes a synthetic abalone dataset, with a few missing values, as headerless CSV."""
+    rng = np.random.default_rng(seed)
+    length = rng.uniform(0.1, 0.8, rows)
+    df = pd.DataFrame(
+        {
+            "sex": rng.choice(["M", "F", "I"], rows),
+            "length": length,
+            "diameter": length * rng.uniform(0.7, 0.9, rows),
+            "height": length * rng.uniform(0.2, 0.4, rows),
+            "whole_weight": length**3 * rng.uniform(3, 5, rows),
+            "shucked_weight": length**3 * rng.uniform(1, 2, rows),
+            "viscera_weight": length**3 * rng.uniform(0.5, 1, rows),
+            "shell_weight": length**3 * rng.uniform(1, 1.5, rows),
+        }
+    )
+    df[preprocess.label_column] = np.round(3 + 20 * length + rng.normal(0, 1.5, rows))
+    df.loc[rng.random(rows) < 0.01, "length"] = np.nan
+    df.loc[rng.random(rows) < 0.01, "sex"] = np.nan
+    pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+    df.to_csv(path, header=False, index=False)
+    return rows
+
+
+def preprocess_data(
+    input_path, base_dir, preprocessing_mode="in-memory", output_format="csv", chunk_size=100000
+):
+    """Runs preprocess.py in the in-memory or streaming mode over a local file."""
+    if preprocessing_mode == "streaming":
+        preprocess.preprocess_streaming(
+            lambda: open(input_path, "rb"),
+            base_dir,
+            chunk_size,
+            output_format=output_format,
+            source=pathlib.Path(input_path).name,
+        )
+    else:
+        preprocess.preprocess_dataframe(
+            preprocess.read_csv(input_path),
+            base_dir,
+            output_format,
+            source=pathlib.Path(input_path).name,
+        )
+
+
+def train_model(train_dir, validation_dir, model_path, hyperparameters):
+    """Trains the model as the SageMaker XGBoost container does, saved as its model.tar.gz.
+
+    Returns:
+        the validation rmse of the last round
+    """
+    params = dict(hyperparameters)
+    num_round = params.pop("num_round")
+    dtrain = xgboost.DMatrix(*reversed(evaluate.read_test_data(train_dir)))
+    dvalidation = xgboost.DMatrix(*reversed(evaluate.read_test_data(validation_dir)))
+    history = {}
+    booster = xgboost.train(
+        params,
+        dtrain,
+        num_round,
+        evals=[(dtrain, "train"), (dvalidation, "validation")],
+        evals_result=history,
+        verbose_eval=False,
+    )
+    model_dir = pathlib.Path(model_path).parent
+    model_dir.mkdir(parents=True, exist_ok=True)
+    booster.save_model(str(model_dir / "xgboost-model"))
+    with tarfile.open(model_path, "w:gz") as tar:
+        tar.add(model_dir / "xgboost-model", arcname="xgboost-model")
+    return history["validation"]["rmse"][-1]
+
+
+def evaluate_model(model_path, test_dir, output_dir, cache_dir, segment_columns=("sex",)):
+    """Runs evaluate.py over the local model and test split.
+
+    Returns:
+        the mse of the model
+    """
+    models = {"challenger": evaluate.load_model(model_path, cache_dir)}
+    segments = evaluate.read_segments(test_dir, list(segment_columns))
+    evaluations = evaluate.evaluate_models(models, evaluate.iter_test_batches(test_dir), segments)
+    pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
+    with open(f"{output_dir}/evaluation.json", "w") as f:
+        f.write(json.dumps(evaluations["challenger"].report()))
+    return evaluations["challenger"].metrics.mse
+
+
+def check_mse(evaluation_path, mse_threshold):
+    """Evaluates the condition step, whether the model would be registered."""
+    with open(evaluation_path) as f:
+        mse = json.load(f)["regression_metrics"]["mse"]["value"]
+    registered = mse <= mse_threshold
+    logger.info(
+        "The mse %f is %s the threshold %f.",
+        mse,
+        "within" if registered else "above",
+        mse_threshold,
+    )
+    return registered
@@ -0,0 +1,142 @@
+import io
+import json
+import pickle
+import tarfile
+
+import numpy as np
+import pytest
+import xgboost
+
+from pipelines.abalone import evaluate, preprocess
+from test_preprocess import make_abalone_csv
+
+
+@pytest.mark.parametrize("output_format", ["csv", "parquet", "recordio-protobuf"])
+def test_batched_evaluation_matches_the_full_test_set(tmp_path, output_format):
+    rng = np.random.default_rng(0)
+    y, X = rng.integers(1, 30, 1000).astype(float), rng.normal(size=(1000, 10))
+    writer = preprocess.SplitWriter(tmp_path, output_format)
+    writer.write("test", y, X)
+    writer.close()
+    model = xgboost.train({"max_depth": 3}, xgboost.DMatrix(X, label=y), num_boost_round=5)
+
+    metrics = evaluate.evaluate(model, evaluate.iter_test_batches(tmp_path / "test", 64)).metrics
+
+    y_test, X_test = evaluate.read_test_data(tmp_path / "test")
+    residuals = y_test.astype(np.float64) - model.predict(xgboost.DMatrix(X_test))
+    assert metrics.count == 1000
+    np.testing.assert_allclose(metrics.mse, np.mean(residuals**2), rtol=1e-10)
+    np.testing.assert_allclose(metrics.residual_std, np.std(residuals), rtol=1e-10)
+
+
+def test_report_breaks_the_metrics_down_by_segment(tmp_path):
+    csv = make_abalone_csv()
+    preprocess.preprocess_streaming(lambda: io.StringIO(csv), str(tmp_path), chunk_size=500)
+    y, X = evaluate.read_test_data(tmp_path / "test")
+    model = xgboost.train({"max_depth": 3}, xgboost.DMatrix(X, label=y), num_boost_round=5)
+
+    segments = evaluate.read_segments(tmp_path / "test", ["sex"])
+    batches = evaluate.iter_test_batches(tmp_path / "test", 100)
+    report = json.loads(json.dumps(evaluate.evaluate(model, batches, segments).report()))
+
+    predictions = model.predict(xgboost.DMatrix(X))
+    residuals = y - predictions
+    metrics = report["regression_metrics"]
+    np.testing.assert_allclose(metrics["mse"]["value"], np.mean(residuals**2))
+    np.testing.assert_allclose(metrics["mae"]["value"], np.mean(np.abs(residuals)))
+    np.testing.assert_allclose(
+        metrics["r2"]["value"], 1 - np.sum(residuals**2) / np.sum((y - y.mean()) ** 2)
+    )
+    np.testing.assert_allclose(report["residual_quantiles"]["p50"], np.median(residuals))
+    assert report["latency"]["rows"] == len(y)
+    assert set(report["segments"]["sex"]) == {"F", "I", "M", "missing"}
+    assert sum(s["count"] for s in report["segments"]["sex"].values()) == len(y)
+    male = X[:, segments["sex"][0][segments["sex"][1].index("M")]] == 1
+    np.testing.assert_allclose(
+        report["segments"]["sex"]["M"]["regression_metrics"]["mse"]["value"],
+        np.mean(residuals[male] ** 2),
+    )
+
+
+def test_champion_and_challenger_are_scored_over_one_read(tmp_path):
+    rng = np.random.default_rng(0)
+    y, X = rng.integers(1, 30, 1000).astype(float), rng.normal(size=(1000, 10))
+    dtrain = xgboost.DMatrix(X, label=y)
+    models = {
+        "challenger": xgboost.train({"max_depth": 3}, dtrain, num_boost_round=10),
+        "champion": xgboost.train({"max_depth": 1}, dtrain, num_boost_round=2),
+    }
+    reads = []
+
+    def batches():
+        for start in range(0, 1000, 300):
+            reads.append(start)
+            yield y[start : start + 300], X[start : start + 300]
+
+    evaluations = evaluate.evaluate_models(models, batches())
+    comparison = evaluate.compare_models(evaluations, "arn:champion")
+
+    assert reads == [0, 300, 600, 900]
+    for name, model in models.items():
+        residuals = y - model.predict(xgboost.DMatrix(X))
+        np.testing.assert_allclose(evaluations[name].metrics.mse, np.mean(residuals**2))
+    challenger, champion = (evaluations[name].metrics.mse for name in ("challenger", "champion"))
+    np.testing.assert_allclose(comparison["mse_ratio"], challenger / champion)
+    np.testing.assert_allclose(comparison["deltas"]["mse"], challenger - champion)
+    assert comparison["challenger_wins"]
+
+
+def test_champion_report_is_json_serializable():
+    y, X = np.arange(1.0, 4.0), np.zeros((3, 1))
+    evaluations = {"challenger": evaluate.Evaluation(), "champion": evaluate.Evaluation()}
+    evaluations["challenger"].update(y, X, y + 1, 0.0)
+    evaluations["champion"].update(y, X, y, 0.0)
+    report = evaluations["challenger"].report()
+
+    report["champion_challenger"] = evaluate.compare_models(evaluations, "arn:champion")
+
+    comparison = json.loads(json.dumps(report, allow_nan=False))["champion_challenger"]
+    assert comparison["challenger_wins"] is False
+    assert comparison["mse_ratio"] > 1.0
+    assert comparison["deltas"]["mse"] == 1.0
+
+
+def test_first_model_passes_without_a_champion():
+    evaluations = {"challenger": evaluate.Evaluation()}
+    evaluations["challenger"].update(np.ones(3), np.zeros((3, 1)), np.zeros(3), 0.0)
+
+    comparison = evaluate.compare_models(evaluations)
+
+    assert comparison["mse_ratio"] == 0.0 and comparison["champion_model_package_arn"] is None
+
+
+def test_empty_test_set_is_reported_clearly(tmp_path):
+    writer = preprocess.SplitWriter(tmp_path, "csv")
+    writer.close()
+    evaluation = evaluate.evaluate(None, evaluate.iter_test_batches(tmp_path / "test", 64))
+
+    assert evaluation.metrics.count == 0 and evaluation.metrics.residual_std is None
+    with pytest.raises(ValueError, match="No test rows"):
+        evaluation.report()
+
+
+@pytest.mark.parametrize("save", ["native", "pickle"])
+def test_model_loader_extracts_once_and_loads_either_format(tmp_path, save):
+    rng = np.random.default_rng(0)
+    y, X = rng.normal(size=100), rng.normal(size=(100, 4))
+    booster = xgboost.train({"max_depth": 2}, xgboost.DMatrix(X, label=y), num_boost_round=3)
+    model_file = tmp_path / "xgboost-model.ubj"
+    if save == "native":
+        booster.save_model(model_file)
+    else:
+        model_file.write_bytes(pickle.dumps(booster))
+    with tarfile.open(tmp_path / "model.tar.gz", "w:gz") as tar:
+        tar.add(model_file, arcname="xgboost-model")
+
+    cache_dir = tmp_path / "cache"
+    model = evaluate.load_model(tmp_path / "model.tar.gz", cache_dir)
+    assert evaluate.extract_model(tmp_path / "model.tar.gz", cache_dir).parent == cache_dir
+    assert len(list(cache_dir.iterdir())) == 1
+
+    dmatrix = xgboost.DMatrix(X)
+    np.testing.assert_allclose(model.predict(dmatrix), booster.predict(dmatrix))
@@ -1,3 +1,5 @@
+import json
+
 import pytest
 
 
@@ -8,3 +10,156 @@ def test_that_you_wrote_tests():
 
 def test_pipelines_importable():
     import pipelines  # noqa: F401
+
+
+def test_definition_hash_ignores_key_and_tag_order():
+    from pipelines import _utils
+
+    tags = [{"Key": "a", "Value": "1"}, {"Key": "b", "Value": "2"}]
+    definition_hash = _utils.get_definition_hash('{"x": 1, "y": [1, 2]}', tags, "role")
+    assert definition_hash == _utils.get_definition_hash(
+        '{"y": [1, 2],  "x": 1}',
+        tags[::-1] + [{"Key": _utils.DEFINITION_HASH_TAG_KEY, "Value": definition_hash}],
+        "role",
+    )
+    assert definition_hash != _utils.get_definition_hash('{"x": 1, "y": [2, 1]}', tags, "role")
+    assert definition_hash != _utils.get_definition_hash('{"x": 1, "y": [1, 2]}', tags[:1], "role")
+
+
+def test_pipeline_definition_is_generated_once(tmp_path, monkeypatch):
+    from pipelines import _utils
+
+    class FakePipeline:
+        name = "abalone"
+        calls = 0
+
+        def definition(self):
+            FakePipeline.calls += 1
+            return '{"Version": "2020-12-01"}'
+
+    monkeypatch.setattr(_utils, "get_pipeline_driver", lambda *args: FakePipeline())
+    monkeypatch.setattr(_utils, "get_pipeline_cache_inputs", lambda *args: {"input_etag": "a"})
+    module_name, kwargs = "pipelines.abalone.pipeline", '{"region": "us-east-1"}'
+    for _ in range(2):
+        name, definition = _utils.get_pipeline_definition(module_name, kwargs, tmp_path)
+        assert (name, definition) == ("abalone", '{"Version": "2020-12-01"}')
+    assert FakePipeline.calls == 1
+    _utils.get_pipeline_definition(module_name, '{"region": "eu-west-1"}', tmp_path)
+    assert FakePipeline.calls == 2
+
+
+def test_pipeline_definition_is_generated_again_when_an_input_changes(tmp_path, monkeypatch):
+    from pipelines import _utils
+
+    inputs = {"input_etag": "a", "source_hash": "s"}
+    definitions = []
+
+    class FakePipeline:
+        name = "abalone"
+
+        def definition(self):
+            definitions.append(dict(inputs))
+            return json.dumps({"Env": inputs["input_etag"]})
+
+    monkeypatch.setattr(_utils, "get_pipeline_driver", lambda *args: FakePipeline())
+    monkeypatch.setattr(
+        _utils, "get_pipeline_cache_inputs", lambda *args: {"input_etag": inputs["input_etag"]}
+    )
+    monkeypatch.setattr(_utils, "get_source_hash", lambda module_name: inputs["source_hash"])
+    monkeypatch.setenv("CODEBUILD_BUILD_ID", "build:1")
+
+    def get_definition():
+        _, definition = _utils.get_pipeline_definition("pipelines.abalone.pipeline", None, tmp_path)
+        return json.loads(definition)["Env"]
+
+    assert get_definition() == "a" and get_definition() == "a"
+    inputs["input_etag"] = "b"
+    assert get_definition() == "b"
+    inputs["source_hash"] = "t"
+    get_definition()
+    monkeypatch.setenv("CODEBUILD_BUILD_ID", "build:2")
+    get_definition()
+    assert len(definitions) == 4
+
+
+def test_execution_monitor_fails_fast_and_summarizes_steps(tmp_path, monkeypatch):
+    import datetime
+    from pipelines import _utils
+
+    t0 = datetime.datetime(2022, 1, 1)
+    minutes = [t0 + datetime.timedelta(minutes=i) for i in range(10)]
+    processing = {"ProcessingJob": {"Arn": "arn:aws:sagemaker:::processing-job/preprocess"}}
+    polls = [
+        [{"StepName": "Preprocess", "StepStatus": "Executing", "Metadata": processing}],
+        [
+            {
+                "StepName": "Preprocess",
+                "StepStatus": "Succeeded",
+                "Metadata": processing,
+                "StartTime": minutes[0],
+                "EndTime": minutes[5],
+            },
+            {
+                "StepName": "Train",
+                "StepStatus": "Failed",
+                "FailureReason": "ClientError",
+                "StartTime": minutes[5],
+                "EndTime": minutes[6],
+            },
+        ],
+    ]
+
+    class FakeSageMaker:
+        def describe_pipeline_execution(self, PipelineExecutionArn):
+            return {"PipelineExecutionStatus": "Executing"}
+
+        def get_paginator(self, name):
+            return self
+
+        def paginate(self, PipelineExecutionArn, SortOrder):
+            return [{"PipelineExecutionSteps": polls.pop(0)}]
+
+        def describe_processing_job(self, ProcessingJobName):
+            return {"ProcessingStartTime": minutes[2]}
+
+    class FakeLogs:
+        class exceptions:
+            ResourceNotFoundException = KeyError
+
+        def describe_log_streams(self, logGroupName, logStreamNamePrefix):
+            return {"logStreams": [{"logStreamName": "preprocess/algo-1"}]}
+
+        def get_log_events(self, logGroupName, logStreamName, startFromHead, nextToken=None):
+            events = [{"message": "hello"}] if nextToken is None else []
+            return {"events": events, "nextForwardToken": "f"}
+
+    monkeypatch.setattr(_utils.time, "sleep", lambda seconds: None)
+    summary_file = tmp_path / "summary.json"
+    status, steps = _utils.wait_for_execution(
+        FakeSageMaker(), FakeLogs(), "arn", summary_file=summary_file
+    )
+    assert status == "Failed" and not polls
+    summary = json.loads(summary_file.read_text())
+    assert summary["Steps"][0]["JobName"] == "preprocess"
+    assert summary["Steps"][0]["QueuedSeconds"] == 120
+    assert summary["Steps"][0]["RunningSeconds"] == 180
+    assert summary["Steps"][1]["RunningSeconds"] == 60
+
+
+@pytest.mark.parametrize("preprocessing_mode", ["in-memory", "streaming"])
+def test_local_pipeline_runs_on_synthetic_data(tmp_path, preprocessing_mode):
+    from pipelines.abalone import pipeline
+
+    steps = pipeline.get_local_pipeline(
+        work_dir=str(tmp_path), rows=2000, preprocessing_mode=preprocessing_mode, region="us-east-1"
+    )
+    results = {name: function(**kwargs) for name, function, kwargs in steps}
+    assert list(results) == [
+        "GenerateSyntheticData",
+        "PreprocessAbaloneData",
+        "TrainAbaloneModel",
+        "EvaluateAbaloneModel",
+        "CheckMSEAbaloneEvaluation",
+    ]
+    assert results["EvaluateAbaloneModel"] < pipeline.MSE_THRESHOLD
+    assert results["CheckMSEAbaloneEvaluation"]
@@ -0,0 +1,218 @@
+import io
+
+import joblib
+import numpy as np
+import pandas as pd
+import pytest
+
+from pipelines.abalone import evaluate, preprocess
+
+
+def make_abalone_csv(rows=2000, seed=7):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({c: rng.normal(size=rows) for c in preprocess.numeric_features})
+    df.insert(0, "sex", rng.choice(["M", "F", "I"], rows))
+    df[preprocess.label_column] = rng.integers(1, 30, rows).astype(float)
+    df.loc[rng.random(rows) < 0.05, "length"] = np.nan
+    df.loc[rng.random(rows) < 0.05, "sex"] = np.nan
+    return df.to_csv(header=False, index=False)
+
+
+class FakeS3Client:
+    def __init__(self, data):
+        self.data = data
+        self.ranges = []
+
+    def head_object(self, Bucket, Key):
+        return {"ContentLength": len(self.data), "ETag": '"etag"'}
+
+    def get_object(self, Bucket, Key, Range, IfMatch):
+        start, end = map(int, Range[len("bytes=") :].split("-"))
+        self.ranges.append((start, end))
+        return {"Body": io.BytesIO(self.data[start : end + 1])}
+
+
+def test_streaming_transformer_matches_in_memory_preprocessor():
+    csv = make_abalone_csv()
+    df = preprocess.read_csv(io.StringIO(csv)).drop(columns=preprocess.label_column)
+    expected = preprocess.get_preprocessor().fit_transform(df)
+
+    statistics = preprocess.RunningStatistics()
+    for chunk in preprocess.read_csv(io.StringIO(csv), chunksize=300):
+        statistics.update(chunk)
+    actual = statistics.transformer().transform(df)
+
+    np.testing.assert_allclose(actual, expected, atol=1e-9)
+
+
+def test_ranged_reader_reassembles_the_object_in_order():
+    csv = make_abalone_csv().encode()
+    client = FakeS3Client(csv)
+
+    with preprocess.RangedS3Reader("bucket", "key", part_size=1000, client=client) as f:
+        df = preprocess.read_csv(f)
+
+    assert len(client.ranges) == -(-len(csv) // 1000)
+    pd.testing.assert_frame_equal(df, preprocess.read_csv(io.BytesIO(csv)))
+
+
+def test_arrow_chunks_match_the_pandas_chunks():
+    pytest.importorskip("pyarrow")
+    csv = make_abalone_csv().encode()
+    reader = preprocess.RangedS3Reader("bucket", "key", part_size=1000, client=FakeS3Client(csv))
+
+    with reader as f:
+        chunks = list(preprocess.iter_csv_chunks(f, chunk_size=300, block_size=4096))
+
+    expected = list(preprocess.read_csv(io.BytesIO(csv), chunksize=300))
+    assert [len(chunk) for chunk in chunks] == [len(chunk) for chunk in expected]
+    for chunk, expected_chunk in zip(chunks, expected):
+        pd.testing.assert_frame_equal(chunk, expected_chunk)
+    with preprocess.RangedS3Reader("bucket", "key", client=FakeS3Client(csv)) as f:
+        pd.testing.assert_frame_equal(
+            preprocess.read_dataframe(f), preprocess.read_csv(io.BytesIO(csv))
+        )
+
+
+def test_preprocess_streaming_writes_every_row_once(tmp_path):
+    csv = make_abalone_csv()
+    preprocess.preprocess_streaming(lambda: io.StringIO(csv), str(tmp_path), chunk_size=500)
+
+    splits = [
+        pd.read_csv(tmp_path / name / f"{name}.csv", header=None) for name in preprocess.split_names
+    ]
+    assert sum(len(split) for split in splits) == 2000
+    # label, seven numeric features and the F/I/M/missing one-hot columns
+    assert all(split.shape[1] == 12 for split in splits)
+
+
+def test_cached_transformer_skips_the_statistics_pass(tmp_path):
+    csv = make_abalone_csv()
+    fitted = preprocess.preprocess_streaming(
+        lambda: io.StringIO(csv), str(tmp_path / "fit"), chunk_size=500
+    )
+    buffer = io.BytesIO()
+    joblib.dump(fitted, buffer)
+    buffer.seek(0)
+
+    opened = []
+    preprocess.preprocess_streaming(
+        lambda: opened.append(1) or io.StringIO(csv),
+        str(tmp_path / "cached"),
+        chunk_size=500,
+        transformer=joblib.load(buffer),
+    )
+
+    assert len(opened) == 1
+    for name in preprocess.split_names:
+        expected, actual = (
+            pd.read_csv(tmp_path / run / name / f"{name}.csv", header=None)
+            for run in ("fit", "cached")
+        )
+        pd.testing.assert_frame_equal(actual, expected)
+
+
+def test_streaming_over_arrow_batches_writes_the_same_splits(tmp_path):
+    pytest.importorskip("pyarrow")
+    csv = make_abalone_csv()
+    preprocess.preprocess_streaming(lambda: io.StringIO(csv), str(tmp_path / "pandas"), 300)
+    preprocess.preprocess_streaming(lambda: io.BytesIO(csv.encode()), str(tmp_path / "arrow"), 300)
+
+    for name in preprocess.split_names:
+        expected, actual = (
+            pd.read_csv(tmp_path / run / name / f"{name}.csv", header=None)
+            for run in ("pandas", "arrow")
+        )
+        pd.testing.assert_frame_equal(actual, expected)
+
+
+def test_splits_are_reproducible_across_chunk_sizes(tmp_path):
+    csv = make_abalone_csv()
+    for chunk_size in (300, 2000):
+        preprocess.preprocess_streaming(
+            lambda: io.StringIO(csv), str(tmp_path / str(chunk_size)), chunk_size=chunk_size
+        )
+
+    for name in preprocess.split_names:
+        first, second = (
+            pd.read_csv(tmp_path / str(chunk_size) / name / f"{name}.csv", header=None)
+            for chunk_size in (300, 2000)
+        )
+        pd.testing.assert_frame_equal(first, second)
+    assert 1300 < len(pd.read_csv(tmp_path / "300" / "train" / "train.csv", header=None)) < 1500
+
+
+def test_split_key_keeps_rows_sharing_a_value_together():
+    df = preprocess.read_csv(io.StringIO(make_abalone_csv()))
+
+    split = preprocess.assign_splits(preprocess.split_keys(df, "rings"), seed=3)
+
+    assert (pd.Series(split).groupby(df["rings"]).nunique() == 1).all()
+    assert not np.array_equal(split, preprocess.assign_splits(preprocess.split_keys(df, "rings")))
+
+
+def test_sharded_statistics_merge_to_the_in_memory_preprocessor(tmp_path):
+    csv = make_abalone_csv().splitlines(keepends=True)
+    hosts = ["algo-1", "algo-2", "algo-3"]
+    for index, host in enumerate(hosts):
+        (tmp_path / host).mkdir()
+        (tmp_path / host / "part.csv").write_text("".join(csv[index::3]))
+        preprocess.preprocess_shard_statistics(
+            tmp_path / host, tmp_path / "statistics", 250, host, hosts
+        )
+    for host in hosts:
+        preprocess.preprocess_shard_transform(
+            tmp_path / host, tmp_path / "statistics", tmp_path / "out", 250, host, hosts
+        )
+
+    assert len(list((tmp_path / "out" / "train").glob("train-algo-*.csv"))) == 3
+    statistics = preprocess.RunningStatistics()
+    for path in sorted((tmp_path / "statistics").glob("*.npz")):
+        statistics.merge(preprocess.RunningStatistics.load(path))
+    df = preprocess.read_csv(io.StringIO("".join(csv))).drop(columns=preprocess.label_column)
+    expected = preprocess.get_preprocessor().fit_transform(df)
+    np.testing.assert_allclose(statistics.transformer().transform(df), expected, atol=1e-9)
+
+
+def test_split_writer_balances_rows_over_parts(tmp_path):
+    rng = np.random.default_rng(0)
+    y, X = rng.integers(1, 30, 100).astype(float), rng.normal(size=(100, 10))
+    writer = preprocess.SplitWriter(tmp_path, parts=4)
+    writer.write("train", y[:30], X[:30])
+    writer.write("train", y[30:], X[30:])
+    writer.close()
+
+    paths = sorted((tmp_path / "train").glob("train-part-*.csv"))
+    sizes = [len(pd.read_csv(path, header=None)) for path in paths]
+    assert len(paths) == 4 and len(list((tmp_path / "test").iterdir())) == 4
+    assert sum(sizes) == 100 and max(sizes) - min(sizes) <= 2
+    y_read, _ = evaluate.read_test_data(tmp_path / "train")
+    np.testing.assert_array_equal(np.sort(y_read), np.sort(y))
+
+
+@pytest.mark.parametrize("output_format", ["csv", "recordio-protobuf"])
+def test_evaluate_skips_the_parts_without_rows(tmp_path, output_format):
+    rng = np.random.default_rng(0)
+    y, X = rng.integers(1, 30, 3).astype(float), rng.normal(size=(3, 10))
+    writer = preprocess.SplitWriter(tmp_path, output_format, parts=4)
+    writer.write("test", y, X)
+    writer.close()
+
+    assert len(list((tmp_path / "test").iterdir())) == 4
+    y_read, _ = evaluate.read_test_data(tmp_path / "test")
+    np.testing.assert_allclose(np.sort(y_read), np.sort(y), rtol=1e-6)
+
+
+@pytest.mark.parametrize("output_format", ["csv", "parquet", "recordio-protobuf"])
+def test_evaluate_reads_every_output_format(tmp_path, output_format):
+    rng = np.random.default_rng(0)
+    y, X = rng.integers(1, 30, 50).astype(float), rng.normal(size=(50, 10))
+    writer = preprocess.SplitWriter(tmp_path, output_format, suffix="-algo-1")
+    writer.write("test", y[:20], X[:20])
+    writer.write("test", y[20:], X[20:])
+    writer.close()
+
+    y_read, X_read = evaluate.read_test_data(tmp_path / "test")
+
+    np.testing.assert_allclose(y_read, y, rtol=1e-6)
+    np.testing.assert_allclose(X_read, X, rtol=1e-6)
@@ -25,6 +25,7 @@
 
 Implements a get_pipeline(**kwargs) method.
 """
+import hashlib
 import os
 
 import boto3
@@ -44,6 +45,11 @@ from sagemaker.processing import (
     ScriptProcessor,
 )
 from sagemaker.sklearn.processing import SKLearnProcessor
+from sagemaker.tuner import (
+    ContinuousParameter,
+    HyperparameterTuner,
+    IntegerParameter,
+)
 from sagemaker.workflow.conditions import ConditionLessThanOrEqualTo
 from sagemaker.workflow.condition_step import (
     ConditionStep,
@@ -58,12 +64,14 @@ from sagemaker.workflow.parameters import (
 from sagemaker.workflow.pipeline import Pipeline
 from sagemaker.workflow.properties import PropertyFile
 from sagemaker.workflow.steps import (
+    CacheConfig,
     ProcessingStep,
     TrainingStep,
+    TuningStep,
 )
 from sagemaker.workflow.step_collections import RegisterModel
 
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
 from sagemaker.network import NetworkConfig
 
 
@@ -71,6 +79,15 @@ from sagemaker.network import NetworkConfig
 
 logger = logging.getLogger(__name__)
 
+# Search space of the optional hyperparameter tuning step, around the default hyperparameters.
+HYPERPARAMETER_RANGES = {
+    "eta": ContinuousParameter(0.05, 0.5),
+    "max_depth": IntegerParameter(3, 10),
+    "gamma": ContinuousParameter(0, 10),
+    "min_child_weight": ContinuousParameter(1, 10),
+    "subsample": ContinuousParameter(0.5, 1),
+}
+
 
 def get_session(region, default_bucket):
     """Gets the sagemaker session based on the region.
@@ -97,6 +114,30 @@ def get_session(region, default_bucket):
     return session
 
 
+def get_code_hash(path):
+    """Gets the SHA-256 of a step's code file.
+
+    The hash is passed to the step so that editing the code changes the step's cache key.
+    """
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def get_object_etag(s3_uri, sagemaker_session):
+    """Gets the ETag of an S3 object, or an empty string if it cannot be read.
+
+    The ETag identifies the content of the default input data, so that replacing the data in place changes the
+    cache key of the steps reading it.
+    """
+    bucket, _, key = s3_uri[len("s3://") :].partition("/")
+    try:
+        response = sagemaker_session.boto_session.client("s3").head_object(Bucket=bucket, Key=key)
+    except (BotoCoreError, ClientError) as e:
+        logger.warning(f"Could not get the ETag of {s3_uri}: {e}")
+        return ""
+    return response["ETag"].strip('"')
+
+
 def get_pipeline(
     region,
     role=None,
@@ -106,6 +147,10 @@ def get_pipeline(
     pipeline_name="AbalonePipeline",
     base_job_prefix="Abalone",
     project_id="SageMakerProjectId",
+    cache_expire_after="P30D",
+    tuning_max_jobs=None,
+    tuning_max_parallel_jobs=3,
+    tuning_strategy="Bayesian",
 ):
     """Gets a SageMaker ML Pipeline instance working with on abalone data.
 
@@ -113,6 +158,13 @@ def get_pipeline(
         region: AWS region to create and run the pipeline.
         role: IAM role to create and run steps and pipeline.
         default_bucket: the bucket to use for storing the artifacts
+        cache_expire_after: ISO 8601 duration for which the results of a step are reused by executions with the
+            same step arguments, code and input data, or None to disable step caching
+        tuning_max_jobs: when set, the model is trained by a hyperparameter tuning job over HYPERPARAMETER_RANGES
+            running this many training jobs, and the best one is evaluated and registered
+        tuning_max_parallel_jobs: the number of training jobs the tuning job runs in parallel
+        tuning_strategy: "Bayesian", which stops unpromising training jobs early, or "Hyperband", which allocates
+            training rounds to the best training jobs
 
     Returns:
         an instance of a pipeline
@@ -124,6 +176,7 @@ def get_pipeline(
 
     # parameters for pipeline execution
     processing_instance_count = ParameterInteger(name="ProcessingInstanceCount", default_value=1)
+    training_instance_count = ParameterInteger(name="TrainingInstanceCount", default_value=1)
     processing_instance_type = ParameterString(name="ProcessingInstanceType", default_value="ml.m5.xlarge")
     training_instance_type = ParameterString(name="TrainingInstanceType", default_value="ml.m5.xlarge")
     inference_instance_type = ParameterString(name="InferenceInstanceType", default_value="ml.m5.xlarge")
@@ -143,6 +196,13 @@ def get_pipeline(
     #     encrypt_inter_container_traffic=True,
     # )
 
+    # steps are cached on their arguments, which include the hash of their code and the ETag of the default input data
+    cache_config = CacheConfig(enable_caching=cache_expire_after is not None, expire_after=cache_expire_after)
+    input_etag = get_object_etag(input_data.default_value, sagemaker_session)
+    preprocessing_code = "source_scripts/preprocessing/prepare_abalone_data/main.py"
+    helpers_dir = "source_scripts/helpers"
+    evaluation_code = "source_scripts/evaluate/evaluate_xgboost/main.py"
+
     # processing step for feature engineering
     try:
         processing_image_uri = sagemaker_session.sagemaker_client.describe_image_version(
@@ -165,17 +225,32 @@ def get_pipeline(
         sagemaker_session=sagemaker_session,
         role=role,
         output_kms_key=bucket_kms_id,
+        env={
+            "CODE_SHA256": get_code_hash(preprocessing_code),
+            # the helpers are uploaded to the same prefix on every upsert, so their hash keys the cache
+            "HELPERS_SHA256": get_code_hash(f"{helpers_dir}/s3_helper.py"),
+            "INPUT_ETAG": input_etag,
+        },
     )
     step_process = ProcessingStep(
         name="PreprocessAbaloneData",
         processor=script_processor,
+        inputs=[
+            ProcessingInput(
+                input_name="helpers",
+                source=helpers_dir,
+                destination="/opt/ml/processing/input/helpers",
+            ),
+        ],
         outputs=[
             ProcessingOutput(output_name="train", source="/opt/ml/processing/train"),
             ProcessingOutput(output_name="validation", source="/opt/ml/processing/validation"),
             ProcessingOutput(output_name="test", source="/opt/ml/processing/test"),
         ],
-        code="source_scripts/preprocessing/prepare_abalone_data/main.py",  # we must figure out this path to get it from step_source directory
-        job_arguments=["--input-data", input_data],
+        code=preprocessing_code,  # we must figure out this path to get it from step_source directory
+        # one file per training instance and split, read by distributed training as an equal shard
+        job_arguments=["--input-data", input_data, "--output-parts", training_instance_count.to_string()],
+        cache_config=cache_config,
     )
 
     # training step for generating model artifacts
@@ -197,7 +272,7 @@ def get_pipeline(
     xgb_train = Estimator(
         image_uri=training_image_uri,
         instance_type=training_instance_type,
-        instance_count=1,
+        instance_count=training_instance_count,
         output_path=model_path,
         base_job_name=f"{base_job_prefix}/abalone-train",
         sagemaker_session=sagemaker_session,
@@ -214,20 +289,48 @@ def get_pipeline(
         subsample=0.7,
         silent=0,
     )
-    step_train = TrainingStep(
-        name="TrainAbaloneModel",
-        estimator=xgb_train,
-        inputs={
-            "train": TrainingInput(
-                s3_data=step_process.properties.ProcessingOutputConfig.Outputs["train"].S3Output.S3Uri,
-                content_type="text/csv",
-            ),
-            "validation": TrainingInput(
-                s3_data=step_process.properties.ProcessingOutputConfig.Outputs["validation"].S3Output.S3Uri,
-                content_type="text/csv",
-            ),
-        },
-    )
+    training_inputs = {
+        "train": TrainingInput(
+            s3_data=step_process.properties.ProcessingOutputConfig.Outputs["train"].S3Output.S3Uri,
+            content_type="text/csv",
+            distribution="ShardedByS3Key",
+        ),
+        "validation": TrainingInput(
+            s3_data=step_process.properties.ProcessingOutputConfig.Outputs["validation"].S3Output.S3Uri,
+            content_type="text/csv",
+            distribution="ShardedByS3Key",
+        ),
+    }
+    if tuning_max_jobs:
+        # Hyperband stops training jobs on its own, early stopping only applies to Bayesian search
+        tuner = HyperparameterTuner(
+            estimator=xgb_train,
+            objective_metric_name="validation:rmse",
+            objective_type="Minimize",
+            hyperparameter_ranges=HYPERPARAMETER_RANGES,
+            strategy=tuning_strategy,
+            max_jobs=tuning_max_jobs,
+            max_parallel_jobs=tuning_max_parallel_jobs,
+            early_stopping_type="Auto" if tuning_strategy == "Bayesian" else "Off",
+            base_tuning_job_name=f"{base_job_prefix}/abalone-tune",
+        )
+        step_train = TuningStep(
+            name="TuneAbaloneModel",
+            tuner=tuner,
+            inputs=training_inputs,
+            cache_config=cache_config,
+        )
+        model_data = step_train.get_top_model_s3_uri(
+            top_k=0, s3_bucket=default_bucket, prefix=f"{base_job_prefix}/AbaloneTrain"
+        )
+    else:
+        step_train = TrainingStep(
+            name="TrainAbaloneModel",
+            estimator=xgb_train,
+            inputs=training_inputs,
+            cache_config=cache_config,
+        )
+        model_data = step_train.properties.ModelArtifacts.S3ModelArtifacts
 
     # processing step for evaluation
     script_eval = ScriptProcessor(
@@ -239,6 +342,7 @@ def get_pipeline(
         sagemaker_session=sagemaker_session,
         role=role,
         output_kms_key=bucket_kms_id,
+        env={"CODE_SHA256": get_code_hash(evaluation_code)},
     )
     evaluation_report = PropertyFile(
         name="AbaloneEvaluationReport",
@@ -250,7 +354,7 @@ def get_pipeline(
         processor=script_eval,
         inputs=[
             ProcessingInput(
-                source=step_train.properties.ModelArtifacts.S3ModelArtifacts,
+                source=model_data,
                 destination="/opt/ml/processing/model",
             ),
             ProcessingInput(
@@ -261,8 +365,9 @@ def get_pipeline(
         outputs=[
             ProcessingOutput(output_name="evaluation", source="/opt/ml/processing/evaluation"),
         ],
-        code="source_scripts/evaluate/evaluate_xgboost/main.py",
+        code=evaluation_code,
         property_files=[evaluation_report],
+        cache_config=cache_config,
     )
 
     # register model step that will be conditionally executed
@@ -291,7 +396,7 @@ def get_pipeline(
         name="RegisterAbaloneModel",
         estimator=xgb_train,
         image_uri=inference_image_uri,
-        model_data=step_train.properties.ModelArtifacts.S3ModelArtifacts,
+        model_data=model_data,
         content_types=["text/csv"],
         response_types=["text/csv"],
         inference_instances=["ml.t2.medium", "ml.m5.large"],
@@ -322,6 +427,7 @@ def get_pipeline(
             processing_instance_type,
             processing_instance_count,
             training_instance_type,
+            training_instance_count,
             model_approval_status,
             input_data,
         ],
@@ -14,3 +14,207 @@
 # HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
 # OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""Helpers to read S3 objects straight into memory with concurrent ranged GETs.
+
+pyarrow parses the CSV objects when it is installed, and is only imported then, so that the helpers also run in
+processing images without it.
+"""
+import collections
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import numpy as np
+import pandas as pd
+from botocore.config import Config
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+DEFAULT_MAX_WORKERS = 8
+
+
+def get_s3_client(max_workers=DEFAULT_MAX_WORKERS):
+    """Creates an S3 client whose connection pool fits `max_workers` concurrent requests."""
+    return boto3.client("s3", config=Config(max_pool_connections=max_workers))
+
+
+def split_s3_uri(s3_uri):
+    """Splits an s3://bucket/key URI into its bucket and key."""
+    bucket, _, key = s3_uri[len("s3://") :].partition("/")
+    return bucket, key
+
+
+class RangedS3Reader(io.RawIOBase):
+    """Read-only file object over an S3 object, fetched with concurrent ranged GETs.
+
+    Up to `max_workers` parts of `part_size` bytes are fetched ahead of the position of the reader into memory, so
+    parsing overlaps with the downloads and nothing touches the disk. Every part is requested with the ETag of the
+    first response, so an object overwritten while it is read fails the read instead of mixing two versions.
+    """
+
+    def __init__(self, bucket, key, part_size=DEFAULT_PART_SIZE, max_workers=DEFAULT_MAX_WORKERS, client=None):
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.max_workers = max_workers
+        self._client = client or get_s3_client(max_workers)
+        head = self._client.head_object(Bucket=bucket, Key=key)
+        self.size = head["ContentLength"]
+        self.etag = head["ETag"]
+        self._executor = ThreadPoolExecutor(max_workers)
+        self._parts = collections.deque()
+        self._next_offset = 0
+        self._buffer = memoryview(b"")
+        self._prefetch()
+
+    def _fetch(self, start, end):
+        response = self._client.get_object(
+            Bucket=self.bucket, Key=self.key, Range=f"bytes={start}-{end - 1}", IfMatch=self.etag
+        )
+        return response["Body"].read()
+
+    def _prefetch(self):
+        while len(self._parts) < self.max_workers and self._next_offset < self.size:
+            end = min(self._next_offset + self.part_size, self.size)
+            self._parts.append(self._executor.submit(self._fetch, self._next_offset, end))
+            self._next_offset = end
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self._buffer:
+            if not self._parts:
+                return 0
+            self._buffer = memoryview(self._parts.popleft().result())
+            self._prefetch()
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            for part in self._parts:
+                part.cancel()
+            self._executor.shutdown(wait=False)
+        super().close()
+
+
+def read_object(bucket, key, part_size=DEFAULT_PART_SIZE, max_workers=DEFAULT_MAX_WORKERS, client=None):
+    """Reads a whole S3 object into memory with concurrent ranged GETs.
+
+    Args:
+        bucket: the bucket of the object.
+        key: the key of the object.
+        part_size: the size in bytes of each ranged GET.
+        max_workers: the number of ranged GETs in flight.
+        client: the S3 client, defaults to one sized for `max_workers`.
+
+    Returns:
+        a bytearray with the content of the object
+    """
+    with RangedS3Reader(bucket, key, part_size, max_workers, client) as reader:
+        content = bytearray(reader.size)
+        view = memoryview(content)
+        offset = 0
+        while offset < reader.size:
+            offset += reader.readinto(view[offset:])
+    logger.info("Read %d bytes from s3://%s/%s", reader.size, bucket, key)
+    return content
+
+
+def _csv_options(column_names=None, dtype=None, block_size=None):
+    """Gets the pyarrow CSV options matching pandas.read_csv with `names` and `dtype`."""
+    import pyarrow as pa
+    from pyarrow import csv
+
+    column_types = {
+        name: pa.string() if t is str else pa.from_numpy_dtype(np.dtype(t)) for name, t in (dtype or {}).items()
+    }
+    read_options = csv.ReadOptions(column_names=column_names)
+    if block_size is not None:
+        read_options.block_size = block_size
+    # empty strings are missing values, as for pandas
+    convert_options = csv.ConvertOptions(column_types=column_types, strings_can_be_null=True)
+    return read_options, convert_options
+
+
+def _to_pandas(table):
+    """Converts a pyarrow table to pandas, with NaN rather than None for the missing strings as pandas reads them."""
+    df = table.to_pandas()
+    for name in df.columns[df.dtypes == object]:
+        df[name] = df[name].where(df[name].notna(), np.nan)
+    return df
+
+
+def iter_record_batches(
+    bucket,
+    key,
+    column_names=None,
+    dtype=None,
+    block_size=1024 * 1024,
+    part_size=DEFAULT_PART_SIZE,
+    max_workers=DEFAULT_MAX_WORKERS,
+    client=None,
+):
+    """Streams a CSV object as pyarrow record batches, parsed while the next ranges download.
+
+    Args:
+        bucket: the bucket of the object.
+        key: the key of the object.
+        column_names: the names of the columns of a headerless CSV, or None to read them from the header.
+        dtype: a dict of column name to numpy type or str, the other types are inferred.
+        block_size: the number of bytes parsed into each record batch.
+        part_size: the size in bytes of each ranged GET.
+        max_workers: the number of ranged GETs in flight.
+        client: the S3 client, defaults to one sized for `max_workers`.
+
+    Yields:
+        pyarrow.RecordBatch
+    """
+    from pyarrow import csv
+
+    read_options, convert_options = _csv_options(column_names, dtype, block_size)
+    with RangedS3Reader(bucket, key, part_size, max_workers, client) as reader:
+        yield from csv.open_csv(reader, read_options=read_options, convert_options=convert_options)
+
+
+def read_dataframe(
+    bucket,
+    key,
+    column_names=None,
+    dtype=None,
+    part_size=DEFAULT_PART_SIZE,
+    max_workers=DEFAULT_MAX_WORKERS,
+    client=None,
+):
+    """Reads a whole CSV object into a pandas DataFrame without a temporary file.
+
+    The object is fetched with concurrent ranged GETs and parsed by the multi-threaded pyarrow CSV reader, or by
+    pandas when pyarrow is not installed.
+
+    Args:
+        bucket: the bucket of the object.
+        key: the key of the object.
+        column_names: the names of the columns of a headerless CSV, or None to read them from the header.
+        dtype: a dict of column name to numpy type or str, the other types are inferred.
+        part_size: the size in bytes of each ranged GET.
+        max_workers: the number of ranged GETs in flight.
+        client: the S3 client, defaults to one sized for `max_workers`.
+
+    Returns:
+        pandas.DataFrame
+    """
+    content = read_object(bucket, key, part_size, max_workers, client)
+    try:
+        import pyarrow as pa
+        from pyarrow import csv
+    except ImportError:
+        header = "infer" if column_names is None else None
+        return pd.read_csv(io.BytesIO(content), header=header, names=column_names, dtype=dtype)
+    read_options, convert_options = _csv_options(column_names, dtype)
+    table = csv.read_csv(pa.py_buffer(content), read_options=read_options, convert_options=convert_options)
+    return _to_pandas(table)
@@ -0,0 +1,107 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import builtins
+import io
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import s3_helper  # noqa: E402
+
+COLUMN_NAMES = ["sex", "length", "rings"]
+DTYPE = {"sex": str, "length": np.float64, "rings": np.float64}
+
+
+class FakeS3Client:
+    def __init__(self, data):
+        self.data = data
+        self.ranges = []
+
+    def head_object(self, Bucket, Key):
+        return {"ContentLength": len(self.data), "ETag": '"etag"'}
+
+    def get_object(self, Bucket, Key, Range, IfMatch):
+        assert IfMatch == '"etag"'
+        start, end = map(int, Range[len("bytes=") :].split("-"))
+        self.ranges.append((start, end))
+        return {"Body": io.BytesIO(self.data[start : end + 1])}
+
+
+def make_csv(rows=1000, seed=0):
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({"sex": rng.choice(["M", "F", "I"], rows), "length": rng.normal(size=rows)})
+    df["rings"] = rng.integers(1, 30, rows).astype(float)
+    df.loc[rng.random(rows) < 0.05, "length"] = np.nan
+    df.loc[rng.random(rows) < 0.05, "sex"] = np.nan
+    return df.to_csv(header=False, index=False).encode()
+
+
+def expected_dataframe(data):
+    return pd.read_csv(io.BytesIO(data), header=None, names=COLUMN_NAMES, dtype=DTYPE)
+
+
+def test_read_object_reassembles_the_ranges_in_order():
+    data = make_csv()
+    client = FakeS3Client(data)
+
+    content = s3_helper.read_object("bucket", "key", part_size=1000, max_workers=3, client=client)
+
+    assert bytes(content) == data
+    assert len(client.ranges) == -(-len(data) // 1000)
+
+
+def test_read_dataframe_matches_pandas():
+    data = make_csv()
+
+    df = s3_helper.read_dataframe("bucket", "key", COLUMN_NAMES, DTYPE, part_size=1000, client=FakeS3Client(data))
+
+    pd.testing.assert_frame_equal(df, expected_dataframe(data))
+
+
+def test_read_dataframe_falls_back_to_pandas_without_pyarrow(monkeypatch):
+    data = make_csv()
+    import_module = builtins.__import__
+
+    def import_without_pyarrow(name, *args, **kwargs):
+        if name.startswith("pyarrow"):
+            raise ImportError(name)
+        return import_module(name, *args, **kwargs)
+
+    monkeypatch.setattr(builtins, "__import__", import_without_pyarrow)
+    df = s3_helper.read_dataframe("bucket", "key", COLUMN_NAMES, DTYPE, client=FakeS3Client(data))
+
+    pd.testing.assert_frame_equal(df, expected_dataframe(data))
+
+
+def test_iter_record_batches_streams_every_row():
+    pytest.importorskip("pyarrow")
+    data = make_csv()
+
+    batches = list(
+        s3_helper.iter_record_batches(
+            "bucket", "key", COLUMN_NAMES, DTYPE, block_size=4096, part_size=1000, client=FakeS3Client(data)
+        )
+    )
+
+    assert len(batches) > 1
+    assert sum(batch.num_rows for batch in batches) == len(expected_dataframe(data))
+    lengths = np.concatenate([batch.column("length").to_numpy(zero_copy_only=False) for batch in batches])
+    np.testing.assert_allclose(lengths, expected_dataframe(data)["length"].to_numpy())
@@ -17,12 +17,11 @@
 """Feature engineers the abalone dataset."""
 import argparse
 import logging
-import os
 import pathlib
 import requests
+import sys
 import tempfile
 
-import boto3
 import numpy as np
 import pandas as pd
 
@@ -31,6 +30,11 @@ from sklearn.impute import SimpleImputer
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import StandardScaler, OneHotEncoder
 
+# source_scripts/helpers, given to the processing job as an input
+HELPERS_DIR = "/opt/ml/processing/input/helpers"
+sys.path.insert(0, HELPERS_DIR)
+from s3_helper import read_dataframe  # noqa: E402
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 logger.addHandler(logging.StreamHandler())
@@ -61,6 +65,10 @@ feature_columns_dtype = {
 }
 label_column_dtype = {"rings": np.float64}
 
+split_names = ["train", "validation", "test"]
+# Upper bounds of the train and validation fractions of the split assignment.
+split_boundaries = [0.7, 0.85]
+
 
 def merge_two_dicts(x, y):
     """Merges two dicts, returning a new copy."""
@@ -69,10 +77,29 @@ def merge_two_dicts(x, y):
     return z
 
 
+def assign_splits(keys, seed=0):
+    """Assigns each row to a split by a stable hash of its key, so that reruns reproduce the same splits.
+
+    Args:
+        keys: a DataFrame with the key of each row.
+        seed: the seed of the hash.
+
+    Returns:
+        an array with the index in `split_names` of the split of each row
+    """
+    # The seed is hashed as one more key column, `hash_key` only applies to string columns.
+    hashes = pd.util.hash_pandas_object(keys.assign(split_seed=seed), index=False)
+    # The top 53 bits of the hash make a uniform double in [0, 1).
+    uniform = (hashes.to_numpy() >> np.uint64(11)) * 2.0**-53
+    return np.digitize(uniform, split_boundaries)
+
+
 if __name__ == "__main__":
     logger.debug("Starting preprocessing.")
     parser = argparse.ArgumentParser()
     parser.add_argument("--input-data", type=str, required=True)
+    parser.add_argument("--split-seed", type=int, default=0)
+    parser.add_argument("--output-parts", type=int, default=1, help="number of files each split is written as")
     args = parser.parse_args()
 
     base_dir = "/opt/ml/processing"
@@ -81,19 +108,13 @@ if __name__ == "__main__":
     bucket = input_data.split("/")[2]
     key = "/".join(input_data.split("/")[3:])
 
-    logger.info("Downloading data from bucket: %s, key: %s", bucket, key)
-    fn = f"{base_dir}/data/abalone-dataset.csv"
-    s3 = boto3.resource("s3")
-    s3.Bucket(bucket).download_file(key, fn)
-
-    logger.debug("Reading downloaded data.")
-    df = pd.read_csv(
-        fn,
-        header=None,
-        names=feature_columns_names + [label_column],
+    logger.info("Reading data from bucket: %s, key: %s", bucket, key)
+    df = read_dataframe(
+        bucket,
+        key,
+        column_names=feature_columns_names + [label_column],
         dtype=merge_two_dicts(feature_columns_dtype, label_column_dtype),
     )
-    os.unlink(fn)
 
     logger.debug("Defining transformers.")
     numeric_features = list(feature_columns_names)
@@ -115,18 +136,26 @@ if __name__ == "__main__":
         ]
     )
 
-    logger.info("Applying transforms.")
-    y = df.pop("rings")
-    X_pre = preprocess.fit_transform(df)
-    y_pre = y.to_numpy().reshape(len(y), 1)
+    logger.info("Splitting %d rows of data into train, validation, test datasets.", len(df))
+    split = assign_splits(pd.DataFrame({"source": key, "row": df.index.to_numpy()}), args.split_seed)
 
-    X = np.concatenate((y_pre, X_pre), axis=1)
-
-    logger.info("Splitting %d rows of data into train, validation, test datasets.", len(X))
-    np.random.shuffle(X)
-    train, validation, test = np.split(X, [int(0.7 * len(X)), int(0.85 * len(X))])
+    logger.info("Applying transforms.")
+    y = df.pop("rings").to_numpy()
+    X = preprocess.fit_transform(df)
 
     logger.info("Writing out datasets to %s.", base_dir)
-    pd.DataFrame(train).to_csv(f"{base_dir}/train/train.csv", header=False, index=False)
-    pd.DataFrame(validation).to_csv(f"{base_dir}/validation/validation.csv", header=False, index=False)
-    pd.DataFrame(test).to_csv(f"{base_dir}/test/test.csv", header=False, index=False)
+    for index, name in enumerate(split_names):
+        split_df = pd.DataFrame(X[split == index])
+        split_df.insert(0, label_column, y[split == index])
+        if args.output_parts == 1:
+            split_df.to_csv(f"{base_dir}/{name}/{name}.csv", header=False, index=False)
+            continue
+        # files of about the same number of rows, so that a ShardedByS3Key channel gives each training instance an
+        # equal share, leaving out the empty ones of a split with fewer rows than parts, which pandas cannot read
+        bounds = np.linspace(0, len(split_df), args.output_parts + 1).astype(int)
+        for part in range(args.output_parts):
+            if bounds[part] == bounds[part + 1]:
+                continue
+            split_df.iloc[bounds[part] : bounds[part + 1]].to_csv(
+                f"{base_dir}/{name}/{name}-part-{part:05d}.csv", header=False, index=False
+            )
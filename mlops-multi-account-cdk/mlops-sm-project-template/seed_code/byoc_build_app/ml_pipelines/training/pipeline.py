@@ -25,6 +25,7 @@
 
 Implements a get_pipeline(**kwargs) method.
 """
+import hashlib
 import os
 
 import boto3
@@ -58,12 +59,13 @@ from sagemaker.workflow.parameters import (
 from sagemaker.workflow.pipeline import Pipeline
 from sagemaker.workflow.properties import PropertyFile
 from sagemaker.workflow.steps import (
+    CacheConfig,
     ProcessingStep,
     TrainingStep,
 )
 from sagemaker.workflow.step_collections import RegisterModel
 
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
 from sagemaker.network import NetworkConfig
 
 
@@ -97,6 +99,38 @@ def get_session(region, default_bucket):
     return session
 
 
+def get_code_hash(path):
+    """Gets the SHA-256 of a step's code file, or of all the files under a step's code directory.
+
+    The hash is passed to the step so that editing the code changes the step's cache key.
+    """
+    digest = hashlib.sha256()
+    if os.path.isdir(path):
+        paths = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+    else:
+        paths = [path]
+    for file_path in paths:
+        digest.update(os.path.relpath(file_path, path).encode())
+        with open(file_path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def get_object_etag(s3_uri, sagemaker_session):
+    """Gets the ETag of an S3 object, or an empty string if it cannot be read.
+
+    The ETag identifies the content of the default input data, so that replacing the data in place changes the
+    cache key of the steps reading it.
+    """
+    bucket, _, key = s3_uri[len("s3://") :].partition("/")
+    try:
+        response = sagemaker_session.boto_session.client("s3").head_object(Bucket=bucket, Key=key)
+    except (BotoCoreError, ClientError) as e:
+        logger.warning(f"Could not get the ETag of {s3_uri}: {e}")
+        return ""
+    return response["ETag"].strip('"')
+
+
 def get_pipeline(
     region,
     role=None,
@@ -109,6 +143,7 @@ def get_pipeline(
     git_hash="",
     ecr_repo_uri="",
     default_input_data="",
+    cache_expire_after="P30D",
 ):
     """Gets a SageMaker ML Pipeline instance working with on abalone data.
 
@@ -119,6 +154,8 @@ def get_pipeline(
         git_hash: the hash id of the current commit. Used to determine which docker image version to use
         ecr_repo_uri: uri of the ECR repository used by this project
         default_input_data: s3 location with data to be used by pipeline
+        cache_expire_after: ISO 8601 duration for which the results of a step are reused by executions with the
+            same step arguments, code and input data, or None to disable step caching
 
     Returns:
         an instance of a pipeline
@@ -149,6 +186,13 @@ def get_pipeline(
     #     encrypt_inter_container_traffic=True,
     # )
 
+    # steps are cached on their arguments, which include the hash of their code and the ETag of the default input data
+    cache_config = CacheConfig(enable_caching=cache_expire_after is not None, expire_after=cache_expire_after)
+    input_etag = get_object_etag(input_data.default_value, sagemaker_session)
+    preprocessing_code = "source_scripts/preprocessing/prepare_abalone_data/preprocessing.R"
+    training_code = "source_scripts/training/"
+    evaluation_code = "source_scripts/evaluate/evaluation.R"
+
     script_processor = ScriptProcessor(
         image_uri=processing_image_uri,
         instance_type=processing_instance_type,
@@ -158,6 +202,7 @@ def get_pipeline(
         sagemaker_session=sagemaker_session,
         role=role,
         output_kms_key=bucket_kms_id,
+        env={"CODE_SHA256": get_code_hash(preprocessing_code), "INPUT_ETAG": input_etag},
     )
     step_process = ProcessingStep(
         name="PreprocessAbaloneData",
@@ -168,7 +213,8 @@ def get_pipeline(
             ProcessingOutput(output_name="validation", source="/opt/ml/processing/output/validation"),
             ProcessingOutput(output_name="test", source="/opt/ml/processing/output/test"),
         ],
-        code="source_scripts/preprocessing/prepare_abalone_data/preprocessing.R",  # we must figure out this path to get it from step_source directory
+        code=preprocessing_code,  # we must figure out this path to get it from step_source directory
+        cache_config=cache_config,
     )
 
     # training step for generating model artifacts
@@ -183,8 +229,9 @@ def get_pipeline(
         sagemaker_session=sagemaker_session,
         role=role,
         output_kms_key=bucket_kms_id,
-        source_dir="source_scripts/training/",
+        source_dir=training_code,
         entry_point="train.R",
+        environment={"CODE_SHA256": get_code_hash(training_code)},
         metric_definitions=[{"Name": "rmse-validation", "Regex": "Calculated validation RMSE: ([0-9.]+);.*$"}],
     )
 
@@ -201,6 +248,7 @@ def get_pipeline(
                 content_type="text/csv",
             ),
         },
+        cache_config=cache_config,
     )
 
     # processing step for evaluation
@@ -213,6 +261,7 @@ def get_pipeline(
         sagemaker_session=sagemaker_session,
         role=role,
         output_kms_key=bucket_kms_id,
+        env={"CODE_SHA256": get_code_hash(evaluation_code)},
     )
     evaluation_report = PropertyFile(
         name="AbaloneEvaluationReport",
@@ -235,8 +284,9 @@ def get_pipeline(
         outputs=[
             ProcessingOutput(output_name="evaluation", source="/opt/ml/processing/evaluation"),
         ],
-        code="source_scripts/evaluate/evaluation.R",
+        code=evaluation_code,
         property_files=[evaluation_report],
+        cache_config=cache_config,
     )
 
     # register model step that will be conditionally executed
@@ -0,0 +1,140 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Resolves the latest approved model packages of model package groups.
+
+The registry is asked for the newest approved package only, and the resolved ARNs are cached
+on disk for a few minutes per model package group, so that repeated builds do not page the
+registry again.
+"""
+
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = ".model-registry-cache"
+CACHE_TTL = 300
+
+
+def _get_cache_path(cache_dir, sm_client, model_package_group_name):
+    return os.path.join(cache_dir, f"{sm_client.meta.region_name}-{model_package_group_name}.json")
+
+
+def _read_cache(cache_path, ttl):
+    try:
+        with open(cache_path) as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time.time() - entry["Timestamp"] > ttl:
+        return None
+    return entry["ModelPackageArn"]
+
+
+def _write_cache(cache_path, model_package_arn):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    with open(cache_path, "w") as f:
+        json.dump({"ModelPackageArn": model_package_arn, "Timestamp": time.time()}, f)
+
+
+def get_approved_package(model_package_group_name, sm_client=None, cache_dir=CACHE_DIR, ttl=CACHE_TTL):
+    """Gets the latest approved model package for a model package group.
+
+    Args:
+        model_package_group_name: The model package group name.
+        sm_client: The SageMaker client, a new one in the default region when None.
+        cache_dir: The directory caching the resolved ARNs, or None to not cache them.
+        ttl: The number of seconds a cached ARN is used for.
+
+    Returns:
+        The SageMaker Model Package ARN.
+    """
+    sm_client = sm_client or boto3.client("sagemaker")
+    cache_path = cache_dir and _get_cache_path(cache_dir, sm_client, model_package_group_name)
+    model_package_arn = cache_path and _read_cache(cache_path, ttl)
+    if model_package_arn:
+        logger.info(f"Using the cached latest approved model package: {model_package_arn}")
+        return model_package_arn
+
+    try:
+        # Get the latest approved model package only
+        response = sm_client.list_model_packages(
+            ModelPackageGroupName=model_package_group_name,
+            ModelApprovalStatus="Approved",
+            SortBy="CreationTime",
+            SortOrder="Descending",
+            MaxResults=1,
+        )
+        approved_packages = response["ModelPackageSummaryList"]
+
+        # Fetch more packages if none returned with continuation token
+        while len(approved_packages) == 0 and "NextToken" in response:
+            logger.debug("Getting more packages for token: {}".format(response["NextToken"]))
+            response = sm_client.list_model_packages(
+                ModelPackageGroupName=model_package_group_name,
+                ModelApprovalStatus="Approved",
+                SortBy="CreationTime",
+                SortOrder="Descending",
+                MaxResults=100,
+                NextToken=response["NextToken"],
+            )
+            approved_packages.extend(response["ModelPackageSummaryList"])
+
+        # Return error if no packages found
+        if len(approved_packages) == 0:
+            error_message = f"No approved ModelPackage found for ModelPackageGroup: {model_package_group_name}"
+            logger.error(error_message)
+            raise Exception(error_message)
+
+        # Return the model package arn
+        model_package_arn = approved_packages[0]["ModelPackageArn"]
+        logger.info(f"Identified the latest approved model package: {model_package_arn}")
+    except ClientError as e:
+        error_message = e.response["Error"]["Message"]
+        logger.error(error_message)
+        raise Exception(error_message)
+
+    if cache_path:
+        _write_cache(cache_path, model_package_arn)
+    return model_package_arn
+
+
+def get_approved_packages(model_package_group_names, sm_client=None, cache_dir=CACHE_DIR, ttl=CACHE_TTL, max_workers=8):
+    """Gets the latest approved model package of several model package groups concurrently.
+
+    Args:
+        model_package_group_names: The model package group names.
+        sm_client: The SageMaker client, a new one in the default region when None.
+        cache_dir: The directory caching the resolved ARNs, or None to not cache them.
+        ttl: The number of seconds a cached ARN is used for.
+        max_workers: The maximum number of concurrent registry requests.
+
+    Returns:
+        The SageMaker Model Package ARN by model package group name.
+    """
+    sm_client = sm_client or boto3.client("sagemaker")
+    names = list(dict.fromkeys(model_package_group_names))
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(names)))) as executor:
+        arns = executor.map(lambda name: get_approved_package(name, sm_client, cache_dir, ttl), names)
+        return dict(zip(names, arns))
@@ -23,18 +23,26 @@ import os
 import boto3
 from botocore.exceptions import ClientError
 
+from load_test import add_arguments, load_test
+
 logger = logging.getLogger(__name__)
 sm_client = boto3.client("sagemaker")
 
 
-def invoke_endpoint(endpoint_name):
+def invoke_endpoint(endpoint_name, args):
     """
-    Add custom logic here to invoke the endpoint and validate reponse
+    Load test the endpoint with the sample payload and check the results against the SLOs
     """
-    return {"endpoint_name": endpoint_name, "success": True}
+    if not args.payload_file or not os.path.exists(args.payload_file):
+        logger.warning(f"No sample payload: {args.payload_file}, skipping the load test")
+        return {"endpoint_name": endpoint_name, "success": True}
+
+    results = load_test(endpoint_name, args)
+    logger.info(f"Load test results: {json.dumps(results, indent=4)}")
+    return {"endpoint_name": endpoint_name, "load_test": results, "success": results["success"]}
 
 
-def test_endpoint(endpoint_name):
+def test_endpoint(endpoint_name, args):
     """
     Describe the endpoint and ensure InSerivce, then invoke endpoint.  Raises exception on error.
     """
@@ -55,7 +63,7 @@ def test_endpoint(endpoint_name):
             logger.info(f"data capture enabled for endpoint config {endpoint_config_name}")
 
         # Call endpoint to handle
-        return invoke_endpoint(endpoint_name)
+        return invoke_endpoint(endpoint_name, args)
     except ClientError as e:
         error_message = e.response["Error"]["Message"]
         logger.error(error_message)
@@ -67,6 +75,7 @@ if __name__ == "__main__":
     parser.add_argument("--log-level", type=str, default=os.environ.get("LOGLEVEL", "INFO").upper())
     parser.add_argument("--import-build-config", type=str, required=True)
     parser.add_argument("--export-test-results", type=str, required=True)
+    add_arguments(parser, payload_file="tests/integration_tests/sample-payload.csv")
     args, _ = parser.parse_known_args()
 
     # Configure logging to output the line number and message
@@ -79,9 +88,13 @@ if __name__ == "__main__":
 
     # Get the endpoint name from sagemaker project name
     endpoint_name = "{}-{}".format(config["Parameters"]["SageMakerProjectName"], config["Parameters"]["StageName"])
-    results = test_endpoint(endpoint_name)
+    results = test_endpoint(endpoint_name, args)
 
     # Print results and write to file
     logger.debug(json.dumps(results, indent=4))
     with open(args.export_test_results, "w") as f:
         json.dump(results, f, indent=4)
+
+    # Fail the stage when the endpoint misses its SLOs
+    if not results["success"]:
+        raise Exception(f"SageMaker endpoint: {endpoint_name} failed the load test")
@@ -14,6 +14,48 @@
 from __future__ import absolute_import
 
 import ast
+import hashlib
+import importlib.util
+import json
+import multiprocessing
+import os
+import pathlib
+import resource
+import threading
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+from botocore.exceptions import ClientError
+
+# Tag of the hash of the definition, tags, role and description a pipeline was upserted with.
+DEFINITION_HASH_TAG_KEY = "pipeline-definition-sha256"
+# Directory of the definitions generated by get_pipeline_definition, shared by the CLIs.
+DEFINITION_CACHE_DIR = ".pipeline-definitions"
+# Environment variables that key the cached definitions: the session a definition is resolved
+# with, and the CodeBuild build the definitions are shared within.
+DEFINITION_CACHE_ENV = ["AWS_PROFILE", "AWS_REGION", "AWS_DEFAULT_REGION", "CODEBUILD_BUILD_ID"]
+# Log group, describe method, name argument and start time field of the jobs run by steps.
+STEP_JOB_TYPES = {
+    "ProcessingJob": (
+        "/aws/sagemaker/ProcessingJobs",
+        "describe_processing_job",
+        "ProcessingJobName",
+        "ProcessingStartTime",
+    ),
+    "TrainingJob": (
+        "/aws/sagemaker/TrainingJobs",
+        "describe_training_job",
+        "TrainingJobName",
+        "TrainingStartTime",
+    ),
+    "TransformJob": (
+        "/aws/sagemaker/TransformJobs",
+        "describe_transform_job",
+        "TransformJobName",
+        "TransformStartTime",
+    ),
+}
 
 
 def get_pipeline_driver(module_name, passed_args=None):
@@ -33,9 +75,221 @@ def get_pipeline_driver(module_name, passed_args=None):
     return _imports.get_pipeline(**kwargs)
 
 
+def get_local_pipeline_driver(module_name, passed_args=None):
+    """Gets the driver for generating the local steps of your pipeline.
+
+    Pipeline modules supporting local runs must define a get_local_pipeline() module-level
+    method, returning the name, function and keyword arguments of every step in order.
+
+    Args:
+        module_name: The module name of your pipeline.
+        passed_args: Optional passed arguments that your pipeline may be templated by.
+
+    Returns:
+        The local steps of the pipeline.
+    """
+    _imports = __import__(module_name, fromlist=["get_local_pipeline"])
+    kwargs = convert_struct(passed_args)
+    return _imports.get_local_pipeline(**kwargs)
+
+
+def _get_peak_rss():
+    """Gets the peak RSS of the current process in MiB, ru_maxrss being in KiB on Linux."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _run_local_step(function, kwargs):
+    """Runs a local step, returning its result, wall-clock seconds and peak RSS in MiB
+    before and after running it."""
+    import_rss = _get_peak_rss()
+    start = time.perf_counter()
+    result = function(**kwargs)
+    seconds = time.perf_counter() - start
+    return result, seconds, import_rss, _get_peak_rss()
+
+
+def run_local_steps(steps, summary_file=None):
+    """Runs local pipeline steps in order, each in a fresh process, reporting their costs.
+
+    Every step runs in its own spawned process, so its peak RSS is not inflated by the
+    memory of the steps before it. The wall-clock time excludes starting the process, and
+    the peak RSS after importing the step's modules is reported apart.
+
+    Args:
+        steps: The name, function and keyword arguments of every step.
+        summary_file: Optional file to write the wall-clock time and peak RSS of each step to.
+
+    Returns:
+        The wall-clock seconds, peak RSS and result of every step.
+    """
+    context = multiprocessing.get_context("spawn")
+    summary = []
+    for name, function, kwargs in steps:
+        print(f"###### Running step {name}")
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            future = executor.submit(_run_local_step, function, kwargs)
+            result, seconds, import_rss, peak_rss = future.result()
+        summary.append(
+            {
+                "StepName": name,
+                "WallClockSeconds": round(seconds, 3),
+                "ImportPeakRssMiB": round(import_rss, 1),
+                "PeakRssMiB": round(peak_rss, 1),
+                "Result": result,
+            }
+        )
+        print(
+            f"###### Step {name}: {seconds:.2f} s, peak RSS {peak_rss:.1f} MiB "
+            f"({import_rss:.1f} MiB after imports), result {result}"
+        )
+    if summary_file:
+        with open(summary_file, "w") as f:
+            json.dump({"Steps": summary}, f, indent=2)
+    return summary
+
+
 def convert_struct(str_struct=None):
     return ast.literal_eval(str_struct) if str_struct else {}
 
+
+def get_source_hash(module_name):
+    """Hashes every file of the package of a pipeline module, without importing the module."""
+    package_dir = pathlib.Path(importlib.util.find_spec(module_name).origin).parent
+    digest = hashlib.sha256()
+    for path in sorted(package_dir.rglob("*")):
+        if path.is_file() and "__pycache__" not in path.parts:
+            digest.update(path.relative_to(package_dir).as_posix().encode())
+            digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def get_pipeline_cache_inputs(module_name, passed_args=None):
+    """Gets the inputs a pipeline resolves when its definition is generated.
+
+    Pipeline modules may define a get_pipeline_cache_inputs() module-level method, taking the
+    arguments of get_pipeline(), that returns what get_pipeline() looks up outside of its
+    arguments and source, such as the ETag of its input data.
+
+    Args:
+        module_name: The module name of your pipeline.
+        passed_args: Optional passed arguments that your pipeline may be templated by.
+
+    Returns:
+        The JSON-serializable inputs, or None if the module does not define the method.
+    """
+    _imports = __import__(module_name, fromlist=["get_pipeline_cache_inputs"])
+    if not hasattr(_imports, "get_pipeline_cache_inputs"):
+        return None
+    return _imports.get_pipeline_cache_inputs(**convert_struct(passed_args))
+
+
+def get_definition_cache_key(module_name, passed_args=None):
+    """Gets the key of a cached definition.
+
+    The key covers the arguments, the source of the pipeline package, the inputs the pipeline
+    resolves at build time and the DEFINITION_CACHE_ENV environment variables, so that a
+    change to any of them generates the definition again.
+    """
+    key = [
+        module_name,
+        passed_args or "",
+        get_source_hash(module_name),
+        get_pipeline_cache_inputs(module_name, passed_args),
+        {name: os.environ.get(name) for name in DEFINITION_CACHE_ENV},
+    ]
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def get_pipeline_definition(module_name, passed_args=None, cache_dir=DEFINITION_CACHE_DIR):
+    """Gets the name and definition of a pipeline, generated once per source and inputs.
+
+    Generating a definition builds sessions, looks up image URIs and uploads step code, so
+    the result is cached under `cache_dir` and reused by the next CLI of the same build, as
+    long as the key of get_definition_cache_key is unchanged.
+
+    Args:
+        module_name: The module name of your pipeline.
+        passed_args: Optional passed arguments that your pipeline may be templated by.
+        cache_dir: The directory of the cached definitions, or None to always generate them.
+
+    Returns:
+        A tuple of the pipeline name and its JSON definition.
+    """
+    if cache_dir is not None:
+        key = get_definition_cache_key(module_name, passed_args)
+        path = pathlib.Path(cache_dir) / f"{key}.json"
+        if path.exists():
+            cached = json.loads(path.read_text())
+            return cached["name"], cached["definition"]
+
+    pipeline = get_pipeline_driver(module_name, passed_args)
+    definition = pipeline.definition()
+    if cache_dir is not None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps({"name": pipeline.name, "definition": definition}))
+    return pipeline.name, definition
+
+
+def get_definition_hash(definition, tags=None, role_arn=None, description=None):
+    """Hashes what an upsert sets on a pipeline, independently of JSON key and tag order."""
+    tags = sorted(
+        (tag["Key"], tag["Value"]) for tag in tags or [] if tag["Key"] != DEFINITION_HASH_TAG_KEY
+    )
+    canonical = json.dumps(
+        [json.loads(definition), tags, role_arn, description], sort_keys=True, separators=(",", ":")
+    )
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def get_stored_definition_hash(sagemaker_client, pipeline_name):
+    """Gets the definition hash tagged on an existing pipeline, or None."""
+    try:
+        response = sagemaker_client.describe_pipeline(PipelineName=pipeline_name)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("ResourceNotFound", "ValidationException"):
+            return None
+        raise
+    definition_hash = None
+    paginator = sagemaker_client.get_paginator("list_tags")
+    for page in paginator.paginate(ResourceArn=response["PipelineArn"]):
+        for tag in page["Tags"]:
+            if tag["Key"] == DEFINITION_HASH_TAG_KEY:
+                definition_hash = tag["Value"]
+    return definition_hash
+
+
+def upsert_pipeline(
+    sagemaker_client, pipeline_name, definition, role_arn, description=None, tags=None
+):
+    """Creates or updates a pipeline, tagging it with the hash of its definition and tags.
+
+    Returns:
+        The response of the create or update call.
+    """
+    definition_hash = get_definition_hash(definition, tags, role_arn, description)
+    tags = [tag for tag in tags or [] if tag["Key"] != DEFINITION_HASH_TAG_KEY]
+    tags.append({"Key": DEFINITION_HASH_TAG_KEY, "Value": definition_hash})
+    request = {
+        "PipelineName": pipeline_name,
+        "PipelineDefinition": definition,
+        "RoleArn": role_arn,
+    }
+    if description is not None:
+        request["PipelineDescription"] = description
+    try:
+        return sagemaker_client.create_pipeline(**request, Tags=tags)
+    except ClientError as e:
+        error = e.response["Error"]
+        if not (
+            error["Code"] == "ValidationException"
+            and "Pipeline names must be unique within" in error["Message"]
+        ):
+            raise
+        response = sagemaker_client.update_pipeline(**request)
+        sagemaker_client.add_tags(ResourceArn=response["PipelineArn"], Tags=tags)
+        return response
+
+
 def get_pipeline_custom_tags(module_name, args, tags):
     """Gets the custom tags for pipeline
 
@@ -49,3 +303,158 @@ def get_pipeline_custom_tags(module_name, args, tags):
     except Exception as e:
         print(f"Error getting project tags: {e}")
     return tags
+
+
+def get_step_job(step):
+    """Gets the type and name of the job run by a pipeline execution step, or (None, None)."""
+    for job_type, metadata in step.get("Metadata", {}).items():
+        if job_type in STEP_JOB_TYPES and "Arn" in metadata:
+            return job_type, metadata["Arn"].split("/")[-1]
+    return None, None
+
+
+def tail_job_logs(logs_client, job_type, job_name, stop, delay=5):
+    """Prints the CloudWatch logs of a job as they arrive, until `stop` is set.
+
+    Every log stream of the job, one per instance, is read from its start and the
+    remaining events are printed once more after `stop` is set.
+    """
+    log_group = STEP_JOB_TYPES[job_type][0]
+    tokens = {}
+    while True:
+        stopping = stop.is_set()
+        try:
+            streams = logs_client.describe_log_streams(
+                logGroupName=log_group, logStreamNamePrefix=f"{job_name}/"
+            )["logStreams"]
+        except logs_client.exceptions.ResourceNotFoundException:
+            streams = []
+        for stream in streams:
+            stream_name = stream["logStreamName"]
+            while True:
+                kwargs = {"nextToken": tokens[stream_name]} if stream_name in tokens else {}
+                response = logs_client.get_log_events(
+                    logGroupName=log_group, logStreamName=stream_name, startFromHead=True, **kwargs
+                )
+                for event in response["events"]:
+                    print(f"[{stream_name}] {event['message']}")
+                if response["nextForwardToken"] == tokens.get(stream_name):
+                    break
+                tokens[stream_name] = response["nextForwardToken"]
+        if stopping:
+            return
+        stop.wait(delay)
+
+
+def get_step_durations(sagemaker_client, step):
+    """Gets how long a step waited for its job to start and how long it ran, in seconds.
+
+    The queued time of a step running a job ends when the job starts running on its
+    instances, so it includes instance provisioning and image download.
+    """
+    job_type, job_name = get_step_job(step)
+    start_time, end_time = step.get("StartTime"), step.get("EndTime")
+    running_since = start_time
+    if job_type is not None:
+        _, describe, name_argument, start_field = STEP_JOB_TYPES[job_type]
+        job = getattr(sagemaker_client, describe)(**{name_argument: job_name})
+        running_since = job.get(start_field, end_time)
+    durations = {
+        "StepName": step["StepName"],
+        "StepStatus": step["StepStatus"],
+        "JobName": job_name,
+        "QueuedSeconds": None,
+        "RunningSeconds": None,
+    }
+    if start_time is not None and running_since is not None:
+        durations["QueuedSeconds"] = (running_since - start_time).total_seconds()
+    if running_since is not None and end_time is not None:
+        durations["RunningSeconds"] = (end_time - running_since).total_seconds()
+    return durations
+
+
+def wait_for_execution(
+    sagemaker_client,
+    logs_client,
+    execution_arn,
+    timeout=7200,
+    min_delay=5,
+    max_delay=60,
+    summary_file=None,
+):
+    """Waits for a pipeline execution, printing its step transitions and job logs.
+
+    The steps are polled every `min_delay` seconds while they change, backing off up to
+    `max_delay` seconds while they do not. The wait ends as soon as a step fails, without
+    waiting for the steps still running.
+
+    Args:
+        sagemaker_client: The SageMaker client.
+        logs_client: The CloudWatch Logs client.
+        execution_arn: The ARN of the pipeline execution.
+        timeout: The maximum number of seconds to wait.
+        min_delay: The minimum number of seconds between polls.
+        max_delay: The maximum number of seconds between polls.
+        summary_file: Optional file to write the queued and running time of each step to.
+
+    Returns:
+        A tuple of the execution status, "Failed" if a step failed, and the execution steps.
+    """
+    deadline = time.monotonic() + timeout
+    paginator = sagemaker_client.get_paginator("list_pipeline_execution_steps")
+    statuses, tails = {}, {}
+    delay = min_delay
+    try:
+        while True:
+            status = sagemaker_client.describe_pipeline_execution(
+                PipelineExecutionArn=execution_arn
+            )["PipelineExecutionStatus"]
+            steps = [
+                step
+                for page in paginator.paginate(
+                    PipelineExecutionArn=execution_arn, SortOrder="Ascending"
+                )
+                for step in page["PipelineExecutionSteps"]
+            ]
+            changed = False
+            for step in steps:
+                name, step_status = step["StepName"], step["StepStatus"]
+                if statuses.get(name) != step_status:
+                    print(f"###### Step {name}: {step_status}")
+                    statuses[name], changed = step_status, True
+                job_type, job_name = get_step_job(step)
+                if job_type is not None and job_name not in tails:
+                    stop = threading.Event()
+                    thread = threading.Thread(
+                        target=tail_job_logs,
+                        args=(logs_client, job_type, job_name, stop),
+                        daemon=True,
+                    )
+                    thread.start()
+                    tails[job_name] = (stop, thread)
+                if step_status not in ("Starting", "Executing") and job_name in tails:
+                    tails[job_name][0].set()
+                if step_status == "Failed":
+                    print(f"###### Step {name} failed: {step.get('FailureReason')}")
+                    status = "Failed"
+            if status != "Executing":
+                break
+            if time.monotonic() > deadline:
+                print(f"###### Execution still running after {timeout} seconds")
+                break
+            delay = min_delay if changed else min(delay * 2, max_delay)
+            time.sleep(delay)
+    finally:
+        for stop, thread in tails.values():
+            stop.set()
+            thread.join()
+
+    if summary_file:
+        summary = {
+            "PipelineExecutionArn": execution_arn,
+            "PipelineExecutionStatus": status,
+            "Steps": [get_step_durations(sagemaker_client, step) for step in steps],
+        }
+        with open(summary_file, "w") as f:
+            json.dump(summary, f, indent=2)
+    return status, steps
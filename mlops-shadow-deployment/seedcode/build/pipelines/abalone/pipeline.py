@@ -6,14 +6,17 @@
                                               .
                                                . -(stop)
 
-Implements a get_pipeline(**kwargs) method.
+Implements a get_pipeline(**kwargs) method, and a get_local_pipeline(**kwargs) method
+running the same chain of scripts on synthetic data without AWS.
 """
+import hashlib
 import os
 
 import boto3
 import sagemaker
 import sagemaker.session
 
+from botocore.exceptions import BotoCoreError, ClientError
 from sagemaker.estimator import Estimator
 from sagemaker.inputs import TrainingInput
 from sagemaker.model_metrics import (
@@ -26,12 +29,19 @@ from sagemaker.processing import (
     ScriptProcessor,
 )
 from sagemaker.sklearn.processing import SKLearnProcessor
+from sagemaker.tuner import (
+    ContinuousParameter,
+    HyperparameterTuner,
+    IntegerParameter,
+)
 from sagemaker.workflow.conditions import ConditionLessThanOrEqualTo
 from sagemaker.workflow.condition_step import (
     ConditionStep,
 )
+from sagemaker.workflow.execution_variables import ExecutionVariables
 from sagemaker.workflow.functions import (
     JsonGet,
+    Join,
 )
 from sagemaker.workflow.parameters import (
     ParameterInteger,
@@ -40,8 +50,10 @@ from sagemaker.workflow.parameters import (
 from sagemaker.workflow.pipeline import Pipeline
 from sagemaker.workflow.properties import PropertyFile
 from sagemaker.workflow.steps import (
+    CacheConfig,
     ProcessingStep,
     TrainingStep,
+    TuningStep,
 )
 from sagemaker.workflow.model_step import ModelStep
 from sagemaker.model import Model
@@ -50,6 +62,43 @@ from sagemaker.workflow.pipeline_context import PipelineSession
 
 BASE_DIR = os.path.dirname(os.path.realpath(__file__))
 
+# Default value of the InputDataUrl parameter.
+DEFAULT_INPUT_DATA_URL = (
+    "s3://sagemaker-servicecatalog-seedcode-{region}/dataset/abalone-dataset.csv"
+)
+
+# Training content type and default training input mode of each preprocessing output format.
+OUTPUT_FORMATS = {
+    "csv": ("text/csv", "File"),
+    "parquet": ("application/x-parquet", "FastFile"),
+    "recordio-protobuf": ("application/x-recordio-protobuf", "Pipe"),
+}
+
+# Hyperparameters of the training step.
+HYPERPARAMETERS = {
+    "objective": "reg:linear",
+    "num_round": 50,
+    "max_depth": 5,
+    "eta": 0.2,
+    "gamma": 4,
+    "min_child_weight": 6,
+    "subsample": 0.7,
+    "silent": 0,
+}
+
+# Highest mse of the models registered by the condition step.
+MSE_THRESHOLD = 6.0
+
+# Search space of the optional hyperparameter tuning step, around the default hyperparameters.
+HYPERPARAMETER_RANGES = {
+    "eta": ContinuousParameter(0.05, 0.5),
+    "max_depth": IntegerParameter(3, 10),
+    "gamma": ContinuousParameter(0, 10),
+    "min_child_weight": ContinuousParameter(1, 10),
+    "subsample": ContinuousParameter(0.5, 1),
+}
+
+
 def get_sagemaker_client(region):
      """Gets the sagemaker client.
 
@@ -120,6 +169,46 @@ def get_pipeline_custom_tags(new_tags, region, sagemaker_project_arn=None):
     return new_tags
 
 
+def get_code_hash(path):
+    """Gets the SHA-256 of a step's code file.
+
+    The hash is passed to the step so that editing the code changes the step's cache key.
+    """
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def get_object_etag(s3_uri, sagemaker_session):
+    """Gets the ETag of an S3 object, or an empty string if it cannot be read.
+
+    The ETag identifies the content of the default input data, so that replacing the data
+    in place changes the cache key of the steps reading it. Prefixes have no ETag.
+    """
+    bucket, _, key = s3_uri[len("s3://"):].partition("/")
+    try:
+        s3_client = sagemaker_session.boto_session.client("s3")
+        response = s3_client.head_object(Bucket=bucket, Key=key)
+    except (BotoCoreError, ClientError) as e:
+        print(f"Error getting the ETag of {s3_uri}: {e}")
+        return ""
+    return response["ETag"].strip('"')
+
+
+def get_pipeline_cache_inputs(region, default_bucket=None, **kwargs):
+    """Gets the inputs get_pipeline resolves at build time, which key its cached definition.
+
+    Args:
+        region: AWS region to create and run the pipeline.
+        default_bucket: the bucket to use for storing the artifacts
+
+    Returns:
+        the ETag of the default input data
+    """
+    sagemaker_session = get_session(region, default_bucket)
+    input_data_url = DEFAULT_INPUT_DATA_URL.format(region=region)
+    return {"input_etag": get_object_etag(input_data_url, sagemaker_session)}
+
+
 def get_pipeline(
     region,
     sagemaker_project_arn=None,
@@ -130,6 +219,15 @@ def get_pipeline(
     base_job_prefix="Abalone",
     processing_instance_type="ml.m5.xlarge",
     training_instance_type="ml.m5.xlarge",
+    preprocessing_mode="in-memory",
+    output_format="csv",
+    training_input_mode=None,
+    cache_preprocessor=True,
+    champion_mse_ratio=None,
+    cache_expire_after="P30D",
+    tuning_max_jobs=None,
+    tuning_max_parallel_jobs=3,
+    tuning_strategy="Bayesian",
 ):
     """Gets a SageMaker ML Pipeline instance working with on abalone data.
 
@@ -137,6 +235,26 @@ def get_pipeline(
         region: AWS region to create and run the pipeline.
         role: IAM role to create and run steps and pipeline.
         default_bucket: the bucket to use for storing the artifacts
+        preprocessing_mode: "in-memory" to fit the transformers on the whole dataset,
+            "streaming" to preprocess it in chunks with bounded memory, or "sharded" to
+            spread the objects under InputDataUrl over ProcessingInstanceCount instances
+        output_format: the format of the train, validation and test splits, one of
+            OUTPUT_FORMATS
+        training_input_mode: overrides the training input mode of the output format
+        cache_preprocessor: whether to reuse the preprocessor fitted on the same input data
+            and code, cached under the default bucket
+        champion_mse_ratio: when set, the evaluation also scores the latest approved model
+            package of the group and the new model is only registered if its mse is at most
+            this ratio of the champion mse
+        cache_expire_after: ISO 8601 duration for which the results of a step are reused by
+            executions with the same step arguments, code and input data, or None to disable
+            step caching
+        tuning_max_jobs: when set, the model is trained by a hyperparameter tuning job over
+            HYPERPARAMETER_RANGES running this many training jobs, and the best one is evaluated
+            and registered
+        tuning_max_parallel_jobs: the number of training jobs the tuning job runs in parallel
+        tuning_strategy: "Bayesian", which stops unpromising training jobs early, or
+            "Hyperband", which allocates training rounds to the best training jobs
 
     Returns:
         an instance of a pipeline
@@ -149,14 +267,26 @@ def get_pipeline(
 
     # parameters for pipeline execution
     processing_instance_count = ParameterInteger(name="ProcessingInstanceCount", default_value=1)
+    training_instance_count = ParameterInteger(name="TrainingInstanceCount", default_value=1)
     model_approval_status = ParameterString(
         name="ModelApprovalStatus", default_value="PendingManualApproval"
     )
     input_data = ParameterString(
         name="InputDataUrl",
-        default_value=f"s3://sagemaker-servicecatalog-seedcode-{region}/dataset/abalone-dataset.csv",
+        default_value=DEFAULT_INPUT_DATA_URL.format(region=region),
     )
 
+    # steps are cached on their arguments, which include the hash of their code and the ETag
+    # of the default input data
+    cache_config = CacheConfig(
+        enable_caching=cache_expire_after is not None, expire_after=cache_expire_after
+    )
+    input_etag = get_object_etag(input_data.default_value, sagemaker_session)
+    # processing jobs are named after the hash of their code, as the SDK does for steps
+    # given a processor, so that the code and output URIs do not change with every upsert
+    preprocessing_code_hash = get_code_hash(os.path.join(BASE_DIR, "preprocess.py"))
+    evaluation_code_hash = get_code_hash(os.path.join(BASE_DIR, "evaluate.py"))
+
     # processing step for feature engineering
     sklearn_processor = SKLearnProcessor(
         framework_version="0.23-1",
@@ -165,22 +295,74 @@ def get_pipeline(
         base_job_name=f"{base_job_prefix}/sklearn-abalone-preprocess",
         sagemaker_session=pipeline_session,
         role=role,
+        env={
+            "CODE_SHA256": preprocessing_code_hash,
+            "INPUT_ETAG": input_etag,
+        },
     )
+    preprocessing_steps = []
+    preprocessing_inputs = []
+    preprocessing_arguments = ["--input-data", input_data, "--mode", preprocessing_mode]
+    preprocessing_arguments += ["--output-format", output_format]
+    if cache_preprocessor:
+        cache_uri = f"s3://{sagemaker_session.default_bucket()}/{base_job_prefix}/PreprocessorCache"
+        preprocessing_arguments += ["--cache-uri", cache_uri]
+    if preprocessing_mode == "sharded":
+        # each instance reads a disjoint subset of the objects under InputDataUrl; the
+        # statistics step writes per-host partial statistics that every instance of the
+        # preprocessing step merges before transforming its own shard
+        sharded_input = ProcessingInput(
+            source=input_data,
+            destination="/opt/ml/processing/data",
+            s3_data_distribution_type="ShardedByS3Key",
+        )
+        step_args = sklearn_processor.run(
+            inputs=[sharded_input],
+            outputs=[
+                ProcessingOutput(output_name="statistics", source="/opt/ml/processing/statistics"),
+            ],
+            code=os.path.join(BASE_DIR, "preprocess.py"),
+            arguments=["--mode", "statistics"],
+            job_name=f"{base_job_prefix}/ComputeAbaloneStatistics-{preprocessing_code_hash}",
+        )
+        step_statistics = ProcessingStep(
+            name="ComputeAbaloneStatistics",
+            step_args=step_args,
+            cache_config=cache_config,
+        )
+        preprocessing_steps.append(step_statistics)
+        preprocessing_inputs = [
+            sharded_input,
+            ProcessingInput(
+                source=step_statistics.properties.ProcessingOutputConfig.Outputs[
+                    "statistics"
+                ].S3Output.S3Uri,
+                destination="/opt/ml/processing/statistics",
+            ),
+        ]
+        preprocessing_arguments = ["--mode", "transform", "--output-format", output_format]
+    # one file per training instance and split, read by distributed training as an equal shard
+    preprocessing_arguments += ["--output-parts", training_instance_count.to_string()]
     step_args = sklearn_processor.run(
+        inputs=preprocessing_inputs,
         outputs=[
             ProcessingOutput(output_name="train", source="/opt/ml/processing/train"),
             ProcessingOutput(output_name="validation", source="/opt/ml/processing/validation"),
             ProcessingOutput(output_name="test", source="/opt/ml/processing/test"),
         ],
         code=os.path.join(BASE_DIR, "preprocess.py"),
-        arguments=["--input-data", input_data],
+        arguments=preprocessing_arguments,
+        job_name=f"{base_job_prefix}/PreprocessAbaloneData-{preprocessing_code_hash}",
     )
     step_process = ProcessingStep(
         name="PreprocessAbaloneData",
         step_args=step_args,
+        cache_config=cache_config,
     )
 
     # training step for generating model artifacts
+    content_type, default_input_mode = OUTPUT_FORMATS[output_format]
+    training_input_mode = training_input_mode or default_input_mode
     model_path = f"s3://{sagemaker_session.default_bucket()}/{base_job_prefix}/AbaloneTrain"
     image_uri = sagemaker.image_uris.retrieve(
         framework="xgboost",
@@ -192,44 +374,70 @@ def get_pipeline(
     xgb_train = Estimator(
         image_uri=image_uri,
         instance_type=training_instance_type,
-        instance_count=1,
+        instance_count=training_instance_count,
         output_path=model_path,
         base_job_name=f"{base_job_prefix}/abalone-train",
         sagemaker_session=pipeline_session,
         role=role,
+        # the default profiler rule is named after the current time
+        disable_profiler=True,
     )
-    xgb_train.set_hyperparameters(
-        objective="reg:linear",
-        num_round=50,
-        max_depth=5,
-        eta=0.2,
-        gamma=4,
-        min_child_weight=6,
-        subsample=0.7,
-        silent=0,
-    )
-    step_args = xgb_train.fit(
-        inputs={
-            "train": TrainingInput(
-                s3_data=step_process.properties.ProcessingOutputConfig.Outputs[
-                    "train"
-                ].S3Output.S3Uri,
-                content_type="text/csv",
-            ),
-            "validation": TrainingInput(
-                s3_data=step_process.properties.ProcessingOutputConfig.Outputs[
-                    "validation"
-                ].S3Output.S3Uri,
-                content_type="text/csv",
-            ),
-        },
-    )
-    step_train = TrainingStep(
-        name="TrainAbaloneModel",
-        step_args=step_args,
-    )
+    xgb_train.set_hyperparameters(**HYPERPARAMETERS)
+    training_inputs = {
+        "train": TrainingInput(
+            s3_data=step_process.properties.ProcessingOutputConfig.Outputs[
+                "train"
+            ].S3Output.S3Uri,
+            content_type=content_type,
+            input_mode=training_input_mode,
+            distribution="ShardedByS3Key",
+        ),
+        "validation": TrainingInput(
+            s3_data=step_process.properties.ProcessingOutputConfig.Outputs[
+                "validation"
+            ].S3Output.S3Uri,
+            content_type=content_type,
+            input_mode=training_input_mode,
+            distribution="ShardedByS3Key",
+        ),
+    }
+    if tuning_max_jobs:
+        # Hyperband stops training jobs on its own, early stopping only applies to Bayesian search
+        tuner = HyperparameterTuner(
+            estimator=xgb_train,
+            objective_metric_name="validation:rmse",
+            objective_type="Minimize",
+            hyperparameter_ranges=HYPERPARAMETER_RANGES,
+            strategy=tuning_strategy,
+            max_jobs=tuning_max_jobs,
+            max_parallel_jobs=tuning_max_parallel_jobs,
+            early_stopping_type="Auto" if tuning_strategy == "Bayesian" else "Off",
+            base_tuning_job_name=f"{base_job_prefix}/abalone-tune",
+        )
+        step_args = tuner.fit(inputs=training_inputs)
+        step_train = TuningStep(
+            name="TuneAbaloneModel",
+            step_args=step_args,
+            cache_config=cache_config,
+        )
+        model_data = step_train.get_top_model_s3_uri(
+            top_k=0,
+            s3_bucket=sagemaker_session.default_bucket(),
+            prefix=f"{base_job_prefix}/AbaloneTrain",
+        )
+    else:
+        step_args = xgb_train.fit(inputs=training_inputs)
+        step_train = TrainingStep(
+            name="TrainAbaloneModel",
+            step_args=step_args,
+            cache_config=cache_config,
+        )
+        model_data = step_train.properties.ModelArtifacts.S3ModelArtifacts
 
     # processing step for evaluation
+    evaluation_arguments = None
+    if champion_mse_ratio is not None:
+        evaluation_arguments = ["--champion-model-package-group", model_package_group_name]
     script_eval = ScriptProcessor(
         image_uri=image_uri,
         command=["python3"],
@@ -238,11 +446,12 @@ def get_pipeline(
         base_job_name=f"{base_job_prefix}/script-abalone-eval",
         sagemaker_session=pipeline_session,
         role=role,
+        env={"CODE_SHA256": evaluation_code_hash},
     )
     step_args = script_eval.run(
         inputs=[
             ProcessingInput(
-                source=step_train.properties.ModelArtifacts.S3ModelArtifacts,
+                source=model_data,
                 destination="/opt/ml/processing/model",
             ),
             ProcessingInput(
@@ -253,9 +462,25 @@ def get_pipeline(
             ),
         ],
         outputs=[
-            ProcessingOutput(output_name="evaluation", source="/opt/ml/processing/evaluation"),
+            # the job name is the same for every execution, so the report of every execution,
+            # which the registered model package points to, is written under its execution id
+            ProcessingOutput(
+                output_name="evaluation",
+                source="/opt/ml/processing/evaluation",
+                destination=Join(
+                    on="/",
+                    values=[
+                        f"s3://{sagemaker_session.default_bucket()}/{base_job_prefix}",
+                        ExecutionVariables.PIPELINE_EXECUTION_ID,
+                        "EvaluateAbaloneModel",
+                        "evaluation",
+                    ],
+                ),
+            ),
         ],
         code=os.path.join(BASE_DIR, "evaluate.py"),
+        arguments=evaluation_arguments,
+        job_name=f"{base_job_prefix}/EvaluateAbaloneModel-{evaluation_code_hash}",
     )
     evaluation_report = PropertyFile(
         name="AbaloneEvaluationReport",
@@ -266,20 +491,28 @@ def get_pipeline(
         name="EvaluateAbaloneModel",
         step_args=step_args,
         property_files=[evaluation_report],
+        # the champion is resolved when the step runs, so a cached comparison may be stale
+        cache_config=cache_config if champion_mse_ratio is None else None,
     )
 
     # register model step that will be conditionally executed
     model_metrics = ModelMetrics(
         model_statistics=MetricsSource(
-            s3_uri="{}/evaluation.json".format(
-                step_eval.arguments["ProcessingOutputConfig"]["Outputs"][0]["S3Output"]["S3Uri"]
+            s3_uri=Join(
+                on="/",
+                values=[
+                    step_eval.properties.ProcessingOutputConfig.Outputs[
+                        "evaluation"
+                    ].S3Output.S3Uri,
+                    "evaluation.json",
+                ],
             ),
             content_type="application/json"
         )
     )
     model = Model(
         image_uri=image_uri,
-        model_data=step_train.properties.ModelArtifacts.S3ModelArtifacts,
+        model_data=model_data,
         sagemaker_session=pipeline_session,
         role=role,
     )
@@ -304,11 +537,23 @@ def get_pipeline(
             property_file=evaluation_report,
             json_path="regression_metrics.mse.value"
         ),
-        right=6.0,
+        right=MSE_THRESHOLD,
     )
+    conditions = [cond_lte]
+    if champion_mse_ratio is not None:
+        conditions.append(
+            ConditionLessThanOrEqualTo(
+                left=JsonGet(
+                    step_name=step_eval.name,
+                    property_file=evaluation_report,
+                    json_path="champion_challenger.mse_ratio",
+                ),
+                right=champion_mse_ratio,
+            )
+        )
     step_cond = ConditionStep(
         name="CheckMSEAbaloneEvaluation",
-        conditions=[cond_lte],
+        conditions=conditions,
         if_steps=[step_register],
         else_steps=[],
     )
@@ -320,10 +565,84 @@ def get_pipeline(
             processing_instance_type,
             processing_instance_count,
             training_instance_type,
+            training_instance_count,
             model_approval_status,
             input_data,
         ],
-        steps=[step_process, step_train, step_eval, step_cond],
+        steps=preprocessing_steps + [step_process, step_train, step_eval, step_cond],
         sagemaker_session=pipeline_session,
     )
     return pipeline
+
+
+def get_local_pipeline(
+    work_dir=".local-pipeline",
+    rows=10000,
+    preprocessing_mode="in-memory",
+    output_format="csv",
+    **kwargs,
+):
+    """Gets the steps of the pipeline as local functions over synthetic data.
+
+    The steps exchange their inputs and outputs through a directory standing in for S3,
+    laid out like the S3 URIs of the pipeline steps.
+
+    Args:
+        work_dir: the directory holding the synthetic data and the step outputs.
+        rows: the number of rows of the synthetic dataset.
+        preprocessing_mode: "in-memory" or "streaming", see get_pipeline.
+        output_format: the format of the train, validation and test splits, one of
+            OUTPUT_FORMATS
+
+    Returns:
+        a list of the name, function and keyword arguments of every step, in order
+    """
+    # the steps import the dependencies of the pipeline scripts, which the pipeline does not need
+    from pipelines.abalone import local
+
+    s3_dir = os.path.join(work_dir, "s3")
+    input_path = os.path.join(s3_dir, "dataset", "abalone-dataset.csv")
+    processing_dir = os.path.join(s3_dir, "PreprocessAbaloneData")
+    model_path = os.path.join(s3_dir, "AbaloneTrain", "model.tar.gz")
+    evaluation_dir = os.path.join(s3_dir, "EvaluateAbaloneModel")
+    return [
+        ("GenerateSyntheticData", local.generate_data, {"path": input_path, "rows": rows}),
+        (
+            "PreprocessAbaloneData",
+            local.preprocess_data,
+            {
+                "input_path": input_path,
+                "base_dir": processing_dir,
+                "preprocessing_mode": preprocessing_mode,
+                "output_format": output_format,
+            },
+        ),
+        (
+            "TrainAbaloneModel",
+            local.train_model,
+            {
+                "train_dir": os.path.join(processing_dir, "train"),
+                "validation_dir": os.path.join(processing_dir, "validation"),
+                "model_path": model_path,
+                "hyperparameters": HYPERPARAMETERS,
+            },
+        ),
+        (
+            "EvaluateAbaloneModel",
+            local.evaluate_model,
+            {
+                "model_path": model_path,
+                "test_dir": os.path.join(processing_dir, "test"),
+                "output_dir": evaluation_dir,
+                "cache_dir": os.path.join(work_dir, "model-cache"),
+            },
+        ),
+        (
+            "CheckMSEAbaloneEvaluation",
+            local.check_mse,
+            {
+                "evaluation_path": os.path.join(evaluation_dir, "evaluation.json"),
+                "mse_threshold": MSE_THRESHOLD,
+            },
+        ),
+    ]
@@ -1,14 +1,75 @@
 import argparse
-import json
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
 from botocore.exceptions import ClientError
 
+import model_registry
+from stage_config import get_stages, write_stage_configs
+
 logger = logging.getLogger(__name__)
 sm_client = boto3.client("sagemaker")
 
+VARIANT_TYPES = ["ProductionVariants", "ShadowProductionVariants"]
+
+
+def get_endpoint_topology(endpoint_name, max_workers=4):
+    """Gets the models of the production and shadow variants of an endpoint.
+
+    The endpoint is described directly, and the models of all its variants concurrently.
+
+    Args:
+        endpoint_name: The endpoint name.
+        max_workers: The maximum number of models described at a time.
+
+    Returns:
+        None when the endpoint does not exist, else its ProductionVariants and
+        ShadowProductionVariants, every variant with its VariantName, ModelName,
+        ModelPackageName, InstanceType and InitialInstanceCount.
+    """
+    try:
+        endpoint = sm_client.describe_endpoint(EndpointName=endpoint_name)
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ValidationException" and (
+            "Could not find endpoint" in e.response["Error"]["Message"]
+        ):
+            return None
+        raise
+    endpoint_config = sm_client.describe_endpoint_config(
+        EndpointConfigName=endpoint["EndpointConfigName"]
+    )
+    variants = [
+        (variant_type, variant)
+        for variant_type in VARIANT_TYPES
+        for variant in endpoint_config.get(variant_type, [])
+    ]
+
+    model_names = list(dict.fromkeys(variant["ModelName"] for _, variant in variants))
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(model_names)))) as executor:
+        models = dict(
+            zip(
+                model_names,
+                executor.map(lambda name: sm_client.describe_model(ModelName=name), model_names),
+            )
+        )
+
+    topology = {variant_type: [] for variant_type in VARIANT_TYPES}
+    for variant_type, variant in variants:
+        model = models[variant["ModelName"]]
+        container = (model.get("Containers") or [model.get("PrimaryContainer", {})])[0]
+        topology[variant_type].append(
+            {
+                "VariantName": variant["VariantName"],
+                "ModelName": variant["ModelName"],
+                "ModelPackageName": container.get("ModelPackageName"),
+                "InstanceType": variant.get("InstanceType"),
+                "InitialInstanceCount": variant.get("InitialInstanceCount"),
+            }
+        )
+    return topology
+
 
 def get_approved_package(model_package_group_name, sagemaker_project_name):
     """Gets the latest approved model package for a model package group.
@@ -21,46 +82,17 @@ def get_approved_package(model_package_group_name, sagemaker_project_name):
         The SageMaker Model Package ARN.
     """
     try:
-        # Get the latest approved model package
-        response = sm_client.list_model_packages(
-            ModelPackageGroupName=model_package_group_name,
-            ModelApprovalStatus="Approved",
-            SortBy="CreationTime",
-            MaxResults=100,
+        model_package_arn = model_registry.get_approved_package(
+            model_package_group_name, sm_client
         )
-        approved_packages = response["ModelPackageSummaryList"]
-
-        # Fetch more packages if none returned with continuation token
-        while len(approved_packages) == 0 and "NextToken" in response:
-            logger.debug("Getting more packages for token: {}".format(response["NextToken"]))
-            response = sm_client.list_model_packages(
-                ModelPackageGroupName=model_package_group_name,
-                ModelApprovalStatus="Approved",
-                SortBy="CreationTime",
-                MaxResults=100,
-                NextToken=response["NextToken"],
-            )
-            approved_packages.extend(response["ModelPackageSummaryList"])
 
-        # Return error if no packages found
-        if len(approved_packages) == 0:
-            error_message = (
-                f"No approved ModelPackage found for ModelPackageGroup: {model_package_group_name}"
-            )
-            logger.error(error_message)
-            raise Exception(error_message)
-
-        # Return the pmodel package arn
-        model_package_arn = approved_packages[0]["ModelPackageArn"]
-        logger.info(f"Identified the latest approved model package: {model_package_arn}")
-        
         # find the current prod model to use for shadow testing
         prod_endpoint_name = f'{sagemaker_project_name}-prod'
-        if prod_endpoint_name in [i['EndpointName'] for i in sm_client.list_endpoints()['Endpoints']]:
-            logger.info('production endpoint exists')
-            conf = sm_client.describe_endpoint(EndpointName=prod_endpoint_name)['EndpointConfigName']
-            model = sm_client.describe_endpoint_config(EndpointConfigName=conf)['ProductionVariants'][0]['ModelName']
-            current_prod_model = sm_client.describe_model(ModelName=model)['Containers'][0]['ModelPackageName']
+        topology = get_endpoint_topology(prod_endpoint_name)
+        production_variants = topology["ProductionVariants"] if topology else []
+        if production_variants and production_variants[0]["ModelPackageName"]:
+            logger.info(f'production endpoint exists: {topology}')
+            current_prod_model = production_variants[0]["ModelPackageName"]
         else:
             current_prod_model = model_package_arn
             logger.info('production endpoint not in existence')
@@ -73,7 +105,7 @@ def get_approved_package(model_package_group_name, sagemaker_project_name):
         raise Exception(error_message)
 
 
-def extend_config(args, model_package_arn, current_prod_model, stage_config):
+def extend_config(args, model_package_arn, current_prod_model, stage_config, project_tags):
     """
     Extend the stage configuration with additional parameters and tags based.
     """
@@ -96,7 +128,7 @@ def extend_config(args, model_package_arn, current_prod_model, stage_config):
         "sagemaker:project-name": args.sagemaker_project_name,
     }
     # Add tags from Project
-    get_pipeline_custom_tags(args, sm_client, new_tags)
+    new_tags.update(project_tags)
 
     return {
         "Parameters": {**stage_config["Parameters"], **new_params},
@@ -114,31 +146,6 @@ def get_pipeline_custom_tags(args, sm_client, new_tags):
         logger.error("Error getting project tags")
     return new_tags
 
-def get_cfn_style_config(stage_config):
-    parameters = []
-    for key, value in stage_config["Parameters"].items():
-        parameter = {
-            "ParameterKey": key,
-            "ParameterValue": value
-        }
-        parameters.append(parameter)
-    tags = []
-    for key, value in stage_config["Tags"].items():
-        tag = {
-            "Key": key,
-            "Value": value
-        }
-        tags.append(tag)
-    return parameters, tags
-
-def create_cfn_params_tags_file(config, export_params_file, export_tags_file):
-    # Write Params and tags in separate file for Cfn cli command
-    parameters, tags = get_cfn_style_config(config)
-    with open(export_params_file, "w") as f:
-        json.dump(parameters, f, indent=4)
-    with open(export_tags_file, "w") as f:
-        json.dump(tags, f, indent=4)
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--log-level", type=str, default=os.environ.get("LOGLEVEL", "INFO").upper())
@@ -175,30 +182,14 @@ if __name__ == "__main__":
     # Get the latest approved package
     model_package_arn, current_prod_model = get_approved_package(args.model_package_group_name, args.sagemaker_project_name)
 
-    # Write the staging config
-    with open(args.import_staging_config, "r") as f:
-        staging_config = extend_config(args, model_package_arn, current_prod_model, json.load(f))
-    logger.debug("Staging config: {}".format(json.dumps(staging_config, indent=4)))
-    with open(args.export_staging_config, "w") as f:
-        json.dump(staging_config, f, indent=4)
-    if (args.export_cfn_params_tags):
-        create_cfn_params_tags_file(staging_config, args.export_staging_params, args.export_staging_tags)
-      
-    # Write the shadow config
-    with open(args.import_shadow_config, "r") as f:
-        shadow_config = extend_config(args, model_package_arn, current_prod_model, json.load(f))
-    logger.debug("Shadow config: {}".format(json.dumps(shadow_config, indent=4)))
-    with open(args.export_shadow_config, "w") as f:
-        json.dump(shadow_config, f, indent=4)
-    if (args.export_cfn_params_tags):
-        create_cfn_params_tags_file(shadow_config, args.export_shadow_params, args.export_shadow_tags)
-
-    # Write the prod config for code pipeline
-    with open(args.import_prod_config, "r") as f:
-        prod_config = extend_config(args, model_package_arn, current_prod_model, json.load(f))
-    logger.debug("Prod config: {}".format(json.dumps(prod_config, indent=4)))
-    with open(args.export_prod_config, "w") as f:
-        json.dump(prod_config, f, indent=4)
-    if (args.export_cfn_params_tags):
-        create_cfn_params_tags_file(prod_config, args.export_prod_params, args.export_prod_tags)
-
+    # Get the project tags once for every stage
+    project_tags = get_pipeline_custom_tags(args, sm_client, {})
+
+    # Write the config of every stage
+    write_stage_configs(
+        get_stages(args, ["staging", "shadow", "prod"]),
+        lambda stage_config: extend_config(
+            args, model_package_arn, current_prod_model, stage_config, project_tags
+        ),
+        args.export_cfn_params_tags,
+    )
@@ -0,0 +1,330 @@
+"""Compares the shadow variant of an endpoint with its production variant.
+
+The data captured for both variants since the endpoint was last updated is read from S3, the
+records are joined on their event id and the predictions of the variants compared, while the
+latency and error metrics of every variant are read from CloudWatch. The resulting promotion
+report tells whether the shadow model meets the thresholds to be promoted.
+
+Runs in the deploy test stage from test.py, or as the script of a SageMaker Processing job
+writing its report to /opt/ml/processing/output.
+"""
+import argparse
+import base64
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse
+
+import boto3
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+REPORT_FILE = "shadow-comparison-report.json"
+LATENCY_PERCENTILES = ["p50", "p90", "p99"]
+ERROR_METRICS = ["Invocation4XXErrors", "Invocation5XXErrors"]
+
+
+def get_shadow_topology(sm_client, endpoint_name):
+    """Gets the production and shadow variant names and the data capture uri of an endpoint."""
+    endpoint = sm_client.describe_endpoint(EndpointName=endpoint_name)
+    endpoint_config = sm_client.describe_endpoint_config(
+        EndpointConfigName=endpoint["EndpointConfigName"]
+    )
+    shadow_variants = endpoint_config.get("ShadowProductionVariants", [])
+    if not shadow_variants:
+        raise Exception(f"SageMaker endpoint: {endpoint_name} has no shadow variant")
+    capture_config = endpoint_config.get("DataCaptureConfig", {})
+    if not capture_config.get("EnableCapture"):
+        raise Exception(f"SageMaker endpoint: {endpoint_name} has no data capture enabled")
+    return {
+        "production_variant": endpoint_config["ProductionVariants"][0]["VariantName"],
+        "shadow_variant": shadow_variants[0]["VariantName"],
+        "capture_uri": capture_config["DestinationS3Uri"],
+        "last_modified": endpoint["LastModifiedTime"],
+    }
+
+
+def get_hour_prefixes(capture_uri, endpoint_name, variant_name, start, end):
+    """Gets the hourly capture prefixes, <endpoint>/<variant>/yyyy/mm/dd/hh/, of a time window."""
+    parsed = urlparse(capture_uri)
+    base = "/".join(p for p in [parsed.path.strip("/"), endpoint_name, variant_name] if p)
+    hour = start.replace(minute=0, second=0, microsecond=0)
+    prefixes = []
+    while hour <= end:
+        prefixes.append(f"{base}/{hour:%Y/%m/%d/%H}/")
+        hour += timedelta(hours=1)
+    return parsed.netloc, prefixes
+
+
+def list_capture_files(s3_client, bucket, prefixes, executor):
+    """Lists the capture files under the prefixes concurrently."""
+
+    def list_prefix(prefix):
+        paginator = s3_client.get_paginator("list_objects_v2")
+        return [
+            content["Key"]
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+            for content in page.get("Contents", [])
+        ]
+
+    return [key for keys in executor.map(list_prefix, prefixes) for key in keys]
+
+
+def parse_output(output):
+    """Parses the captured output of a record into an array of predictions, None if not numeric."""
+    data = output.get("data", "")
+    if output.get("encoding") == "BASE64":
+        data = base64.b64decode(data).decode("utf-8")
+    try:
+        return np.array(data.replace("\n", ",").strip(",").split(","), dtype=float)
+    except ValueError:
+        return None
+
+
+def read_capture_file(s3_client, bucket, key, start):
+    """Reads the predictions of the records of a capture file since start, by event id."""
+    body = s3_client.get_object(Bucket=bucket, Key=key)["Body"]
+    records = {}
+    for line in body.iter_lines():
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        metadata = record["eventMetadata"]
+        inference_time = datetime.strptime(
+            metadata["inferenceTime"][:19], "%Y-%m-%dT%H:%M:%S"
+        ).replace(tzinfo=timezone.utc)
+        if inference_time >= start:
+            records[metadata["eventId"]] = parse_output(record["captureData"]["endpointOutput"])
+    return records
+
+
+def read_captures(s3_client, bucket, prefixes, start, max_workers=16):
+    """Reads the predictions of the records captured under the prefixes, by event id."""
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        keys = list_capture_files(s3_client, bucket, prefixes, executor)
+        records = {}
+        for file_records in executor.map(
+            lambda key: read_capture_file(s3_client, bucket, key, start), keys
+        ):
+            records.update(file_records)
+    logger.info(f"Read {len(records)} captured records from {len(keys)} files")
+    return records
+
+
+def compare_predictions(production, shadow, tolerance):
+    """Compares the predictions of the records captured for both variants.
+
+    Args:
+        production: The predictions of the production variant by event id.
+        shadow: The predictions of the shadow variant by event id.
+        tolerance: The absolute delta within which two predictions agree.
+
+    Returns:
+        The statistics of the shadow minus production prediction deltas.
+    """
+    event_ids = sorted(production.keys() & shadow.keys())
+    pairs = [
+        (production[event_id], shadow[event_id])
+        for event_id in event_ids
+        if production[event_id] is not None
+        and shadow[event_id] is not None
+        and production[event_id].shape == shadow[event_id].shape
+    ]
+    comparison = {
+        "production_records": len(production),
+        "shadow_records": len(shadow),
+        "matched_records": len(event_ids),
+        "compared_records": len(pairs),
+    }
+    if not pairs:
+        return comparison
+    deltas = np.concatenate([s - p for p, s in pairs])
+    abs_deltas = np.abs(deltas)
+    comparison.update(
+        {
+            "predictions": int(deltas.size),
+            "mean_delta": float(deltas.mean()),
+            "mean_abs_delta": float(abs_deltas.mean()),
+            "p99_abs_delta": float(np.percentile(abs_deltas, 99)),
+            "max_abs_delta": float(abs_deltas.max()),
+            "rmse": float(np.sqrt(np.mean(deltas**2))),
+            "within_tolerance": float(np.mean(abs_deltas <= tolerance)),
+        }
+    )
+    return comparison
+
+
+def get_variant_metrics(cw_client, endpoint_name, variant_names, start, end):
+    """Gets the latency percentiles in milliseconds, invocations and errors of every variant."""
+    period = max(60, int((end - start).total_seconds()) // 60 * 60)
+    queries = []
+    labels = {}
+    for i, variant_name in enumerate(variant_names):
+        dimensions = [
+            {"Name": "EndpointName", "Value": endpoint_name},
+            {"Name": "VariantName", "Value": variant_name},
+        ]
+        metric_stats = [("ModelLatency", p) for p in LATENCY_PERCENTILES]
+        metric_stats += [(m, "Sum") for m in ["Invocations"] + ERROR_METRICS]
+        for metric_name, stat in metric_stats:
+            query_id = f"v{i}_{metric_name.lower()}_{stat.lower()}"
+            labels[query_id] = f"{variant_name}/{metric_name}/{stat}"
+            queries.append(
+                {
+                    "Id": query_id,
+                    "MetricStat": {
+                        "Metric": {
+                            "Namespace": "AWS/SageMaker",
+                            "MetricName": metric_name,
+                            "Dimensions": dimensions,
+                        },
+                        "Period": period,
+                        "Stat": stat,
+                    },
+                }
+            )
+    values = {}
+    paginator = cw_client.get_paginator("get_metric_data")
+    for page in paginator.paginate(MetricDataQueries=queries, StartTime=start, EndTime=end):
+        for result in page["MetricDataResults"]:
+            values.setdefault(labels[result["Id"]], []).extend(result["Values"])
+
+    metrics = {}
+    for variant_name in variant_names:
+        # ModelLatency is in microseconds, and the highest percentile of the periods is kept
+        latency = {
+            p: max(values.get(f"{variant_name}/ModelLatency/{p}", []), default=None)
+            for p in LATENCY_PERCENTILES
+        }
+        invocations = sum(values.get(f"{variant_name}/Invocations/Sum", []))
+        errors = sum(sum(values.get(f"{variant_name}/{m}/Sum", [])) for m in ERROR_METRICS)
+        metrics[variant_name] = {
+            "latency_ms": {p: v / 1000 if v is not None else None for p, v in latency.items()},
+            "invocations": invocations,
+            "errors": errors,
+            "error_rate": errors / invocations if invocations else None,
+        }
+    return metrics
+
+
+def check(value, threshold, passed):
+    return {"value": value, "threshold": threshold, "passed": bool(passed)}
+
+
+def get_checks(comparison, metrics, production_variant, shadow_variant, args):
+    """Checks the comparison against the promotion thresholds, skipping the unset ones."""
+    production, shadow = metrics[production_variant], metrics[shadow_variant]
+    checks = {
+        "min_records": check(
+            comparison["compared_records"],
+            args.min_records,
+            comparison["compared_records"] >= args.min_records,
+        )
+    }
+    if args.max_mean_abs_delta is not None and "mean_abs_delta" in comparison:
+        checks["max_mean_abs_delta"] = check(
+            comparison["mean_abs_delta"],
+            args.max_mean_abs_delta,
+            comparison["mean_abs_delta"] <= args.max_mean_abs_delta,
+        )
+    production_p99 = production["latency_ms"]["p99"]
+    shadow_p99 = shadow["latency_ms"]["p99"]
+    if args.max_latency_ratio is not None and production_p99 and shadow_p99 is not None:
+        checks["max_p99_latency_ratio"] = check(
+            shadow_p99 / production_p99,
+            args.max_latency_ratio,
+            shadow_p99 / production_p99 <= args.max_latency_ratio,
+        )
+    if args.max_shadow_error_rate is not None and shadow["error_rate"] is not None:
+        checks["max_shadow_error_rate"] = check(
+            shadow["error_rate"],
+            args.max_shadow_error_rate,
+            shadow["error_rate"] <= args.max_shadow_error_rate,
+        )
+    return checks
+
+
+def compare_shadow(endpoint_name, args, session=None):
+    """Compares the shadow variant of an endpoint with its production variant.
+
+    Args:
+        endpoint_name: The endpoint name.
+        args: The parsed thresholds, as added to a parser by add_arguments.
+        session: The boto3 session, the default one when None.
+
+    Returns:
+        The promotion report.
+    """
+    session = session or boto3.Session()
+    s3_client = session.client("s3")
+    topology = get_shadow_topology(session.client("sagemaker"), endpoint_name)
+    production_variant = topology["production_variant"]
+    shadow_variant = topology["shadow_variant"]
+    end = datetime.now(timezone.utc)
+    start = max(topology["last_modified"], end - timedelta(hours=args.max_hours))
+    logger.info(
+        f"Comparing {shadow_variant} with {production_variant} of {endpoint_name} since {start}"
+    )
+
+    captures = {}
+    for variant_name in [production_variant, shadow_variant]:
+        bucket, prefixes = get_hour_prefixes(
+            topology["capture_uri"], endpoint_name, variant_name, start, end
+        )
+        captures[variant_name] = read_captures(s3_client, bucket, prefixes, start)
+    comparison = compare_predictions(
+        captures[production_variant], captures[shadow_variant], args.tolerance
+    )
+    metrics = get_variant_metrics(
+        session.client("cloudwatch"),
+        endpoint_name,
+        [production_variant, shadow_variant],
+        start,
+        end,
+    )
+    checks = get_checks(comparison, metrics, production_variant, shadow_variant, args)
+    return {
+        "endpoint_name": endpoint_name,
+        "production_variant": production_variant,
+        "shadow_variant": shadow_variant,
+        "start_time": start.isoformat(),
+        "end_time": end.isoformat(),
+        "comparison": comparison,
+        "variants": metrics,
+        "checks": checks,
+        "promote": all(c["passed"] for c in checks.values()),
+    }
+
+
+def add_arguments(parser):
+    """Adds the comparison thresholds to an argument parser."""
+    parser.add_argument("--max-hours", type=float, default=24)
+    parser.add_argument("--tolerance", type=float, default=0.5)
+    # The comparison runs right after the shadow deployment, before the shadow variant has
+    # received any traffic, so no minimum is required unless set
+    parser.add_argument("--min-records", type=int, default=0)
+    parser.add_argument("--max-mean-abs-delta", type=float, default=None)
+    parser.add_argument("--max-latency-ratio", type=float, default=1.2)
+    # Distinct from the --max-error-rate of the load test, which test.py adds to the same parser
+    parser.add_argument("--max-shadow-error-rate", type=float, default=0.01)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--log-level", type=str, default=os.environ.get("LOGLEVEL", "INFO").upper())
+    parser.add_argument("--endpoint-name", type=str, required=True)
+    parser.add_argument("--output-dir", type=str, default="/opt/ml/processing/output")
+    add_arguments(parser)
+    args, _ = parser.parse_known_args()
+
+    log_format = "%(levelname)s: [%(filename)s:%(lineno)s] %(message)s"
+    logging.basicConfig(format=log_format, level=args.log_level)
+
+    report = compare_shadow(args.endpoint_name, args)
+    os.makedirs(args.output_dir, exist_ok=True)
+    with open(os.path.join(args.output_dir, REPORT_FILE), "w") as f:
+        json.dump(report, f, indent=4)
+    logger.info(json.dumps(report["checks"], indent=4))
@@ -6,18 +6,27 @@ import os
 import boto3
 from botocore.exceptions import ClientError
 
+import compare_shadow
+from load_test import add_arguments, load_test
+
 logger = logging.getLogger(__name__)
 sm_client = boto3.client("sagemaker")
 
 
-def invoke_endpoint(endpoint_name):
+def invoke_endpoint(endpoint_name, args):
     """
-    Add custom logic here to invoke the endpoint and validate reponse
+    Load test the endpoint with the sample payload and check the results against the SLOs
     """
-    return {"endpoint_name": endpoint_name, "success": True}
+    if not args.payload_file or not os.path.exists(args.payload_file):
+        logger.warning(f"No sample payload: {args.payload_file}, skipping the load test")
+        return {"endpoint_name": endpoint_name, "success": True}
+
+    results = load_test(endpoint_name, args)
+    logger.info(f"Load test results: {json.dumps(results, indent=4)}")
+    return {"endpoint_name": endpoint_name, "load_test": results, "success": results["success"]}
 
 
-def test_endpoint(endpoint_name):
+def test_endpoint(endpoint_name, args):
     """
     Describe the endpoint and ensure InSerivce, then invoke endpoint.  Raises exception on error.
     """
@@ -38,19 +47,28 @@ def test_endpoint(endpoint_name):
             logger.info(f"data capture enabled for endpoint config {endpoint_config_name}")
 
         # Call endpoint to handle
-        return invoke_endpoint(endpoint_name)
+        return invoke_endpoint(endpoint_name, args)
     except ClientError as e:
         error_message = e.response["Error"]["Message"]
         logger.error(error_message)
         raise Exception(error_message)
 
 
-if __name__ == "__main__":
+def get_parser():
+    """
+    Get the parser of the test options, load test SLOs and shadow promotion thresholds
+    """
     parser = argparse.ArgumentParser()
     parser.add_argument("--log-level", type=str, default=os.environ.get("LOGLEVEL", "INFO").upper())
     parser.add_argument("--import-build-config", type=str, required=True)
     parser.add_argument("--export-test-results", type=str, required=True)
-    args, _ = parser.parse_known_args()
+    compare_shadow.add_arguments(parser)
+    add_arguments(parser, payload_file="test/sample-payload.csv")
+    return parser
+
+
+if __name__ == "__main__":
+    args, _ = get_parser().parse_known_args()
 
     # Configure logging to output the line number and message
     log_format = "%(levelname)s: [%(filename)s:%(lineno)s] %(message)s"
@@ -64,9 +82,27 @@ if __name__ == "__main__":
     endpoint_name = "{}-{}".format(
         config["Parameters"]["SageMakerProjectName"], config["Parameters"]["StageName"]
     )
-    results = test_endpoint(endpoint_name)
+
+    # Only compare the shadow variant from the production traffic, without load testing it
+    deploy_shadow = config["Parameters"].get("DeployShadow") == "true"
+    if deploy_shadow:
+        args.payload_file = None
+    results = test_endpoint(endpoint_name, args)
+
+    # Compare the shadow variant with production from the captured traffic
+    if deploy_shadow:
+        results["shadow_comparison"] = compare_shadow.compare_shadow(endpoint_name, args)
 
     # Print results and write to file
     logger.debug(json.dumps(results, indent=4))
     with open(args.export_test_results, "w") as f:
         json.dump(results, f, indent=4)
+
+    # Fail the stage when the endpoint misses its SLOs
+    if not results["success"]:
+        raise Exception(f"SageMaker endpoint: {endpoint_name} failed the load test")
+
+    # Fail the stage when the shadow variant misses the promotion thresholds
+    if "shadow_comparison" in results and not results["shadow_comparison"]["promote"]:
+        failed = [k for k, v in results["shadow_comparison"]["checks"].items() if not v["passed"]]
+        raise Exception(f"Shadow variant not ready for promotion, failed checks: {failed}")
@@ -0,0 +1,221 @@
+import argparse
+import base64
+import importlib.util
+import io
+import json
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+import compare_shadow
+
+START = datetime(2024, 1, 31, 22, 30, tzinfo=timezone.utc)
+END = datetime(2024, 2, 1, 0, 10, tzinfo=timezone.utc)
+
+
+class FakeBody(io.BytesIO):
+    def iter_lines(self):
+        return iter(self.read().splitlines())
+
+
+class FakeS3Client:
+    def __init__(self, objects):
+        self.objects = objects
+
+    def get_object(self, Bucket, Key):
+        return {"Body": FakeBody(self.objects[(Bucket, Key)])}
+
+
+class FakeCloudWatchClient:
+    """Returns the same values for every variant but the one named Empty, which has none."""
+
+    def __init__(self, values):
+        self.values = values
+        self.queries = None
+
+    def get_paginator(self, operation_name):
+        assert operation_name == "get_metric_data"
+        return self
+
+    def paginate(self, MetricDataQueries, StartTime, EndTime):
+        self.queries = MetricDataQueries
+        for query in MetricDataQueries:
+            metric_stat = query["MetricStat"]
+            variant_name = metric_stat["Metric"]["Dimensions"][1]["Value"]
+            key = (metric_stat["Metric"]["MetricName"], metric_stat["Stat"])
+            values = self.values.get(key, []) if variant_name != "Empty" else []
+            yield {"MetricDataResults": [{"Id": query["Id"], "Values": values}]}
+
+
+def capture_record(event_id, inference_time, data, encoding="CSV"):
+    if encoding == "BASE64":
+        data = base64.b64encode(data.encode("utf-8")).decode("utf-8")
+    return json.dumps(
+        {
+            "captureData": {
+                "endpointInput": {"data": "1,2,3", "encoding": "CSV"},
+                "endpointOutput": {"data": data, "encoding": encoding},
+            },
+            "eventMetadata": {"eventId": event_id, "inferenceTime": inference_time},
+        }
+    )
+
+
+@pytest.fixture
+def test_script(monkeypatch):
+    # Loaded from its path, as "test" is also the name of a standard library package
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    spec = importlib.util.spec_from_file_location("test_script", Path(__file__).parent / "test.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_parser_takes_both_error_rates(test_script):
+    args = test_script.get_parser().parse_args(
+        [
+            "--import-build-config",
+            "config.json",
+            "--export-test-results",
+            "results.json",
+            "--max-error-rate",
+            "0.05",
+            "--max-shadow-error-rate",
+            "0.02",
+        ]
+    )
+
+    assert args.max_error_rate == 0.05
+    assert args.max_shadow_error_rate == 0.02
+    assert args.payload_file == "test/sample-payload.csv"
+
+
+def test_hour_prefixes_follow_the_capture_layout():
+    bucket, prefixes = compare_shadow.get_hour_prefixes(
+        "s3://bucket/datacapture/", "endpoint", "shadow", START, END
+    )
+
+    assert bucket == "bucket"
+    assert prefixes == [
+        "datacapture/endpoint/shadow/2024/01/31/22/",
+        "datacapture/endpoint/shadow/2024/01/31/23/",
+        "datacapture/endpoint/shadow/2024/02/01/00/",
+    ]
+    _, prefixes = compare_shadow.get_hour_prefixes("s3://bucket", "endpoint", "shadow", END, END)
+    assert prefixes == ["endpoint/shadow/2024/02/01/00/"]
+
+
+def test_capture_file_keeps_the_records_since_the_start():
+    lines = [
+        capture_record("before", "2024-01-31T22:29:59Z", "1.0"),
+        capture_record("csv", "2024-01-31T22:30:00Z", "1.5\n2.5\n"),
+        "",
+        capture_record("base64", "2024-01-31T23:00:00.123Z", "3.0", encoding="BASE64"),
+        capture_record("text", "2024-01-31T23:30:00Z", "not a number"),
+    ]
+    s3_client = FakeS3Client({("bucket", "key"): "\n".join(lines).encode("utf-8")})
+
+    records = compare_shadow.read_capture_file(s3_client, "bucket", "key", START)
+
+    assert set(records) == {"csv", "base64", "text"}
+    np.testing.assert_array_equal(records["csv"], [1.5, 2.5])
+    np.testing.assert_array_equal(records["base64"], [3.0])
+    assert records["text"] is None
+
+
+def test_predictions_are_compared_on_the_matched_records():
+    production = {
+        "a": np.array([1.0]),
+        "b": np.array([2.0, 4.0]),
+        "c": np.array([3.0]),
+        "d": None,
+        "e": np.array([5.0]),
+        "production only": np.array([6.0]),
+    }
+    shadow = {
+        "a": np.array([1.25]),
+        "b": np.array([2.0, 3.0]),
+        "c": np.array([3.0, 3.0]),
+        "d": np.array([4.0]),
+        "e": np.array([7.0]),
+        "shadow only": np.array([8.0]),
+    }
+
+    comparison = compare_shadow.compare_predictions(production, shadow, tolerance=0.5)
+
+    deltas = np.array([0.25, 0.0, -1.0, 2.0])
+    assert comparison["production_records"] == 6 and comparison["shadow_records"] == 6
+    assert comparison["matched_records"] == 5
+    assert comparison["compared_records"] == 3
+    assert comparison["predictions"] == 4
+    np.testing.assert_allclose(comparison["mean_delta"], deltas.mean())
+    np.testing.assert_allclose(comparison["mean_abs_delta"], np.abs(deltas).mean())
+    np.testing.assert_allclose(comparison["max_abs_delta"], 2.0)
+    np.testing.assert_allclose(comparison["rmse"], np.sqrt(np.mean(deltas**2)))
+    np.testing.assert_allclose(comparison["within_tolerance"], 0.5)
+    json.dumps(comparison, allow_nan=False)
+
+
+def test_no_matched_records_are_reported_without_statistics():
+    comparison = compare_shadow.compare_predictions({"a": np.ones(1)}, {"b": np.ones(1)}, 0.5)
+
+    assert comparison == {
+        "production_records": 1,
+        "shadow_records": 1,
+        "matched_records": 0,
+        "compared_records": 0,
+    }
+
+
+def test_variant_metrics_are_read_in_one_query():
+    cw_client = FakeCloudWatchClient(
+        {
+            ("ModelLatency", "p50"): [1000.0, 1500.0],
+            ("ModelLatency", "p99"): [2000.0, 3000.0],
+            ("Invocations", "Sum"): [60.0, 40.0],
+            ("Invocation4XXErrors", "Sum"): [1.0],
+            ("Invocation5XXErrors", "Sum"): [1.0, 0.0],
+        }
+    )
+
+    metrics = compare_shadow.get_variant_metrics(
+        cw_client, "endpoint", ["Production", "Empty"], START, END
+    )
+
+    assert len(cw_client.queries) == 2 * 6
+    assert {q["MetricStat"]["Period"] for q in cw_client.queries} == {6000}
+    assert metrics["Production"] == {
+        "latency_ms": {"p50": 1.5, "p90": None, "p99": 3.0},
+        "invocations": 100.0,
+        "errors": 2.0,
+        "error_rate": 0.02,
+    }
+    assert metrics["Empty"] == {
+        "latency_ms": {"p50": None, "p90": None, "p99": None},
+        "invocations": 0,
+        "errors": 0,
+        "error_rate": None,
+    }
+
+
+def test_fresh_shadow_variant_passes_without_traffic():
+    parser = argparse.ArgumentParser()
+    compare_shadow.add_arguments(parser)
+    args = parser.parse_args([])
+    comparison = compare_shadow.compare_predictions({}, {}, args.tolerance)
+    no_traffic = {
+        "latency_ms": {"p50": None, "p90": None, "p99": None},
+        "invocations": 0,
+        "errors": 0,
+        "error_rate": None,
+    }
+    metrics = {"Production": no_traffic, "Shadow": no_traffic}
+
+    checks = compare_shadow.get_checks(comparison, metrics, "Production", "Shadow", args)
+
+    assert checks == {"min_records": {"value": 0, "threshold": 0, "passed": True}}
+    args.min_records = 1
+    checks = compare_shadow.get_checks(comparison, metrics, "Production", "Shadow", args)
+    assert not checks["min_records"]["passed"]
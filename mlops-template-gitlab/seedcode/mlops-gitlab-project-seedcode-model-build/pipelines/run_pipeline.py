@@ -17,7 +17,21 @@ import argparse
 import json
 import sys
 
-from pipelines._utils import get_pipeline_driver, convert_struct, get_pipeline_custom_tags
+import boto3
+from sagemaker.session import Session
+from sagemaker.workflow.pipeline import Pipeline
+
+from pipelines._utils import (
+    convert_struct,
+    get_definition_hash,
+    get_local_pipeline_driver,
+    get_pipeline_custom_tags,
+    get_pipeline_definition,
+    get_stored_definition_hash,
+    run_local_steps,
+    upsert_pipeline,
+    wait_for_execution,
+)
 
 def main():  # pragma: no cover
     """The main harness that creates or updates and runs the pipeline.
@@ -64,36 +78,93 @@ def main():  # pragma: no cover
         default=None,
         help="""List of dict strings of '[{"Key": "string", "Value": "string"}, ..]'""",
     )
+    parser.add_argument(
+        "--skip-if-unchanged",
+        dest="skip_if_unchanged",
+        action="store_true",
+        help="Do not start an execution when the pipeline definition and tags are unchanged.",
+    )
+    parser.add_argument(
+        "--wait-timeout",
+        dest="wait_timeout",
+        type=int,
+        default=1800,
+        help="The maximum number of seconds to wait for the execution to finish.",
+    )
+    parser.add_argument(
+        "--summary-file",
+        dest="summary_file",
+        type=str,
+        default="pipeline-execution-summary.json",
+        help="The file to output the queued and running time of each step json to.",
+    )
+    parser.add_argument(
+        "--local",
+        dest="local",
+        action="store_true",
+        help="Run the steps locally on synthetic data, without AWS, timing each of them.",
+    )
     args = parser.parse_args()
 
-    if args.module_name is None or args.role_arn is None:
+    if args.module_name is None or (args.role_arn is None and not args.local):
         parser.print_help()
         sys.exit(2)
     tags = convert_struct(args.tags)
 
     try:
-        pipeline = get_pipeline_driver(args.module_name, args.kwargs)
-        print("###### Creating/updating a SageMaker Pipeline with the following definition:")
-        parsed = json.loads(pipeline.definition())
-        print(json.dumps(parsed, indent=2, sort_keys=True))
+        if args.local:
+            steps = get_local_pipeline_driver(args.module_name, args.kwargs)
+            run_local_steps(steps, summary_file=args.summary_file)
+            return
 
+        name, definition = get_pipeline_definition(args.module_name, args.kwargs)
         all_tags = get_pipeline_custom_tags(args.module_name, args.kwargs, tags)
 
-        upsert_response = pipeline.upsert(
-            role_arn=args.role_arn, description=args.description, tags=all_tags
+        boto_session = boto3.Session(region_name=convert_struct(args.kwargs).get("region"))
+        sagemaker_session = Session(boto_session=boto_session)
+        sagemaker_client = sagemaker_session.sagemaker_client
+
+        definition_hash = get_definition_hash(
+            definition, all_tags, args.role_arn, args.description
         )
-        print("\n###### Created/Updated SageMaker Pipeline: Response received:")
-        print(upsert_response)
+        if get_stored_definition_hash(sagemaker_client, name) == definition_hash:
+            print(f"###### SageMaker Pipeline {name} is unchanged (sha256 {definition_hash})")
+            if args.skip_if_unchanged:
+                print("Skipping the execution.")
+                return
+        else:
+            print("###### Creating/updating a SageMaker Pipeline with the following definition:")
+            print(json.dumps(json.loads(definition), indent=2, sort_keys=True))
+
+            upsert_response = upsert_pipeline(
+                sagemaker_client,
+                name,
+                definition,
+                role_arn=args.role_arn,
+                description=args.description,
+                tags=all_tags,
+            )
+            print("\n###### Created/Updated SageMaker Pipeline: Response received:")
+            print(upsert_response)
 
-        execution = pipeline.start()
+        execution = Pipeline(name=name, sagemaker_session=sagemaker_session).start()
         print(f"\n###### Execution started with PipelineExecutionArn: {execution.arn}")
 
         print("Waiting for the execution to finish...")
-        execution.wait()
-        print("\n#####Execution completed. Execution step details:")
+        # The steps are polled more often while they change status, and the wait stops as soon
+        # as a step fails. If the execution is taking a longer time, increase --wait-timeout.
+        status, steps = wait_for_execution(
+            sagemaker_client,
+            boto_session.client("logs"),
+            execution.arn,
+            timeout=args.wait_timeout,
+            summary_file=args.summary_file,
+        )
+        print(f"\n#####Execution {status}. Execution step details:")
 
-        print(execution.list_steps())
-        # Todo print the status?
+        print(steps)
+        if status != "Succeeded":
+            sys.exit(1)
     except Exception as e:  # pylint: disable=W0703
         print(f"Exception: {e}")
         sys.exit(1)
@@ -8,6 +8,7 @@ import sagemaker
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 from src.model_build.pipeline import get_pipeline
+from pipelines._utils import wait_for_execution
 
 logging.basicConfig(level=logging.INFO)
 
@@ -45,9 +46,16 @@ if __name__ == "__main__":
             logging.info(f"EXECUTION STARTED WITH PipelineExecutionArn: {execution.arn}")
             
             logging.info("WAITING FOR THE EXECUTION TO FINISH...")
-            execution.wait(360)
+            # polls the steps every 5 to 60 seconds for up to 6 hours, stops as soon as a step fails
+            status, steps = wait_for_execution(sagemaker_session.sagemaker_client,
+                                               sagemaker_session.boto_session.client("logs"),
+                                               execution.arn,
+                                               timeout=6 * 60 * 60,
+                                               summary_file="pipeline-execution-summary.json")
 
-            logging.info(f"EXECUTION COMPLETED. SEE THE EXECUTION STEP DETAILS:\n {execution.list_steps()}")
+            logging.info(f"EXECUTION {status.upper()}. SEE THE EXECUTION STEP DETAILS:\n {steps}")
+            if status != "Succeeded":
+                sys.exit(1)
     except Exception as e:
         print(f"Exception: {e}")
         sys.exit(1)
@@ -65,6 +65,7 @@ def get_pipeline(iam_role, session, cfg):
                                   processor=processor,
                                   code=cfg["processing"]["entry_point"],
                                   cache_config=cache_config,
+                                  job_arguments=["--cache_uri", f"s3://{default_bucket}/mlops_model_pipeline_preprocessor_cache/"],
                                   inputs = [ProcessingInput(destination="/opt/ml/processing/input", dataset_definition=dataset_def)],
                                   outputs=[
                                             ProcessingOutput(source=cfg["processing"]["parameters"]["model"], output_name="model"),
@@ -1,11 +1,17 @@
+import io
 import os
+import json
 import joblib
+import hashlib
 import logging
 import tarfile
 import argparse
 import pandas as pd
 import numpy as np
 import pyarrow
+import boto3
+
+from botocore.exceptions import ClientError
 
 from sklearn.compose import ColumnTransformer
 from sklearn.impute import SimpleImputer
@@ -15,7 +21,57 @@ from sklearn.model_selection import train_test_split
 
 logging.basicConfig(level=logging.INFO)
 
-def prepare_data(args, data):
+NUMERIC_FEATURES = ['in_elapsed_flight_time',
+                    'out_elapsed_flight_time',
+                    'total_price',
+                    'total_markup_amount',
+                    'adt_numbers',
+                    'cnn_numbers',
+                    'inf_numbers']
+CATEGORICAL_FEATURES = ['source']
+
+def get_fingerprint(args, input_name, data):
+    """Fingerprints the input data, the feature lists and this script for the preprocessor cache."""
+    input_hash = hashlib.sha256()
+    with open(input_name, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            input_hash.update(block)
+    with open(__file__, "rb") as f:
+        script_hash = hashlib.sha256(f.read()).hexdigest()
+    fingerprint = {"input": input_hash.hexdigest(),
+                   "size": os.path.getsize(input_name),
+                   "rows": len(data),
+                   "target": args.target,
+                   "numeric_features": NUMERIC_FEATURES,
+                   "categorical_features": CATEGORICAL_FEATURES,
+                   "script": script_hash}
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()
+
+def get_cache_location(cache_uri, fingerprint):
+    bucket, _, prefix = cache_uri[len("s3://"):].partition("/")
+    return bucket, "/".join(filter(None, [prefix.rstrip("/"), fingerprint, "model.joblib"]))
+
+def load_cached_model(cache_uri, fingerprint):
+    """Returns the preprocessing model fitted for the fingerprint, or None on a cache miss."""
+    bucket, key = get_cache_location(cache_uri, fingerprint)
+    try:
+        body = boto3.client("s3").get_object(Bucket=bucket, Key=key)["Body"].read()
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            logging.info(f"NO CACHED PREPROCESSING MODEL AT s3://{bucket}/{key}")
+            return None
+        raise
+    logging.info(f"LOADED CACHED PREPROCESSING MODEL FROM s3://{bucket}/{key}")
+    return joblib.load(io.BytesIO(body))
+
+def save_cached_model(cache_uri, fingerprint, model):
+    bucket, key = get_cache_location(cache_uri, fingerprint)
+    buffer = io.BytesIO()
+    joblib.dump(model, buffer)
+    boto3.client("s3").put_object(Bucket=bucket, Key=key, Body=buffer.getvalue())
+    logging.info(f"CACHED PREPROCESSING MODEL AT s3://{bucket}/{key}")
+
+def prepare_data(args, data, pipeline_model=None):
     
     # GET DATASET FROM SCIKIT-LEARN
     logging.info("DEFINING SCIKIT-LEARN FEATURE ENGINEERING PIPELINE")
@@ -32,14 +88,8 @@ def prepare_data(args, data):
                   'return_date',
                   'mkp_source'], 
                  axis=1)
-    numeric_features = ['in_elapsed_flight_time',
-                        'out_elapsed_flight_time',
-                        'total_price',
-                        'total_markup_amount',
-                        'adt_numbers',
-                        'cnn_numbers',
-                        'inf_numbers']
-    categorical_features = ['source']
+    numeric_features = NUMERIC_FEATURES
+    categorical_features = CATEGORICAL_FEATURES
 
     # Preprocess the data
     X = df.drop(args.target, axis=1)
@@ -48,24 +98,26 @@ def prepare_data(args, data):
     # Split the data into train and test sets
     X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
     
-    # Define the pipeline
-    numeric_transformer = Pipeline(steps=[
-        ('imputer', SimpleImputer(strategy='mean')),
-        ('scaler', StandardScaler())])
+    # Reuse the preprocessing model fitted on the same data and code, if cached
+    if pipeline_model is None:
+        # Define the pipeline
+        numeric_transformer = Pipeline(steps=[
+            ('imputer', SimpleImputer(strategy='mean')),
+            ('scaler', StandardScaler())])
 
-    categorical_transformer = Pipeline(steps=[
-        ('imputer', SimpleImputer(strategy='constant', fill_value='missing')),
-        ('onehot', OneHotEncoder(handle_unknown='ignore'))])
+        categorical_transformer = Pipeline(steps=[
+            ('imputer', SimpleImputer(strategy='constant', fill_value='missing')),
+            ('onehot', OneHotEncoder(handle_unknown='ignore'))])
 
-    preprocessor = ColumnTransformer(transformers=[
-        ('num', numeric_transformer, numeric_features),
-        ('cat', categorical_transformer, categorical_features)])
+        preprocessor = ColumnTransformer(transformers=[
+            ('num', numeric_transformer, numeric_features),
+            ('cat', categorical_transformer, categorical_features)])
 
-    # Preprocessing
-    pipeline_model = Pipeline(steps=[('preprocessor', preprocessor)])
+        # Preprocessing
+        pipeline_model = Pipeline(steps=[('preprocessor', preprocessor)])
 
-    # Fit the pipeline to the training data
-    pipeline_model.fit(X_train, y_train)
+        # Fit the pipeline to the training data
+        pipeline_model.fit(X_train, y_train)
     
     # GET ONE HOT ENCODED COLUMN NAMES
     new_cat_cols = pipeline_model.named_steps["preprocessor"].named_transformers_["cat"].named_steps["onehot"].get_feature_names(categorical_features)
@@ -91,13 +143,22 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--target", type=str, default="journey_type")
     parser.add_argument("--base_dir", type=str, default=base_dir)
+    parser.add_argument("--cache_uri", type=str, default=None)
     args, _ = parser.parse_known_args()
     
     # READ INPUT DATA
     pdInput = pd.read_parquet(os.environ['input_name'], engine = 'pyarrow')
     
+    # LOOK UP THE PREPROCESSING MODEL CACHE
+    cached_model = None
+    if args.cache_uri:
+        fingerprint = get_fingerprint(args, os.environ['input_name'], pdInput)
+        cached_model = load_cached_model(args.cache_uri, fingerprint)
+    
     # GENERATE PREPROCESSING MODEL
-    preprocessing_model = prepare_data(args, pdInput)
+    preprocessing_model = prepare_data(args, pdInput, cached_model)
+    if args.cache_uri and cached_model is None:
+        save_cached_model(args.cache_uri, fingerprint, preprocessing_model)
     
     # SAVE THE PREPROCESSING MODEL
     joblib.dump(preprocessing_model, "model.joblib")
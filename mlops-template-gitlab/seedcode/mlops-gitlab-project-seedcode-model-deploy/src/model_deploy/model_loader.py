@@ -0,0 +1,14 @@
+# Open source libraries
+import os
+import joblib
+
+
+def load_model(model_dir, filename="model.joblib"):
+    """Load a joblib model with its numpy arrays memory-mapped
+
+    The arrays of an uncompressed joblib file are mapped read-only instead of being read
+    into memory, so every gunicorn worker of the endpoint shares the same pages of the
+    model file (e.g. the RandomForest trees) through the page cache rather than holding
+    its own private copy.
+    """
+    return joblib.load(os.path.join(model_dir, filename), mmap_mode="r")
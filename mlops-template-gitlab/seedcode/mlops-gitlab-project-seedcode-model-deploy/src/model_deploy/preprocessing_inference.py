@@ -61,6 +61,8 @@ import pandas as pd
 import tarfile
 import re
 
+from model_loader import load_model
+
 try:
     from sagemaker_containers.beta.framework import (
         content_types,
@@ -146,5 +148,5 @@ def predict_fn(input_data, model):
 
 def model_fn(model_dir):    
     """Deserialize fitted model"""
-    preprocessor = joblib.load(os.path.join(model_dir, "model.joblib"))
+    preprocessor = load_model(model_dir)
     return preprocessor
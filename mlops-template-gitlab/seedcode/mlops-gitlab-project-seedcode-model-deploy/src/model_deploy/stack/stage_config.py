@@ -0,0 +1,105 @@
+"""Generates the configuration of every deployment stage in a single pass.
+
+Every stage has a <stage>-config.json in the repository. The stages the pipeline deploys are
+named on the command line with their import and export files, and any other <stage>-config.json
+found is exported alongside them, so that adding a stage only takes adding its config file.
+"""
+import glob
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+CONFIG_SUFFIX = "-config.json"
+
+
+def get_stages(args, stage_names, config_dir="."):
+    """Gets the import and export files of every stage.
+
+    Args:
+        args: The parsed arguments, with the import_<stage>_config and
+            export_<stage>_{config,params,tags} of the named stages.
+        stage_names: The names of the stages named on the command line.
+        config_dir: The directory to find the other <stage>-config.json in.
+
+    Returns:
+        The import_config, export_config, export_params and export_tags by stage name.
+    """
+    stages = {
+        name: {
+            "import_config": getattr(args, f"import_{name}_config"),
+            "export_config": getattr(args, f"export_{name}_config"),
+            "export_params": getattr(args, f"export_{name}_params"),
+            "export_tags": getattr(args, f"export_{name}_tags"),
+        }
+        for name in stage_names
+    }
+    imported = {os.path.abspath(stage["import_config"]) for stage in stages.values()}
+    for path in sorted(glob.glob(os.path.join(config_dir, f"*{CONFIG_SUFFIX}"))):
+        name = os.path.basename(path)[: -len(CONFIG_SUFFIX)]
+        if name in stages or os.path.abspath(path) in imported:
+            continue
+        stages[name] = {
+            "import_config": path,
+            "export_config": f"{name}-config-export.json",
+            "export_params": f"{name}-params-export.json",
+            "export_tags": f"{name}-tags-export.json",
+        }
+    return stages
+
+
+def get_cfn_style_config(stage_config):
+    parameters = []
+    for key, value in stage_config["Parameters"].items():
+        parameter = {
+            "ParameterKey": key,
+            "ParameterValue": value
+        }
+        parameters.append(parameter)
+    tags = []
+    for key, value in stage_config["Tags"].items():
+        tag = {
+            "Key": key,
+            "Value": value
+        }
+        tags.append(tag)
+    return parameters, tags
+
+
+def create_cfn_params_tags_file(config, export_params_file, export_tags_file):
+    # Write Params and tags in separate file for Cfn cli command
+    parameters, tags = get_cfn_style_config(config)
+    with open(export_params_file, "w") as f:
+        json.dump(parameters, f, indent=4)
+    with open(export_tags_file, "w") as f:
+        json.dump(tags, f, indent=4)
+
+
+def write_stage_configs(stages, extend_config, export_cfn_params_tags=False, max_workers=8):
+    """Extends and writes the configuration of every stage concurrently.
+
+    Args:
+        stages: The import and export files by stage name, as returned by get_stages.
+        extend_config: The function extending the configuration of a stage.
+        export_cfn_params_tags: Whether to also write the parameters and tags for the Cfn cli.
+        max_workers: The maximum number of stages written at a time.
+
+    Returns:
+        The extended configuration by stage name.
+    """
+
+    def write_stage_config(name):
+        stage = stages[name]
+        with open(stage["import_config"], "r") as f:
+            config = extend_config(json.load(f))
+        logger.debug("{} config: {}".format(name, json.dumps(config, indent=4)))
+        with open(stage["export_config"], "w") as f:
+            json.dump(config, f, indent=4)
+        if export_cfn_params_tags:
+            create_cfn_params_tags_file(config, stage["export_params"], stage["export_tags"])
+        return config
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(stages)))) as executor:
+        return dict(zip(stages, executor.map(write_stage_config, stages)))
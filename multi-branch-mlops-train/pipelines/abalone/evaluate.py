@@ -1,54 +1,462 @@
 """Evaluation script for measuring mean squared error."""
+import argparse
+import hashlib
 import json
 import logging
 import pathlib
 import pickle
+import shutil
+import struct
+import sys
 import tarfile
+import tempfile
+import time
 
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
 import numpy as np
 import pandas as pd
 import xgboost
 
-from sklearn.metrics import mean_squared_error
-
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 logger.addHandler(logging.StreamHandler())
 
+# Metrics of the report; mse is always included since the pipeline condition step gates on it.
+METRICS = ["mse", "rmse", "mae", "r2", "residual_quantiles"]
+RESIDUAL_QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+
+def _read_varint(buf, pos):
+    """Decodes the protobuf varint at `pos`, returning it and the position after it."""
+    value, shift = 0, 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def _fields(buf):
+    """Yields the number and payload of every length-delimited field of a protobuf message."""
+    pos = 0
+    while pos < len(buf):
+        tag, pos = _read_varint(buf, pos)
+        if tag & 7 == 0:
+            _, pos = _read_varint(buf, pos)
+            continue
+        length, pos = _read_varint(buf, pos)
+        yield tag >> 3, buf[pos : pos + length]
+        pos += length
+
+
+def iter_recordio_protobuf(path, batch_size):
+    """Yields the labels and dense features of a RecordIO-protobuf file in batches of records."""
+    with open(path, "rb") as f:
+        while True:
+            labels, rows = [], []
+            for header in iter(lambda: f.read(8), b""):
+                _, length = struct.unpack("<II", header)
+                record = f.read(length + (-length % 4))[:length]
+                for number, entry in _fields(record):
+                    value = dict(_fields(entry))[2]
+                    tensor = dict(_fields(dict(_fields(value))[2]))
+                    values = np.frombuffer(tensor.get(1, b""), dtype="<f4")
+                    (rows if number == 1 else labels).append(values)
+                if len(rows) == batch_size:
+                    break
+            if not rows:
+                return
+            yield np.concatenate(labels), np.vstack(rows)
+
+
+def iter_test_batches(test_dir, batch_size=100000):
+    """Yields the labels and features of every test file in batches of at most `batch_size` rows.
+
+    Every output format of preprocess.py is read incrementally, so memory is bounded by the
+    batch size rather than the size of the test set. The empty files preprocess.py creates
+    for the parts that received no rows are skipped.
+    """
+    for path in sorted(pathlib.Path(test_dir).iterdir()):
+        if path.suffix == ".json" or path.stat().st_size == 0:
+            continue
+        if path.suffix == ".rec":
+            yield from iter_recordio_protobuf(path, batch_size)
+            continue
+        if path.suffix == ".parquet":
+            # pyarrow is only needed, and only imported, for Parquet test data
+            import pyarrow.parquet as pq
+
+            batches = (batch.to_pandas() for batch in pq.ParquetFile(path).iter_batches(batch_size))
+        else:
+            batches = pd.read_csv(path, header=None, chunksize=batch_size)
+        for df in batches:
+            yield df.iloc[:, 0].to_numpy(), df.iloc[:, 1:].to_numpy()
+
+
+def read_test_data(test_dir):
+    """Reads the labels and features of every test file, whatever its output format."""
+    labels, features = zip(*iter_test_batches(test_dir))
+    return np.concatenate(labels), np.vstack(features)
+
+
+def _merge_moments(count, mean, m2, values):
+    """Merges a batch of values into a count, mean and sum of squared deviations."""
+    n = len(values)
+    batch_mean = values.mean()
+    delta = batch_mean - mean
+    mean += delta * n / (count + n)
+    m2 += np.square(values - batch_mean).sum() + delta**2 * count * n / (count + n)
+    return mean, m2
+
+
+class RunningRegressionMetrics:
+    """Accumulates regression metrics over batches of predictions.
+
+    Every batch is reduced with vectorized operations. The means and sums of squared
+    deviations of the residuals and labels are merged with Chan's parallel form of Welford's
+    algorithm, so the results match a single pass over all the predictions without holding
+    them in memory. The residual quantiles come from a bounded uniform sample of the
+    residuals, which is exact while the number of rows stays within `sample_size`.
+    """
+
+    def __init__(self, sample_size=100000, seed=0):
+        self.sample_size = sample_size
+        self.count = 0
+        self.residual_mean = 0.0
+        self.residual_m2 = 0.0
+        self.squared_error_mean = 0.0
+        self.absolute_error_mean = 0.0
+        self.label_mean = 0.0
+        self.label_m2 = 0.0
+        self.residual_sample = np.empty(0)
+        self._priority = np.empty(0)
+        self._rng = np.random.default_rng(seed)
+
+    def update(self, y, predictions):
+        """Adds a batch of labels and their predictions."""
+        y = np.asarray(y, dtype=np.float64)
+        residuals = y - predictions
+        n = len(residuals)
+        if n == 0:
+            return
+        total = self.count + n
+        self.residual_mean, self.residual_m2 = _merge_moments(
+            self.count, self.residual_mean, self.residual_m2, residuals
+        )
+        self.label_mean, self.label_m2 = _merge_moments(
+            self.count, self.label_mean, self.label_m2, y
+        )
+        batch_mse = np.square(residuals).mean()
+        self.squared_error_mean += (batch_mse - self.squared_error_mean) * n / total
+        batch_mae = np.abs(residuals).mean()
+        self.absolute_error_mean += (batch_mae - self.absolute_error_mean) * n / total
+        self.count = total
+
+        sample = np.concatenate([self.residual_sample, residuals])
+        priority = np.concatenate([self._priority, self._rng.random(n)])
+        if len(sample) > self.sample_size:
+            keep = np.argpartition(priority, self.sample_size)[: self.sample_size]
+            sample, priority = sample[keep], priority[keep]
+        self.residual_sample, self._priority = sample, priority
+
+    @property
+    def mse(self):
+        return self.squared_error_mean
+
+    @property
+    def residual_std(self):
+        if self.count == 0:
+            return None
+        return np.sqrt(self.residual_m2 / self.count)
+
+    @property
+    def rmse(self):
+        return np.sqrt(self.squared_error_mean)
+
+    @property
+    def mae(self):
+        return self.absolute_error_mean
+
+    @property
+    def r2(self):
+        if self.label_m2 == 0:
+            return None
+        return 1 - self.squared_error_mean * self.count / self.label_m2
+
+    def report(self, metrics=METRICS):
+        """Gets the `metrics` in the SageMaker model quality report schema."""
+        if self.count == 0:
+            raise ValueError("No test rows to evaluate the model on.")
+        regression_metrics = {"mse": {"value": self.mse, "standard_deviation": self.residual_std}}
+        for name in ("rmse", "mae", "r2"):
+            if name in metrics:
+                regression_metrics[name] = {"value": getattr(self, name)}
+        report = {"regression_metrics": regression_metrics}
+        if "residual_quantiles" in metrics:
+            values = np.quantile(self.residual_sample, RESIDUAL_QUANTILES)
+            report["residual_quantiles"] = {
+                f"p{round(q * 100):02d}": value for q, value in zip(RESIDUAL_QUANTILES, values)
+            }
+        return report
+
+
+def read_segments(test_dir, segment_columns):
+    """Finds the one-hot encoded feature columns of each segment column.
+
+    preprocess.py writes the names of the features, `<column>_<category>` for the one-hot
+    encoded ones, to feature-names.json next to the test split.
+
+    Returns:
+        a dict of segment column to the indices and categories of its one-hot columns
+    """
+    path = pathlib.Path(test_dir) / "feature-names.json"
+    if not segment_columns or not path.exists():
+        return {}
+    with open(path) as f:
+        feature_names = json.load(f)
+    segments = {}
+    for column in segment_columns:
+        prefix = f"{column}_"
+        indices = [i for i, name in enumerate(feature_names) if name.startswith(prefix)]
+        if not indices:
+            logger.warning("No one-hot encoded features of segment column %s.", column)
+            continue
+        segments[column] = (indices, [feature_names[i][len(prefix) :] for i in indices])
+    return segments
+
+
+def segment_labels(X, indices, categories):
+    """Decodes the category of every row from its one-hot columns, "unknown" if all are 0."""
+    block = X[:, indices]
+    labels = np.asarray(categories, dtype=object)[block.argmax(axis=1)]
+    labels[block.max(axis=1) <= 0] = "unknown"
+    return labels
+
+
+class Evaluation:
+    """Accumulates the overall and per-segment metrics and the prediction latency of a model."""
+
+    def __init__(self, segments=None):
+        self.segments = segments or {}
+        self.metrics = RunningRegressionMetrics()
+        self.segment_metrics = {column: {} for column in self.segments}
+        self.predict_seconds = 0.0
+
+    def update(self, y, X, predictions, predict_seconds):
+        """Adds a batch of labels, features and predictions, and the time taken to predict."""
+        self.predict_seconds += predict_seconds
+        self.metrics.update(y, predictions)
+        for column, (indices, categories) in self.segments.items():
+            labels = segment_labels(X, indices, categories)
+            for label in np.unique(labels):
+                mask = labels == label
+                metrics = self.segment_metrics[column].setdefault(label, RunningRegressionMetrics())
+                metrics.update(y[mask], predictions[mask])
+
+    def report(self, metrics=METRICS):
+        """Gets the evaluation report, which keeps the schema the pipeline conditions read."""
+        report = self.metrics.report(metrics)
+        report["latency"] = {
+            "rows": self.metrics.count,
+            "predict_seconds_per_1k_rows": 1000 * self.predict_seconds / max(self.metrics.count, 1),
+        }
+        report["segments"] = {
+            column: {
+                label: dict(count=segment.count, **segment.report(metrics))
+                for label, segment in sorted(segments.items())
+            }
+            for column, segments in self.segment_metrics.items()
+        }
+        return report
+
+
+def _timed_predict(model, dmatrix):
+    start = time.perf_counter()
+    predictions = model.predict(dmatrix)
+    return predictions, time.perf_counter() - start
+
+
+def evaluate_models(models, batches, segments=None):
+    """Scores several models over a single read of the test data.
+
+    Each batch of `(y, X)` is read and converted to a DMatrix once, and then predicted by
+    all the models concurrently.
+
+    Args:
+        models: a dict of model name to xgboost model.
+        batches: iterable of `(y, X)` batches, as yielded by `iter_test_batches`.
+        segments: the one-hot columns of each segment column, as returned by `read_segments`.
+
+    Returns:
+        a dict of model name to its `Evaluation`
+    """
+    evaluations = {name: Evaluation(segments) for name in models}
+    with ThreadPoolExecutor(max_workers=len(models)) as executor:
+        for y, X in batches:
+            dmatrix = xgboost.DMatrix(X)
+            futures = {
+                name: executor.submit(_timed_predict, model, dmatrix)
+                for name, model in models.items()
+            }
+            for name, future in futures.items():
+                predictions, predict_seconds = future.result()
+                evaluations[name].update(y, X, predictions, predict_seconds)
+    for name, evaluation in evaluations.items():
+        logger.info("Evaluated %d rows with the %s model.", evaluation.metrics.count, name)
+    return evaluations
+
+
+def evaluate(model, batches, segments=None):
+    """Predicts every batch of `(y, X)` in turn and accumulates the evaluation."""
+    return evaluate_models({"model": model}, batches, segments)["model"]
+
+
+def extract_model(model_path, cache_dir="model-cache"):
+    """Extracts a model.tar.gz once, into a cache directory named after the digest of its content.
+
+    Returns:
+        the directory holding the extracted model artifacts
+    """
+    digest = hashlib.sha256()
+    with open(model_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    model_dir = pathlib.Path(cache_dir) / digest.hexdigest()
+    if model_dir.exists():
+        logger.info("Using the model artifacts already extracted to %s.", model_dir)
+        return model_dir
+    pathlib.Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    staging_dir = tempfile.mkdtemp(dir=cache_dir)
+    with tarfile.open(model_path) as tar:
+        tar.extractall(path=staging_dir)
+    try:
+        pathlib.Path(staging_dir).rename(model_dir)
+    except OSError:
+        # extracted concurrently by another process
+        shutil.rmtree(staging_dir)
+    return model_dir
+
+
+def load_xgboost_model(model_file):
+    """Loads an xgboost model saved in the native binary, JSON or UBJSON format, falling back
+    to unpickling the artifacts of older xgboost containers."""
+    with open(model_file, "rb") as f:
+        # pickles of protocol 2 and above start with the PROTO opcode
+        if f.read(1) == pickle.PROTO:
+            logger.info("%s is not in a native xgboost format, unpickling it.", model_file)
+            f.seek(0)
+            return pickle.load(f)
+    booster = xgboost.Booster()
+    booster.load_model(bytearray(pathlib.Path(model_file).read_bytes()))
+    return booster
+
+
+def load_model(model_path, cache_dir="model-cache"):
+    """Loads the xgboost model of a model.tar.gz through the extraction cache."""
+    return load_xgboost_model(extract_model(model_path, cache_dir) / "xgboost-model")
+
+
+def get_champion_model_package(model_package_group_name):
+    """Gets the latest approved model package of the group.
+
+    Returns:
+        a tuple of the model package ARN and its model data URL, or None if the group has
+        no approved model package yet
+    """
+    sm_client = boto3.client("sagemaker")
+    summaries = sm_client.list_model_packages(
+        ModelPackageGroupName=model_package_group_name,
+        ModelApprovalStatus="Approved",
+        SortBy="CreationTime",
+        SortOrder="Descending",
+        MaxResults=1,
+    )["ModelPackageSummaryList"]
+    if not summaries:
+        return None
+    arn = summaries[0]["ModelPackageArn"]
+    package = sm_client.describe_model_package(ModelPackageName=arn)
+    return arn, package["InferenceSpecification"]["Containers"][0]["ModelDataUrl"]
+
+
+def download_model(model_data_url, model_path):
+    """Downloads a model.tar.gz from S3."""
+    bucket, _, key = model_data_url[len("s3://") :].partition("/")
+    boto3.resource("s3").Bucket(bucket).download_file(key, model_path)
+
+
+def compare_models(evaluations, champion_arn=None, metrics=METRICS):
+    """Compares the challenger with the champion, if there is one.
+
+    The ConditionStep gates on `mse_ratio`, the challenger mse over the champion mse, which
+    is 0 when there is no approved champion yet so that the first model is not blocked. A
+    perfect champion gives the largest finite float rather than infinity, which is not JSON.
+    The values are plain Python types so that the report can be serialized to JSON.
+
+    Returns:
+        the champion_challenger section of the evaluation report
+    """
+    challenger = evaluations["challenger"].metrics
+    comparison = {"champion_model_package_arn": champion_arn, "mse_ratio": 0.0}
+    if "champion" in evaluations:
+        champion = evaluations["champion"].metrics
+        comparison["champion"] = evaluations["champion"].report(metrics)
+        if champion.mse:
+            comparison["mse_ratio"] = float(challenger.mse / champion.mse)
+        else:
+            comparison["mse_ratio"] = 1.0 if challenger.mse == 0 else sys.float_info.max
+        comparison["deltas"] = {}
+        for name in ("mse", "rmse", "mae", "r2"):
+            values = getattr(challenger, name), getattr(champion, name)
+            if (name == "mse" or name in metrics) and None not in values:
+                comparison["deltas"][name] = float(values[0] - values[1])
+    comparison["challenger_wins"] = bool(comparison["mse_ratio"] <= 1.0)
+    return comparison
 
 
 if __name__ == "__main__":
     logger.debug("Starting evaluation.")
-    model_path = "/opt/ml/processing/model/model.tar.gz"
-    with tarfile.open(model_path) as tar:
-        tar.extractall(path=".")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=100000)
+    parser.add_argument("--metrics", type=str, default=",".join(METRICS))
+    parser.add_argument("--segment-columns", type=str, default="sex")
+    parser.add_argument(
+        "--champion-model-package-group",
+        type=str,
+        default=None,
+        help="compare with the latest approved model package of this group",
+    )
+    args = parser.parse_args()
 
     logger.debug("Loading xgboost model.")
-    model = pickle.load(open("xgboost-model", "rb"))
+    models = {"challenger": load_model("/opt/ml/processing/model/model.tar.gz")}
 
-    logger.debug("Reading test data.")
-    test_path = "/opt/ml/processing/test/test.csv"
-    df = pd.read_csv(test_path, header=None)
+    champion = None
+    if args.champion_model_package_group is not None:
+        champion = get_champion_model_package(args.champion_model_package_group)
+        if champion is None:
+            logger.info("No approved model package in %s.", args.champion_model_package_group)
+        else:
+            logger.info("Loading champion model package %s.", champion[0])
+            download_model(champion[1], "champion.tar.gz")
+            models["champion"] = load_model("champion.tar.gz")
 
-    logger.debug("Reading test data.")
-    y_test = df.iloc[:, 0].to_numpy()
-    df.drop(df.columns[0], axis=1, inplace=True)
-    X_test = xgboost.DMatrix(df.values)
+    test_dir = "/opt/ml/processing/test"
+    segments = read_segments(test_dir, [c for c in args.segment_columns.split(",") if c])
 
-    logger.info("Performing predictions against test data.")
-    predictions = model.predict(X_test)
+    logger.info("Performing predictions against test data in batches of %d rows.", args.batch_size)
+    evaluations = evaluate_models(models, iter_test_batches(test_dir, args.batch_size), segments)
 
     logger.debug("Calculating mean squared error.")
-    mse = mean_squared_error(y_test, predictions)
-    std = np.std(y_test - predictions)
-    report_dict = {
-        "regression_metrics": {
-            "mse": {
-                "value": mse,
-                "standard_deviation": std
-            },
-        },
-    }
+    metrics = args.metrics.split(",")
+    mse = evaluations["challenger"].metrics.mse
+    report_dict = evaluations["challenger"].report(metrics)
+    if args.champion_model_package_group is not None:
+        champion_arn = champion[0] if champion else None
+        report_dict["champion_challenger"] = compare_models(evaluations, champion_arn, metrics)
 
     output_dir = "/opt/ml/processing/evaluation"
     pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
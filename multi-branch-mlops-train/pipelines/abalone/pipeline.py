@@ -1,15 +1,23 @@
+import hashlib
 import os
 
 import boto3
 import sagemaker
 import sagemaker.session
+from botocore.exceptions import BotoCoreError, ClientError
 from sagemaker.estimator import Estimator
 from sagemaker.inputs import TrainingInput
 from sagemaker.metadata_properties import MetadataProperties
 from sagemaker.processing import (
+    ProcessingInput,
     ProcessingOutput,
 )
 from sagemaker.sklearn.processing import SKLearnProcessor
+from sagemaker.tuner import (
+    ContinuousParameter,
+    HyperparameterTuner,
+    IntegerParameter,
+)
 from sagemaker.workflow.parameters import (
     ParameterInteger,
     ParameterString,
@@ -18,13 +26,32 @@ from sagemaker.workflow.pipeline import Pipeline
 from sagemaker.workflow.pipeline_experiment_config import PipelineExperimentConfig
 from sagemaker.workflow.step_collections import RegisterModel
 from sagemaker.workflow.steps import (
+    CacheConfig,
     ProcessingStep,
     TrainingStep,
+    TuningStep,
 )
 
 BASE_DIR = os.path.dirname(os.path.realpath(__file__))
 # 1
 
+# Training content type and default training input mode of each preprocessing output format.
+OUTPUT_FORMATS = {
+    "csv": ("text/csv", "File"),
+    "parquet": ("application/x-parquet", "FastFile"),
+    "recordio-protobuf": ("application/x-recordio-protobuf", "Pipe"),
+}
+
+# Search space of the optional hyperparameter tuning step, around the default hyperparameters.
+HYPERPARAMETER_RANGES = {
+    "eta": ContinuousParameter(0.05, 0.5),
+    "max_depth": IntegerParameter(3, 10),
+    "gamma": ContinuousParameter(0, 10),
+    "min_child_weight": ContinuousParameter(1, 10),
+    "subsample": ContinuousParameter(0.5, 1),
+}
+
+
 def get_session(region, default_bucket):
     boto_session = boto3.Session(region_name=region)
 
@@ -38,6 +65,25 @@ def get_session(region, default_bucket):
     )
 
 
+def get_code_hash(path):
+    # the hash of a step's code is passed to the step so that editing it changes the cache key
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def get_object_etag(s3_uri, sagemaker_session):
+    # the ETag of the default input data changes the cache key when the data is replaced in
+    # place; prefixes and unreadable objects have none
+    bucket, _, key = s3_uri[len("s3://"):].partition("/")
+    try:
+        s3_client = sagemaker_session.boto_session.client("s3")
+        response = s3_client.head_object(Bucket=bucket, Key=key)
+    except (BotoCoreError, ClientError) as e:
+        print(f"Error getting the ETag of {s3_uri}: {e}")
+        return ""
+    return response["ETag"].strip('"')
+
+
 def get_pipeline(
     region,
     model_package_group_name,
@@ -46,6 +92,15 @@ def get_pipeline(
     commit_id,
     role_arn,
     default_bucket=None,
+    preprocessing_mode="in-memory",
+    output_format="csv",
+    training_input_mode=None,
+    cache_preprocessor=True,
+    cache_expire_after="P30D",
+    tuning_max_jobs=None,
+    tuning_max_parallel_jobs=3,
+    tuning_strategy="Bayesian",
+    keep_alive_period_in_seconds=None,
 ):
     sagemaker_session = get_session(region, default_bucket)
     if role_arn is None:
@@ -53,6 +108,7 @@ def get_pipeline(
 
     # parameters for pipeline execution
     processing_instance_count = ParameterInteger(name="ProcessingInstanceCount", default_value=1)
+    training_instance_count = ParameterInteger(name="TrainingInstanceCount", default_value=1)
     processing_instance_type = ParameterString(
         name="ProcessingInstanceType", default_value="ml.m5.xlarge"
     )
@@ -67,6 +123,13 @@ def get_pipeline(
         default_value=f"s3://sagemaker-servicecatalog-seedcode-{region}/dataset/abalone-dataset.csv",
     )
 
+    # steps are cached on their arguments, which include the hash of their code and the ETag
+    # of the default input data
+    cache_config = CacheConfig(
+        enable_caching=cache_expire_after is not None, expire_after=cache_expire_after
+    )
+    input_etag = get_object_etag(input_data.default_value, sagemaker_session)
+
     # processing step for feature engineering
     sklearn_processor = SKLearnProcessor(
         framework_version="0.23-1",
@@ -75,20 +138,68 @@ def get_pipeline(
         base_job_name=f"{base_job_prefix}/sklearn-abalone-preprocess",
         sagemaker_session=sagemaker_session,
         role=role_arn,
+        env={
+            "CODE_SHA256": get_code_hash(os.path.join(BASE_DIR, "preprocess.py")),
+            "INPUT_ETAG": input_etag,
+        },
     )
+    preprocessing_steps = []
+    preprocessing_inputs = []
+    preprocessing_arguments = ["--input-data", input_data, "--mode", preprocessing_mode]
+    preprocessing_arguments += ["--output-format", output_format]
+    if cache_preprocessor:
+        cache_uri = f"s3://{sagemaker_session.default_bucket()}/{base_job_prefix}/PreprocessorCache"
+        preprocessing_arguments += ["--cache-uri", cache_uri]
+    if preprocessing_mode == "sharded":
+        # each instance reads a disjoint subset of the objects under InputDataUrl; the
+        # statistics step writes per-host partial statistics that every instance of the
+        # preprocessing step merges before transforming its own shard
+        sharded_input = ProcessingInput(
+            source=input_data,
+            destination="/opt/ml/processing/data",
+            s3_data_distribution_type="ShardedByS3Key",
+        )
+        step_statistics = ProcessingStep(
+            name="ComputeAbaloneStatistics",
+            processor=sklearn_processor,
+            inputs=[sharded_input],
+            outputs=[
+                ProcessingOutput(output_name="statistics", source="/opt/ml/processing/statistics"),
+            ],
+            code=os.path.join(BASE_DIR, "preprocess.py"),
+            job_arguments=["--mode", "statistics"],
+            cache_config=cache_config,
+        )
+        preprocessing_steps.append(step_statistics)
+        preprocessing_inputs = [
+            sharded_input,
+            ProcessingInput(
+                source=step_statistics.properties.ProcessingOutputConfig.Outputs[
+                    "statistics"
+                ].S3Output.S3Uri,
+                destination="/opt/ml/processing/statistics",
+            ),
+        ]
+        preprocessing_arguments = ["--mode", "transform", "--output-format", output_format]
+    # one file per training instance and split, read by distributed training as an equal shard
+    preprocessing_arguments += ["--output-parts", training_instance_count.to_string()]
     step_process = ProcessingStep(
         name="PreprocessAbaloneData",
         processor=sklearn_processor,
+        inputs=preprocessing_inputs,
         outputs=[
             ProcessingOutput(output_name="train", source="/opt/ml/processing/train"),
             ProcessingOutput(output_name="validation", source="/opt/ml/processing/validation"),
             ProcessingOutput(output_name="test", source="/opt/ml/processing/test"),
         ],
         code=os.path.join(BASE_DIR, "preprocess.py"),
-        job_arguments=["--input-data", input_data],
+        job_arguments=preprocessing_arguments,
+        cache_config=cache_config,
     )
 
     # training step for generating model artifacts
+    content_type, default_input_mode = OUTPUT_FORMATS[output_format]
+    training_input_mode = training_input_mode or default_input_mode
     model_path = f"s3://{sagemaker_session.default_bucket()}/{base_job_prefix}/AbaloneTrain"
     image_uri = sagemaker.image_uris.retrieve(
         framework="xgboost",
@@ -100,11 +211,15 @@ def get_pipeline(
     xgb_train = Estimator(
         image_uri=image_uri,
         instance_type=training_instance_type,
-        instance_count=1,
+        instance_count=training_instance_count,
         output_path=model_path,
         base_job_name=f"{base_job_prefix}/abalone-train",
         sagemaker_session=sagemaker_session,
         role=role_arn,
+        # keeps the instance and the pulled image in a managed warm pool after training, so
+        # that the next training job of any branch pipeline with the same configuration skips
+        # provisioning; warm pools are not used by tuning jobs
+        keep_alive_period_in_seconds=None if tuning_max_jobs else keep_alive_period_in_seconds,
     )
     xgb_train.set_hyperparameters(
         objective="reg:linear",
@@ -116,28 +231,60 @@ def get_pipeline(
         subsample=0.7,
         silent=0,
     )
-    step_train = TrainingStep(
-        name="TrainAbaloneModel",
-        estimator=xgb_train,
-        inputs={
-            "train": TrainingInput(
-                s3_data=step_process.properties.ProcessingOutputConfig.Outputs[
-                    "train"
-                ].S3Output.S3Uri,
-                content_type="text/csv",
-            ),
-            "validation": TrainingInput(
-                s3_data=step_process.properties.ProcessingOutputConfig.Outputs[
-                    "validation"
-                ].S3Output.S3Uri,
-                content_type="text/csv",
-            ),
-        },
-    )
+    training_inputs = {
+        "train": TrainingInput(
+            s3_data=step_process.properties.ProcessingOutputConfig.Outputs[
+                "train"
+            ].S3Output.S3Uri,
+            content_type=content_type,
+            input_mode=training_input_mode,
+            distribution="ShardedByS3Key",
+        ),
+        "validation": TrainingInput(
+            s3_data=step_process.properties.ProcessingOutputConfig.Outputs[
+                "validation"
+            ].S3Output.S3Uri,
+            content_type=content_type,
+            input_mode=training_input_mode,
+            distribution="ShardedByS3Key",
+        ),
+    }
+    if tuning_max_jobs:
+        # Hyperband stops training jobs on its own, early stopping only applies to Bayesian search
+        tuner = HyperparameterTuner(
+            estimator=xgb_train,
+            objective_metric_name="validation:rmse",
+            objective_type="Minimize",
+            hyperparameter_ranges=HYPERPARAMETER_RANGES,
+            strategy=tuning_strategy,
+            max_jobs=tuning_max_jobs,
+            max_parallel_jobs=tuning_max_parallel_jobs,
+            early_stopping_type="Auto" if tuning_strategy == "Bayesian" else "Off",
+            base_tuning_job_name=f"{base_job_prefix}/abalone-tune",
+        )
+        step_train = TuningStep(
+            name="TuneAbaloneModel",
+            tuner=tuner,
+            inputs=training_inputs,
+            cache_config=cache_config,
+        )
+        model_data = step_train.get_top_model_s3_uri(
+            top_k=0,
+            s3_bucket=sagemaker_session.default_bucket(),
+            prefix=f"{base_job_prefix}/AbaloneTrain",
+        )
+    else:
+        step_train = TrainingStep(
+            name="TrainAbaloneModel",
+            estimator=xgb_train,
+            inputs=training_inputs,
+            cache_config=cache_config,
+        )
+        model_data = step_train.properties.ModelArtifacts.S3ModelArtifacts
     step_register = RegisterModel(
         name="RegisterAbaloneModel",
         estimator=xgb_train,
-        model_data=step_train.properties.ModelArtifacts.S3ModelArtifacts,
+        model_data=model_data,
         content_types=["text/csv"],
         response_types=["text/csv"],
         inference_instances=["ml.t2.medium", "ml.m5.large"],
@@ -154,10 +301,11 @@ def get_pipeline(
             processing_instance_type,
             processing_instance_count,
             training_instance_type,
+            training_instance_count,
             model_approval_status,
             input_data,
         ],
-        steps=[step_process, step_train, step_register],
+        steps=preprocessing_steps + [step_process, step_train, step_register],
         sagemaker_session=sagemaker_session,
         pipeline_experiment_config=PipelineExperimentConfig(
             experiment_name=model_package_group_name,
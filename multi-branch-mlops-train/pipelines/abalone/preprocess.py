@@ -1,15 +1,27 @@
 """Feature engineers the abalone dataset."""
 import argparse
+import collections
+import hashlib
+import io
+import json
 import logging
 import os
 import pathlib
 import requests
+import struct
+import sys
 import tempfile
 
+from concurrent.futures import ThreadPoolExecutor
+
 import boto3
+import joblib
 import numpy as np
 import pandas as pd
 
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
 from sklearn.compose import ColumnTransformer
 from sklearn.impute import SimpleImputer
 from sklearn.pipeline import Pipeline
@@ -45,6 +57,18 @@ feature_columns_dtype = {
 }
 label_column_dtype = {"rings": np.float64}
 
+categorical_features = ["sex"]
+numeric_features = [c for c in feature_columns_names if c not in categorical_features]
+
+split_names = ["train", "validation", "test"]
+# Upper bounds of the train and validation fractions of the split assignment.
+split_boundaries = [0.7, 0.85]
+
+# File extension of each supported output format of the train, validation and test splits.
+output_extensions = {"csv": "csv", "parquet": "parquet", "recordio-protobuf": "rec"}
+
+RECORDIO_MAGIC = 0xCED7230A
+
 
 def merge_two_dicts(x, y):
     """Merges two dicts, returning a new copy."""
@@ -53,40 +77,93 @@ def merge_two_dicts(x, y):
     return z
 
 
-if __name__ == "__main__":
-    logger.debug("Starting preprocessing.")
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--input-data", type=str, required=True)
-    args = parser.parse_args()
-
-    base_dir = "/opt/ml/processing"
-    pathlib.Path(f"{base_dir}/data").mkdir(parents=True, exist_ok=True)
-    input_data = args.input_data
-    bucket = input_data.split("/")[2]
-    key = "/".join(input_data.split("/")[3:])
-
-    logger.info("Downloading data from bucket: %s, key: %s", bucket, key)
-    fn = f"{base_dir}/data/abalone-dataset.csv"
-    s3 = boto3.resource("s3")
-    s3.Bucket(bucket).download_file(key, fn)
-
-    logger.debug("Reading downloaded data.")
-    df = pd.read_csv(
-        fn,
+def read_csv(filepath_or_buffer, chunksize=None):
+    """Reads the headerless abalone CSV, optionally as an iterator of chunks."""
+    return pd.read_csv(
+        filepath_or_buffer,
         header=None,
         names=feature_columns_names + [label_column],
         dtype=merge_two_dicts(feature_columns_dtype, label_column_dtype),
+        chunksize=chunksize,
     )
-    os.unlink(fn)
 
-    logger.debug("Defining transformers.")
-    numeric_features = list(feature_columns_names)
-    numeric_features.remove("sex")
+
+def _open_arrow_csv(f, block_size=None):
+    """Opens a binary file object as a stream of pyarrow record batches of the abalone CSV.
+
+    Returns:
+        the record batch reader, or None when pyarrow is not installed or `f` is text
+    """
+    if isinstance(f, io.TextIOBase):
+        return None
+    try:
+        import pyarrow as pa
+        from pyarrow import csv
+    except ImportError:
+        return None
+    column_types = {
+        name: pa.string() if dtype is str else pa.float64()
+        for name, dtype in merge_two_dicts(feature_columns_dtype, label_column_dtype).items()
+    }
+    read_options = csv.ReadOptions(column_names=feature_columns_names + [label_column])
+    if block_size is not None:
+        read_options.block_size = block_size
+    # empty strings are missing values, as for pandas
+    convert_options = csv.ConvertOptions(column_types=column_types, strings_can_be_null=True)
+    return csv.open_csv(f, read_options=read_options, convert_options=convert_options)
+
+
+def _arrow_to_frame(table, start):
+    """Converts rows of the abalone CSV to a DataFrame indexed by row ordinal from `start`,
+    with NaN rather than None for the missing categories, as pandas reads them."""
+    df = table.to_pandas()
+    df.index = pd.RangeIndex(start, start + len(df))
+    for column in categorical_features:
+        df[column] = df[column].where(df[column].notna(), np.nan)
+    return df
+
+
+def iter_csv_chunks(f, chunk_size, block_size=None):
+    """Reads the headerless abalone CSV as chunks of `chunk_size` rows indexed by row ordinal.
+
+    Binary inputs are parsed by the multi-threaded pyarrow CSV reader as a stream of record
+    batches, which are regrouped into chunks; text inputs, or all inputs when pyarrow is not
+    installed, are read in chunks by pandas.
+    """
+    reader = _open_arrow_csv(f, block_size)
+    if reader is None:
+        yield from read_csv(f, chunksize=chunk_size)
+        return
+    import pyarrow as pa
+
+    batches, rows, start = [], 0, 0
+    for batch in reader:
+        batches.append(batch)
+        rows += batch.num_rows
+        while rows >= chunk_size:
+            table = pa.Table.from_batches(batches, reader.schema)
+            yield _arrow_to_frame(table.slice(0, chunk_size), start)
+            start += chunk_size
+            rest = table.slice(chunk_size)
+            batches, rows = rest.to_batches(), rest.num_rows
+    if rows:
+        yield _arrow_to_frame(pa.Table.from_batches(batches, reader.schema), start)
+
+
+def read_dataframe(f):
+    """Reads the whole headerless abalone CSV, with pyarrow when it can, see iter_csv_chunks."""
+    reader = _open_arrow_csv(f)
+    if reader is None:
+        return read_csv(f)
+    return _arrow_to_frame(reader.read_all(), 0)
+
+
+def get_preprocessor():
+    """Defines the transformers that are fitted on the whole dataset in memory."""
     numeric_transformer = Pipeline(
         steps=[("imputer", SimpleImputer(strategy="median")), ("scaler", StandardScaler())]
     )
 
-    categorical_features = ["sex"]
     categorical_transformer = Pipeline(
         steps=[
             ("imputer", SimpleImputer(strategy="constant", fill_value="missing")),
@@ -94,27 +171,788 @@ if __name__ == "__main__":
         ]
     )
 
-    preprocess = ColumnTransformer(
+    return ColumnTransformer(
         transformers=[
             ("num", numeric_transformer, numeric_features),
             ("cat", categorical_transformer, categorical_features),
         ]
     )
 
-    logger.info("Applying transforms.")
-    y = df.pop("rings")
-    X_pre = preprocess.fit_transform(df)
-    y_pre = y.to_numpy().reshape(len(y), 1)
 
-    X = np.concatenate((y_pre, X_pre), axis=1)
+class RunningStatistics:
+    """Accumulates the statistics of the abalone transformers one chunk at a time.
+
+    Numeric columns keep a count, mean and sum of squared deviations, combined across
+    chunks with the parallel variance update of Chan et al., plus a bounded uniform
+    sample (bottom-k by random priority) from which the median is approximated. The
+    median is exact while a column has at most `sample_size` non-null values.
+    Categorical columns keep their vocabulary.
+    """
+
+    def __init__(self, sample_size=100000, seed=0):
+        self.sample_size = sample_size
+        self.rng = np.random.default_rng(seed)
+        self.rows = 0
+        self.count = {c: 0 for c in numeric_features}
+        self.mean = {c: 0.0 for c in numeric_features}
+        self.m2 = {c: 0.0 for c in numeric_features}
+        self.sample = {c: np.empty(0) for c in numeric_features}
+        self.priority = {c: np.empty(0) for c in numeric_features}
+        self.vocabulary = {c: set() for c in categorical_features}
+
+    def update(self, df):
+        """Folds a chunk of raw rows into the statistics."""
+        self.rows += len(df)
+        for column in numeric_features:
+            values = df[column].dropna().to_numpy(dtype=np.float64)
+            if len(values) == 0:
+                continue
+            self._update_moments(column, len(values), values.mean(), values.var() * len(values))
+            self._update_sample(column, values, self.rng.random(len(values)))
+        for column in categorical_features:
+            self.vocabulary[column].update(df[column].fillna("missing").unique())
+
+    def merge(self, other):
+        """Folds the statistics accumulated by another instance, e.g. on another host."""
+        self.rows += other.rows
+        for column in numeric_features:
+            if other.count[column] == 0:
+                continue
+            self._update_moments(column, other.count[column], other.mean[column], other.m2[column])
+            self._update_sample(column, other.sample[column], other.priority[column])
+        for column in categorical_features:
+            self.vocabulary[column].update(other.vocabulary[column])
+
+    def save(self, path):
+        """Writes the partial statistics to an `.npz` file."""
+        arrays = {
+            "rows": np.array(self.rows),
+            "count": np.array([self.count[c] for c in numeric_features]),
+            "mean": np.array([self.mean[c] for c in numeric_features]),
+            "m2": np.array([self.m2[c] for c in numeric_features]),
+        }
+        for column in numeric_features:
+            arrays[f"sample_{column}"] = self.sample[column]
+            arrays[f"priority_{column}"] = self.priority[column]
+        for column in categorical_features:
+            arrays[f"vocabulary_{column}"] = np.array(sorted(self.vocabulary[column]), dtype=str)
+        np.savez_compressed(path, **arrays)
+
+    @classmethod
+    def load(cls, path, sample_size=100000):
+        """Reads partial statistics written by `save()`."""
+        statistics = cls(sample_size=sample_size)
+        with np.load(path) as arrays:
+            statistics.rows = int(arrays["rows"])
+            for index, column in enumerate(numeric_features):
+                statistics.count[column] = int(arrays["count"][index])
+                statistics.mean[column] = float(arrays["mean"][index])
+                statistics.m2[column] = float(arrays["m2"][index])
+                statistics.sample[column] = arrays[f"sample_{column}"]
+                statistics.priority[column] = arrays[f"priority_{column}"]
+            for column in categorical_features:
+                statistics.vocabulary[column] = set(arrays[f"vocabulary_{column}"].tolist())
+        return statistics
+
+    def _update_moments(self, column, count, mean, m2):
+        total = self.count[column] + count
+        delta = mean - self.mean[column]
+        self.mean[column] += delta * count / total
+        self.m2[column] += m2 + delta**2 * self.count[column] * count / total
+        self.count[column] = total
+
+    def _update_sample(self, column, values, priority):
+        values = np.concatenate((self.sample[column], values))
+        priority = np.concatenate((self.priority[column], priority))
+        if len(values) > self.sample_size:
+            keep = np.argpartition(priority, self.sample_size)[: self.sample_size]
+            values, priority = values[keep], priority[keep]
+        self.sample[column], self.priority[column] = values, priority
+
+    def transformer(self):
+        """Freezes the statistics into a transformer equivalent to `get_preprocessor()`.
+
+        The scaler statistics are those of the imputed column: the mean and variance of the
+        observed values are combined with the missing values set to the median.
+        """
+        medians, means, scales = {}, {}, {}
+        for column in numeric_features:
+            count, mean, m2 = self.count[column], self.mean[column], self.m2[column]
+            median = float(np.median(self.sample[column])) if count else np.nan
+            missing = self.rows - count
+            if count and missing:
+                delta = median - mean
+                mean += delta * missing / self.rows
+                m2 += delta**2 * count * missing / self.rows
+            scale = np.sqrt(m2 / self.rows) if self.rows else 0.0
+            medians[column], means[column] = median, mean
+            scales[column] = scale if scale > np.finfo(np.float64).eps else 1.0
+        categories = {c: sorted(self.vocabulary[c]) for c in categorical_features}
+        return StreamingTransformer(medians, means, scales, categories)
+
+
+class StreamingTransformer:
+    """Applies median imputation, standard scaling and one-hot encoding chunk by chunk."""
+
+    def __init__(self, medians, means, scales, categories):
+        self.medians = medians
+        self.means = means
+        self.scales = scales
+        self.categories = categories
+
+    def transform(self, df):
+        """Transforms a chunk of raw rows into the dense feature matrix."""
+        numeric = df[numeric_features].fillna(self.medians)
+        numeric = (numeric - pd.Series(self.means)) / pd.Series(self.scales)
+        blocks = [numeric[numeric_features].to_numpy(dtype=np.float64)]
+        for column in categorical_features:
+            codes = pd.Categorical(
+                df[column].fillna("missing"), categories=self.categories[column]
+            ).codes
+            onehot = np.zeros((len(df), len(self.categories[column])))
+            known = codes >= 0
+            onehot[np.flatnonzero(known), codes[known]] = 1.0
+            blocks.append(onehot)
+        return np.hstack(blocks)
+
+
+def get_feature_names(preprocessor):
+    """Gets the names of the columns of the feature matrix, `<column>_<category>` for the
+    one-hot encoded ones, from either a fitted `ColumnTransformer` or `StreamingTransformer`."""
+    if isinstance(preprocessor, StreamingTransformer):
+        categories = preprocessor.categories
+    else:
+        onehot = preprocessor.named_transformers_["cat"].named_steps["onehot"]
+        categories = dict(zip(categorical_features, onehot.categories_))
+    one_hot_names = [f"{c}_{v}" for c in categorical_features for v in categories[c]]
+    return numeric_features + one_hot_names
+
+
+def write_feature_names(base_dir, preprocessor):
+    """Writes the feature names next to the test split, for evaluate.py to find the segments."""
+    pathlib.Path(f"{base_dir}/test").mkdir(parents=True, exist_ok=True)
+    with open(f"{base_dir}/test/feature-names.json", "w") as f:
+        json.dump(get_feature_names(preprocessor), f)
+
+
+def _varint(value):
+    """Encodes an unsigned integer as a protobuf varint."""
+    encoded = bytearray()
+    while value > 0x7F:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def _field(number, payload):
+    """Encodes a length-delimited protobuf field."""
+    return _varint(number << 3 | 2) + _varint(len(payload)) + payload
+
+
+def _float32_entry(number, width):
+    """Encodes a `values` map entry holding a dense Float32Tensor of zeros.
+
+    Returns:
+        the encoded entry and the offset of the float bytes inside it
+    """
+    tensor = _field(1, bytes(4 * width))
+    entry = _field(number, _field(1, b"values") + _field(2, _field(2, tensor)))
+    return entry, len(entry) - 4 * width
+
+
+def write_recordio_protobuf(f, y, X):
+    """Writes labelled dense rows as RecordIO-wrapped `aialgs` Record protobufs.
+
+    Every row has the same width, so every record has the same layout: the framing and
+    protobuf bytes are encoded once and the float32 values of all the rows are copied
+    into a tiled template in one vectorized operation.
+    """
+    features, features_offset = _float32_entry(1, X.shape[1])
+    label, label_offset = _float32_entry(2, 1)
+    record = features + label
+    padding = bytes(-len(record) % 4)
+    template = np.frombuffer(
+        struct.pack("<II", RECORDIO_MAGIC, len(record)) + record + padding, dtype=np.uint8
+    )
+    features_offset += 8
+    label_offset += 8 + len(features)
+
+    rows = np.tile(template, (len(X), 1))
+    rows[:, features_offset : features_offset + 4 * X.shape[1]] = (
+        np.ascontiguousarray(X, dtype="<f4").view(np.uint8).reshape(len(X), -1)
+    )
+    rows[:, label_offset : label_offset + 4] = (
+        np.ascontiguousarray(y, dtype="<f4").view(np.uint8).reshape(len(X), -1)
+    )
+    f.write(rows.tobytes())
+
+
+class SplitWriter:
+    """Appends labelled rows to the train, validation and test outputs.
+
+    The label is written as the first column for CSV and Parquet, as expected by the
+    XGBoost algorithm, and as the record label for RecordIO-protobuf.
+
+    With `parts` greater than one, every split is written as that many files of about the
+    same number of rows, so that a channel distributed `ShardedByS3Key` gives each training
+    instance an equal share.
+    """
+
+    def __init__(self, base_dir, output_format="csv", suffix="", parts=1):
+        self.output_format = output_format
+        self.parts = parts
+        self.paths = {}
+        self.files = {}
+        extension = output_extensions[output_format]
+        for name in split_names:
+            pathlib.Path(f"{base_dir}/{name}").mkdir(parents=True, exist_ok=True)
+            if parts == 1:
+                self.paths[name] = [f"{base_dir}/{name}/{name}{suffix}.{extension}"]
+            else:
+                self.paths[name] = [
+                    f"{base_dir}/{name}/{name}{suffix}-part-{part:05d}.{extension}"
+                    for part in range(parts)
+                ]
+
+    def write(self, name, y, X):
+        """Appends the rows of feature matrix `X` labelled with `y` to split `name`."""
+        if self.parts == 1:
+            self._write_part(name, 0, y, X)
+            return
+        bounds = np.linspace(0, len(y), self.parts + 1).astype(int)
+        for part in range(self.parts):
+            start, end = bounds[part], bounds[part + 1]
+            if end > start:
+                self._write_part(name, part, y[start:end], X[start:end])
+
+    def _write_part(self, name, part, y, X):
+        key = (name, part)
+        if self.output_format == "parquet":
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            columns = [pa.array(y, type=pa.float32())]
+            columns += [pa.array(X[:, i], type=pa.float32()) for i in range(X.shape[1])]
+            table = pa.table(columns, names=[label_column] + [f"f{i}" for i in range(X.shape[1])])
+            if key not in self.files:
+                self.files[key] = pq.ParquetWriter(self.paths[name][part], table.schema)
+            self.files[key].write_table(table)
+            return
+
+        if key not in self.files:
+            mode = "w" if self.output_format == "csv" else "wb"
+            self.files[key] = open(self.paths[name][part], mode)
+        if self.output_format == "csv":
+            frame = pd.DataFrame(X)
+            frame.insert(0, label_column, y)
+            frame.to_csv(self.files[key], header=False, index=False)
+        else:
+            write_recordio_protobuf(self.files[key], y, X)
+
+    def close(self):
+        """Closes the outputs, creating empty ones for the parts that received no rows."""
+        for name in split_names:
+            for part, path in enumerate(self.paths[name]):
+                if (name, part) not in self.files and self.output_format != "parquet":
+                    open(path, "w").close()
+        for f in self.files.values():
+            f.close()
+
+
+class RangedS3Reader(io.RawIOBase):
+    """Read-only file object over an S3 object, fetched with concurrent ranged GETs.
+
+    Up to `max_workers` parts of `part_size` bytes are fetched ahead of the position of the
+    reader into memory, so parsing overlaps with the downloads and nothing touches the disk.
+    Every part is requested with the ETag of the first response, so an object overwritten
+    while it is read fails the read instead of mixing two versions.
+    """
+
+    def __init__(self, bucket, key, part_size=8 * 1024 * 1024, max_workers=8, client=None):
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.max_workers = max_workers
+        self._client = client or boto3.client("s3", config=Config(max_pool_connections=max_workers))
+        head = self._client.head_object(Bucket=bucket, Key=key)
+        self.size = head["ContentLength"]
+        self._etag = head["ETag"]
+        self._executor = ThreadPoolExecutor(max_workers)
+        self._parts = collections.deque()
+        self._next_offset = 0
+        self._buffer = memoryview(b"")
+        self._prefetch()
+
+    def _fetch(self, start, end):
+        response = self._client.get_object(
+            Bucket=self.bucket, Key=self.key, Range=f"bytes={start}-{end - 1}", IfMatch=self._etag
+        )
+        return response["Body"].read()
+
+    def _prefetch(self):
+        while len(self._parts) < self.max_workers and self._next_offset < self.size:
+            end = min(self._next_offset + self.part_size, self.size)
+            self._parts.append(self._executor.submit(self._fetch, self._next_offset, end))
+            self._next_offset = end
 
-    logger.info("Splitting %d rows of data into train, validation, test datasets.", len(X))
-    np.random.shuffle(X)
-    train, validation, test = np.split(X, [int(0.7 * len(X)), int(0.85 * len(X))])
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self._buffer:
+            if not self._parts:
+                return 0
+            self._buffer = memoryview(self._parts.popleft().result())
+            self._prefetch()
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            for part in self._parts:
+                part.cancel()
+            self._executor.shutdown(wait=False)
+        super().close()
+
+
+def split_keys(chunk, split_key=None, source=""):
+    """Gets the keys that the split of each row of `chunk` is derived from.
+
+    Args:
+        chunk: a raw DataFrame chunk, indexed by row ordinal within its source file.
+        split_key: the column to split by, so that rows sharing a value stay together,
+            or None to split by row ordinal.
+        source: the name of the file `chunk` was read from.
+
+    Returns:
+        a DataFrame with one key per row
+    """
+    if split_key is not None:
+        return chunk[[split_key]]
+    return pd.DataFrame({"source": source, "row": chunk.index.to_numpy()})
+
+
+def assign_splits(keys, seed=0):
+    """Assigns each row to a split by a stable hash of its key.
+
+    The assignment only depends on the key and the seed, so it is the same across reruns,
+    chunk sizes and the hosts a shard is processed on.
+
+    Args:
+        keys: a DataFrame with the keys of the rows, as returned by `split_keys`.
+        seed: the seed of the hash.
+
+    Returns:
+        an array with the index in `split_names` of the split of each row
+    """
+    # The seed is hashed as one more key column, `hash_key` only applies to string columns.
+    hashes = pd.util.hash_pandas_object(keys.assign(split_seed=seed), index=False)
+    # The top 53 bits of the hash make a uniform double in [0, 1).
+    uniform = (hashes.to_numpy() >> np.uint64(11)) * 2.0**-53
+    return np.digitize(uniform, split_boundaries)
+
+
+def get_fingerprint(bucket, key, mode):
+    """Fingerprints the input object, the features and this script for the preprocessor cache.
+
+    The ETag and size identify the content of the object without reading it, so a cached
+    preprocessor is found before any pass over the data.
+
+    Args:
+        bucket: the bucket of the input object.
+        key: the key of the input object.
+        mode: the preprocessing mode, which decides the type of the fitted preprocessor.
+
+    Returns:
+        the hex digest of the fingerprint
+    """
+    head = boto3.client("s3").head_object(Bucket=bucket, Key=key)
+    with open(__file__, "rb") as f:
+        script_hash = hashlib.sha256(f.read()).hexdigest()
+    fingerprint = {
+        "etag": head["ETag"],
+        "size": head["ContentLength"],
+        "mode": mode,
+        "features": [feature_columns_names, categorical_features, label_column],
+        "script": script_hash,
+    }
+    return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()
+
+
+def _cache_location(cache_uri, fingerprint):
+    bucket, _, prefix = cache_uri[len("s3://") :].partition("/")
+    return bucket, "/".join(filter(None, [prefix.rstrip("/"), fingerprint, "preprocessor.joblib"]))
+
+
+def load_cached_preprocessor(cache_uri, fingerprint):
+    """Loads the preprocessor fitted for `fingerprint` from the cache under `cache_uri`.
+
+    Returns:
+        the fitted preprocessor, or None on a cache miss
+    """
+    bucket, key = _cache_location(cache_uri, fingerprint)
+    try:
+        body = boto3.client("s3").get_object(Bucket=bucket, Key=key)["Body"].read()
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            logger.info("No cached preprocessor at s3://%s/%s.", bucket, key)
+            return None
+        raise
+    logger.info("Loaded the cached preprocessor from s3://%s/%s.", bucket, key)
+    return joblib.load(io.BytesIO(body))
+
+
+def save_cached_preprocessor(cache_uri, fingerprint, preprocessor):
+    """Saves the fitted `preprocessor` for `fingerprint` to the cache under `cache_uri`."""
+    bucket, key = _cache_location(cache_uri, fingerprint)
+    buffer = io.BytesIO()
+    joblib.dump(preprocessor, buffer)
+    boto3.client("s3").put_object(Bucket=bucket, Key=key, Body=buffer.getvalue())
+    logger.info("Cached the fitted preprocessor at s3://%s/%s.", bucket, key)
+
+
+def preprocess_in_memory(
+    bucket,
+    key,
+    base_dir,
+    output_format="csv",
+    split_key=None,
+    seed=0,
+    preprocessor=None,
+    parts=1,
+):
+    """Reads the dataset and fits the transformers with the whole dataset in memory.
+
+    Args:
+        preprocessor: an already fitted preprocessor, in which case the fit is skipped.
+        parts: the number of files each split is written as.
+
+    Returns:
+        the fitted preprocessor
+    """
+    logger.info("Reading data from bucket: %s, key: %s", bucket, key)
+    with RangedS3Reader(bucket, key) as f:
+        df = read_dataframe(f)
+    return preprocess_dataframe(
+        df, base_dir, output_format, split_key, seed, preprocessor, parts, source=key
+    )
+
+
+def preprocess_dataframe(
+    df,
+    base_dir,
+    output_format="csv",
+    split_key=None,
+    seed=0,
+    preprocessor=None,
+    parts=1,
+    source="",
+):
+    """Splits, fits the transformers on and transforms a dataset held in memory.
+
+    Args:
+        source: the name of the input, hashed along with the row ordinals.
+
+    Returns:
+        the fitted preprocessor
+    """
+    logger.info("Splitting %d rows of data into train, validation, test datasets.", len(df))
+    split = assign_splits(split_keys(df, split_key, source=source), seed)
+    y = df.pop("rings").to_numpy()
+
+    if preprocessor is None:
+        logger.debug("Defining transformers.")
+        preprocessor = get_preprocessor().fit(df)
+
+    logger.info("Applying transforms.")
+    X = preprocessor.transform(df)
+    logger.info(f"X Shape: {X.shape}")
 
     logger.info("Writing out datasets to %s.", base_dir)
-    pd.DataFrame(train).to_csv(f"{base_dir}/train/train.csv", header=False, index=False)
-    pd.DataFrame(validation).to_csv(
-        f"{base_dir}/validation/validation.csv", header=False, index=False
+    write_feature_names(base_dir, preprocessor)
+    writer = SplitWriter(base_dir, output_format, parts=parts)
+    try:
+        for index, name in enumerate(split_names):
+            writer.write(name, y[split == index], X[split == index])
+    finally:
+        writer.close()
+    return preprocessor
+
+
+def accumulate_statistics(chunks, seed=0):
+    """Runs the first pass, accumulating the transformer statistics over `chunks`."""
+    statistics = RunningStatistics(seed=seed)
+    for chunk in chunks:
+        statistics.update(chunk)
+    logger.info("Accumulated statistics over %d rows.", statistics.rows)
+    return statistics
+
+
+def write_splits(
+    chunks,
+    transformer,
+    base_dir,
+    output_format="csv",
+    suffix="",
+    split_key=None,
+    seed=0,
+    parts=1,
+):
+    """Runs the second pass, appending each transformed chunk to its split outputs.
+
+    Args:
+        chunks: iterable of `(source, chunk)` pairs of raw DataFrame chunks.
+        transformer: the fitted `StreamingTransformer`.
+        base_dir: the processing directory holding the output folders.
+        output_format: one of `output_extensions`.
+        suffix: appended to the output file names so that hosts do not overwrite each other.
+        split_key: the column to split by, or None to split by row ordinal.
+        seed: the seed of the split assignment.
+        parts: the number of files each split is written as.
+    """
+    write_feature_names(base_dir, transformer)
+    writer = SplitWriter(base_dir, output_format, suffix, parts)
+    try:
+        for source, chunk in chunks:
+            split = assign_splits(split_keys(chunk, split_key, source), seed)
+            y = chunk.pop(label_column).to_numpy()
+            X = transformer.transform(chunk)
+            for index, name in enumerate(split_names):
+                writer.write(name, y[split == index], X[split == index])
+    finally:
+        writer.close()
+
+
+def preprocess_streaming(
+    open_input,
+    base_dir,
+    chunk_size,
+    seed=0,
+    output_format="csv",
+    split_key=None,
+    source="",
+    transformer=None,
+    parts=1,
+):
+    """Preprocesses the dataset in two passes over chunks of `chunk_size` rows.
+
+    The first pass accumulates the transformer statistics, the second transforms each
+    chunk and appends its rows straight to the train, validation and test outputs, so
+    memory stays bounded by the chunk size rather than the dataset size.
+
+    Args:
+        open_input: callable opening a fresh file-like object over the raw CSV.
+        base_dir: the processing directory holding the output folders.
+        chunk_size: the number of rows read and transformed at a time.
+        seed: the seed of the median sample and of the split assignment.
+        output_format: one of `output_extensions`.
+        split_key: the column to split by, or None to split by row ordinal.
+        source: the name of the input, hashed along with the row ordinals.
+        transformer: an already fitted `StreamingTransformer`, in which case the first
+            pass is skipped.
+        parts: the number of files each split is written as.
+
+    Returns:
+        the fitted `StreamingTransformer`
+    """
+    if transformer is None:
+        logger.info("Accumulating statistics in chunks of %d rows.", chunk_size)
+        with open_input() as f:
+            statistics = accumulate_statistics(iter_csv_chunks(f, chunk_size), seed)
+        transformer = statistics.transformer()
+
+    logger.info("Applying transforms and writing out datasets to %s.", base_dir)
+    with open_input() as f:
+        chunks = ((source, chunk) for chunk in iter_csv_chunks(f, chunk_size))
+        write_splits(
+            chunks,
+            transformer,
+            base_dir,
+            output_format,
+            split_key=split_key,
+            seed=seed,
+            parts=parts,
+        )
+    return transformer
+
+
+def get_host_info(resource_config="/opt/ml/config/resourceconfig.json"):
+    """Gets the current host and all hosts of the processing job.
+
+    Returns:
+        a tuple of the current host name and the sorted list of host names
+    """
+    if not os.path.exists(resource_config):
+        return "algo-1", ["algo-1"]
+    with open(resource_config) as f:
+        config = json.load(f)
+    return config["current_host"], sorted(config["hosts"])
+
+
+def read_local_chunks(input_dir, chunk_size):
+    """Reads every file under `input_dir`, in key order, as chunks of `chunk_size` rows.
+
+    Yields:
+        `(source, chunk)` pairs, where source is the path of the file relative to `input_dir`
+    """
+    for path in sorted(pathlib.Path(input_dir).rglob("*")):
+        if path.is_file():
+            source = path.relative_to(input_dir).as_posix()
+            with open(path, "rb") as f:
+                for chunk in iter_csv_chunks(f, chunk_size):
+                    yield source, chunk
+
+
+def preprocess_shard_statistics(input_dir, statistics_dir, chunk_size, host, hosts, seed=0):
+    """Map step of the sharded mode: accumulates the statistics of this host's shard.
+
+    Each host writes its partial statistics to `statistics-<host>.npz`; all the partial
+    files are gathered under one S3 prefix that feeds `preprocess_shard_transform`.
+    """
+    logger.info("Accumulating statistics of the shard on host %s.", host)
+    chunks = (chunk for _, chunk in read_local_chunks(input_dir, chunk_size))
+    statistics = accumulate_statistics(chunks, seed=[seed, hosts.index(host)])
+    pathlib.Path(statistics_dir).mkdir(parents=True, exist_ok=True)
+    statistics.save(f"{statistics_dir}/statistics-{host}.npz")
+
+
+def preprocess_shard_transform(
+    input_dir,
+    statistics_dir,
+    base_dir,
+    chunk_size,
+    host,
+    hosts,
+    seed=0,
+    output_format="csv",
+    split_key=None,
+    parts=1,
+):
+    """Reduce and transform step of the sharded mode.
+
+    Every host merges all the partial statistics, in host order so that each of them ends
+    up with the same transformer, and then transforms and splits its own shard only. The
+    split of a row is hashed from its file and ordinal, so it does not depend on the host.
+    """
+    paths = sorted(pathlib.Path(statistics_dir).glob("statistics-*.npz"))
+    logger.info("Merging %d partial statistics on host %s.", len(paths), host)
+    statistics = RunningStatistics()
+    for path in paths:
+        statistics.merge(RunningStatistics.load(path))
+
+    logger.info("Applying transforms and writing out datasets to %s.", base_dir)
+    chunks = read_local_chunks(input_dir, chunk_size)
+    write_splits(
+        chunks,
+        statistics.transformer(),
+        base_dir,
+        output_format=output_format,
+        suffix=f"-{host}",
+        split_key=split_key,
+        seed=seed,
+        parts=parts,
     )
-    pd.DataFrame(test).to_csv(f"{base_dir}/test/test.csv", header=False, index=False)
+
+
+if __name__ == "__main__":
+    logger.debug("Starting preprocessing.")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input-data", type=str)
+    parser.add_argument(
+        "--mode",
+        type=str,
+        default="in-memory",
+        choices=["in-memory", "streaming", "statistics", "transform"],
+    )
+    parser.add_argument("--chunk-size", type=int, default=100000)
+    parser.add_argument("--output-format", type=str, default="csv", choices=list(output_extensions))
+    parser.add_argument(
+        "--split-key",
+        type=str,
+        default=None,
+        choices=feature_columns_names + [label_column],
+        help="column to assign the splits by, defaults to the row ordinal",
+    )
+    parser.add_argument("--split-seed", type=int, default=0)
+    parser.add_argument(
+        "--output-parts",
+        type=int,
+        default=1,
+        help="number of files each split is written as, per host in the sharded mode",
+    )
+    parser.add_argument(
+        "--cache-uri",
+        type=str,
+        default=None,
+        help="S3 prefix of the fitted preprocessor cache of the in-memory and streaming modes",
+    )
+    args = parser.parse_args()
+
+    base_dir = "/opt/ml/processing"
+    if args.mode in ("statistics", "transform"):
+        current_host, hosts = get_host_info()
+        if args.mode == "statistics":
+            preprocess_shard_statistics(
+                f"{base_dir}/data",
+                f"{base_dir}/statistics",
+                args.chunk_size,
+                current_host,
+                hosts,
+                seed=args.split_seed,
+            )
+        else:
+            preprocess_shard_transform(
+                f"{base_dir}/data",
+                f"{base_dir}/statistics",
+                base_dir,
+                args.chunk_size,
+                current_host,
+                hosts,
+                seed=args.split_seed,
+                output_format=args.output_format,
+                split_key=args.split_key,
+                parts=args.output_parts,
+            )
+        sys.exit(0)
+
+    if args.input_data is None:
+        parser.error(f"--input-data is required in {args.mode} mode")
+    input_data = args.input_data
+    bucket = input_data.split("/")[2]
+    key = "/".join(input_data.split("/")[3:])
+
+    cached = None
+    if args.cache_uri is not None:
+        fingerprint = get_fingerprint(bucket, key, args.mode)
+        cached = load_cached_preprocessor(args.cache_uri, fingerprint)
+
+    if args.mode == "streaming":
+        logger.info("Streaming data from bucket: %s, key: %s", bucket, key)
+        fitted = preprocess_streaming(
+            lambda: RangedS3Reader(bucket, key),
+            base_dir,
+            args.chunk_size,
+            seed=args.split_seed,
+            output_format=args.output_format,
+            split_key=args.split_key,
+            source=key,
+            transformer=cached,
+            parts=args.output_parts,
+        )
+    else:
+        fitted = preprocess_in_memory(
+            bucket,
+            key,
+            base_dir,
+            args.output_format,
+            args.split_key,
+            args.split_seed,
+            cached,
+            args.output_parts,
+        )
+
+    if args.cache_uri is not None and cached is None:
+        save_cached_preprocessor(args.cache_uri, fingerprint, fitted)
@@ -4,9 +4,64 @@ import argparse
 import json
 import sys
 
+import boto3
+from botocore.exceptions import ClientError
+
 from abalone.pipeline import get_pipeline
 
 
+def describe_training_job(sagemaker_client, training_job_name):
+    """Describes a training job, adding the seconds from its creation to the start of training."""
+    job = sagemaker_client.describe_training_job(TrainingJobName=training_job_name)
+    job['StartupSeconds'] = (job['TrainingStartTime'] - job['CreationTime']).total_seconds()
+    return job
+
+
+def get_warm_pool_origin(sagemaker_client, job):
+    """Gets the name of the training job whose warm pool a training job reused, or None."""
+    # the original job was created before, and marked as reused after, the reusing job
+    paginator = sagemaker_client.get_paginator('list_training_jobs')
+    pages = paginator.paginate(
+        WarmPoolStatusEquals='Reused',
+        CreationTimeBefore=job['CreationTime'],
+        LastModifiedTimeAfter=job['CreationTime'],
+    )
+    for page in pages:
+        for summary in page['TrainingJobSummaries']:
+            if summary.get('WarmPoolStatus', {}).get('ReusedByJob') == job['TrainingJobName']:
+                return summary['TrainingJobName']
+    return None
+
+
+def get_startup_report(sagemaker_client, steps):
+    """Reports the startup seconds of the training jobs of a pipeline execution, and the
+    seconds saved by running them on a warm pool instead of on new instances.
+
+    The saving of a training job is the startup time of the job that provisioned the warm
+    pool it ran on minus its own startup time.
+    """
+    report = []
+    for step in steps:
+        training_job_arn = step.get('Metadata', {}).get('TrainingJob', {}).get('Arn')
+        if training_job_arn is None:
+            continue
+        job = describe_training_job(sagemaker_client, training_job_arn.split('/')[-1])
+        cold_job, origins = job, []
+        origin = get_warm_pool_origin(sagemaker_client, job)
+        while origin is not None:
+            origins.append(origin)
+            cold_job = describe_training_job(sagemaker_client, origin)
+            origin = get_warm_pool_origin(sagemaker_client, cold_job)
+        report.append({
+            'step_name': step['StepName'],
+            'training_job_name': job['TrainingJobName'],
+            'startup_seconds': job['StartupSeconds'],
+            'warm_pool_origin': origins[0] if origins else None,
+            'startup_seconds_saved': max(cold_job['StartupSeconds'] - job['StartupSeconds'], 0.0),
+        })
+    return report
+
+
 def main():  # pragma: no cover
     parser = argparse.ArgumentParser()
 
@@ -17,6 +72,7 @@ def main():  # pragma: no cover
     parser.add_argument('-experiment-name', '--experiment-name', dest='experiment_name', type=str, required=True)
     parser.add_argument('-commit-id', '--commit-id', dest='commit_id', type=str, required=True)
     parser.add_argument('-role-arn', '--role-arn', dest='role_arn', type=str, required=True)
+    parser.add_argument('-keep-alive-period-in-seconds', '--keep-alive-period-in-seconds', dest='keep_alive_period_in_seconds', type=int, default=None)
 
     args = parser.parse_args()
     print(f'args={args}')
@@ -29,6 +85,7 @@ def main():  # pragma: no cover
             base_job_prefix=args.model_name,
             commit_id=args.commit_id,
             role_arn=args.role_arn,
+            keep_alive_period_in_seconds=args.keep_alive_period_in_seconds,
         )
         print("###### Creating/updating a SageMaker Pipeline with the following definition:")
         parsed = json.loads(pipeline.definition())
@@ -57,7 +114,19 @@ def main():  # pragma: no cover
         execution.wait()
         print("\n#####Execution completed. Execution step details:")
 
-        print(execution.list_steps())
+        steps = execution.list_steps()
+        print(steps)
+
+        sagemaker_client = boto3.client('sagemaker', region_name=args.region)
+        try:
+            startup_report = get_startup_report(sagemaker_client, steps)
+        except ClientError as e:
+            print(f"Error getting the training startup report: {e}")
+        else:
+            print("\n###### Training startup seconds and seconds saved by warm pools:")
+            print(json.dumps(startup_report, indent=2))
+            saved = sum(job['startup_seconds_saved'] for job in startup_report)
+            print(f"Startup seconds saved: {saved}")
     except Exception as e:  # pylint: disable=W0703
         print(f"Exception: {e}")
         sys.exit(1)
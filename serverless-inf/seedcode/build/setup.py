@@ -19,11 +19,14 @@ extras = {
         "coverage",
         "flake8",
         "mock",
+        "pyarrow",
         "pydocstyle",
         "pytest",
         "pytest-cov",
         "sagemaker",
+        "scikit-learn",
         "tox",
+        "xgboost",
     ]
 }
 setuptools.setup(